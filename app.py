@@ -1,10 +1,18 @@
 import gradio as gr
-import math
-import threading
-from raiden.chatbot_engine import chat, get_index
+from raiden.chatbot_engine import get_index, CHAT_ERROR_MESSAGE
+from raiden import request_planner
 from dotenv import load_dotenv
 from langchain_community.chat_message_histories import ChatMessageHistory
-from raiden.chatbot_utils import store_response_in_pinecone, search_cached_answer
+from raiden.chatbot_utils import store_response_in_pinecone, get_local_cache
+from raiden.openai_client import priority_lane, PRIORITY_BACKGROUND
+from raiden.deadline import deadline_scope, get_deadline_metrics, REQUEST_BUDGET_SECONDS
+from raiden.serving import serve
+from raiden.batch import router as batch_router
+from raiden.profiling import profiled, requested_profile, router as profiling_router
+from raiden.missing_teeth import (
+    ANY_CLASS, ARCH_CLASSES, SIDE_CLASSES, REGION_CLASSES, SYMMETRY_CLASSES,
+    format_breakdown, describe_filtered_patterns,
+)
 import time
 
 # 環境変数のロード
@@ -14,7 +22,8 @@ load_dotenv()
 index = None
 
 # チャットボットの応答関数
-def respond(message, chat_history):
+@profiled("respond", root=True)
+def respond_message(message, chat_history):
     global index
     start_time = time.time()    
 
@@ -24,38 +33,34 @@ def respond(message, chat_history):
         history.add_user_message(user_message)
         history.add_ai_message(ai_message)
 
-    # 1. キャッシュ検索（過去回答の検索）
-    cached_result = search_cached_answer(message)
-    # cached_result = {"found": False}
-
-    if cached_result.get("found"):        
-        bot_message = cached_result["answer"]
-         # 応答時間を計測して表示
-        elapsed_time = time.time() - start_time
-        print(f"キャッシュヒット！保存済み回答を返します (応答時間: {elapsed_time:.3f}秒)")
-
-    else:
-        # 3. キャッシュヒットしなかった場合 → 新規回答を生成
-        print("キャッシュヒットなし。LLMで新規回答を生成します")
-
-        prompt = f"""
-        1. 専門知識に基づき、質問に関連する情報を要約して回答してください。        
-        2. 回答は日本語で作成し、結論と臨床的な参考事例を含めてください。
-        3. 直接関連する情報がない場合は、最も近い情報を提供し、その旨を明示してください。
-        4. 歯科医療に関する質問（歯牙移植、歯科治療、歯科技工所など）は非常に専門的であるため、必ずベクトル検索ツールを使用してください。自身の知識だけで回答せず、必ずツールを使用してください。
-
-        質問: {message}
-        """
-
-        # indexがNoneの場合は初期化
-        if index is None:
-            index = get_index()
-
-        # LLMから回答を取得
-        bot_message = chat(prompt, history, index)
+    # indexがNoneの場合は初期化
+    if index is None:
+        index = get_index()
 
-        # 4. 回答をPineconeに保存
-        store_result = store_response_in_pinecone(message, bot_message)
+    # 処理全体に時間の予算を設定し、超過しそうなら各段階で縮退させる
+    with deadline_scope(REQUEST_BUDGET_SECONDS):
+        # 1. キャッシュ検索とナレッジ検索を並列に実行し、ヒットしなければそのまま新規回答を生成
+        result = request_planner.answer(message, history, index)
+        bot_message = result["answer"]
+
+        if result["from_cache"]:
+            # 応答時間を計測して表示
+            elapsed_time = time.time() - start_time
+            print(f"キャッシュヒット！保存済み回答を返します (応答時間: {elapsed_time:.3f}秒)")
+
+        elif result["degraded"] or bot_message == CHAT_ERROR_MESSAGE:
+            # 代替回答やエラーメッセージはキャッシュに保存しない
+            print(f"時間切れまたはエラーのため保存しません (応答時間: {time.time() - start_time:.3f}秒)")
+            print(f"デッドライン統計: {get_deadline_metrics()}")
+
+        else:
+            print(f"キャッシュヒットなし。LLMで新規回答を生成しました (応答時間: {time.time() - start_time:.3f}秒)")
+
+    # 4. 回答をPineconeに保存（対話リクエストを優先するためバックグラウンドレーンで実行）
+    # 回答に時間がかかっても保存できるよう、リクエストの予算の外で行う
+    if not (result["from_cache"] or result["degraded"] or bot_message == CHAT_ERROR_MESSAGE):
+        with priority_lane(PRIORITY_BACKGROUND):
+            store_result = store_response_in_pinecone(message, bot_message, question_embedding=result["embedding"])
         if store_result:
             print("新規回答を正常にPineconeに保存しました")
 
@@ -74,34 +79,61 @@ def respond(message, chat_history):
 
     return "", chat_history
 
+def respond(message, chat_history, request: gr.Request = None):
+    # X-Raiden-Profileヘッダーと管理用トークン付きのリクエストはプロファイルを取る
+    with requested_profile(request):
+        return respond_message(message, chat_history)
+
 
 
 # 欠損数チェッカーの関数
 def calculate_combinations_28(n):
     if not (0 <= n <= 28):
         return "0〜28本の間で入力してください。"
-    combinations = math.comb(28, n)
-    return f"上下顎あわせて {n} 本が欠損している場合、\n組み合わせ数は {combinations:,} 通りです。"
+    # 総数に加えて顎別・左右別・部位別などの内訳を表示する
+    return format_breakdown(int(n))
 
 # 欠損数チェッカーのインターフェース
 with gr.Blocks(title="欠損数チェッカー") as dental_app:
     gr.Markdown("## 欠損数チェッカー（上下顎）")
     gr.Markdown("上下顎あわせて28本のうち、何本欠損したかに応じた組み合わせ数を表示します。")
     slider = gr.Slider(0, 28, step=1, value=10, label="欠損歯の本数（上下顎 合計）")
-    output = gr.Textbox(label="結果", lines=2)
+    output = gr.Textbox(label="結果", lines=10)
     slider.change(fn=calculate_combinations_28, inputs=slider, outputs=output)
 
+    gr.Markdown("### 条件で絞り込む")
+    with gr.Row():
+        arch = gr.Dropdown([ANY_CLASS] + ARCH_CLASSES[1:], value=ANY_CLASS, label="顎")
+        side = gr.Dropdown([ANY_CLASS] + SIDE_CLASSES[1:], value=ANY_CLASS, label="左右")
+        region = gr.Dropdown([ANY_CLASS] + REGION_CLASSES[1:], value=ANY_CLASS, label="部位")
+        symmetry = gr.Dropdown([ANY_CLASS] + SYMMETRY_CLASSES, value=ANY_CLASS, label="対称性")
+    max_gap = gr.Slider(1, 14, step=1, value=14, label="最長の連続欠損（本以下）")
+    search_button = gr.Button("該当パターンを表示")
+    filtered_output = gr.Textbox(label="絞り込み結果", lines=12)
+    search_button.click(
+        fn=describe_filtered_patterns,
+        inputs=[slider, arch, side, region, symmetry, max_gap],
+        outputs=filtered_output,
+    )
 
 
-# 欠損数チェッカーを起動する関数
-def run_dental_app():
-    print("欠損数チェッカーを起動中... (http://0.0.0.0:7861)")
-    dental_app.launch(
-        server_name="127.0.0.1",  # EC2では外部からのアクセスを許可するため0.0.0.0を使用
-        server_port=7861,  # チャットボットをメインにするためポートを7861に変更
-        share=False,
-        show_error=True
-    )
+
+with gr.Blocks(css=".gradio-container {background-color:rgb(248, 230, 199)}") as demo:    
+    gr.Markdown("## 自家歯牙移植、歯牙再植、歯科全般について応答します")    
+    gr.Markdown("""
+    ### Chatbotに関するご意見,ご要望は:070-6633-0363  **email**:shibuya8020@gmail.com    
+    """)    
+
+    chatbot = gr.Chatbot(autoscroll=True)
+    msg = gr.Textbox(placeholder="メッセージを入力してください", label="conversation")
+    clear = gr.ClearButton([msg, chatbot])
+    msg.submit(respond, [msg, chatbot], [msg, chatbot])
+
+# 配信するアプリ（タブ名, マウントするパス, Blocks）。先頭がメインのチャットボット
+APPS = [
+    ("🦷 チャットボット", "/", demo),
+    ("📊 欠損数チェッカー", "/dental", dental_app),
+]
 
 # メインのチャットボットアプリ
 if __name__ == "__main__":
@@ -113,28 +145,10 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"インデックス初期化エラー: {e}")
         print("警告: インデックスなしで起動します。必要時に再初期化を試みます。")
-    
-    # 欠損数チェッカーを別スレッドで起動
-    thread = threading.Thread(target=run_dental_app)
-    thread.daemon = True  # メインプログラム終了時にスレッドも終了させる
-    thread.start()
-    
 
-with gr.Blocks(css=".gradio-container {background-color:rgb(248, 230, 199)}") as demo:    
-    gr.Markdown("## 自家歯牙移植、歯牙再植、歯科全般について応答します")    
-    gr.Markdown("""
-    ### Chatbotに関するご意見,ご要望は:070-6633-0363  **email**:shibuya8020@gmail.com    
-    """)    
+    # スナップショットが設定されていれば回答キャッシュをプロセス内に読み込む
+    get_local_cache()
 
-    chatbot = gr.Chatbot(autoscroll=True)
-    msg = gr.Textbox(placeholder="メッセージを入力してください", label="conversation")
-    clear = gr.ClearButton([msg, chatbot])
-    msg.submit(respond, [msg, chatbot], [msg, chatbot])
-    
-    # チャットボットを起動 (メインアプリ)
-    demo.launch(
-        server_name="127.0.0.1",
-        server_port=7860,  # メインアプリをポート7860で起動
-        share=False,
-        show_error=True
-    )
\ No newline at end of file
+    # チャットボットと欠損数チェッカーを1つのサーバーで起動（RAIDEN_SERVE_MODEで切り替え）
+    # バッチ回答API（POST /api/batch）と管理用API（/admin/profiling）も同じサーバーで受け付ける
+    serve(APPS, routers=[batch_router, profiling_router])
\ No newline at end of file
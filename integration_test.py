@@ -1,10 +1,11 @@
 import gradio as gr
-import math
 import threading
 from raiden.chatbot_engine import chat, get_index
 from dotenv import load_dotenv
 from langchain_community.chat_message_histories import ChatMessageHistory
 from raiden.chatbot_utils import store_response_in_pinecone, search_cached_answer
+from raiden.missing_teeth import format_breakdown
+from raiden.serving import serve
 import time
 # グローバル初期化
 load_dotenv()
@@ -14,8 +15,8 @@ index = None
 def calculate_combinations_28(n):
     if not (0 <= n <= 28):
         return "0〜28本の間で入力してください。"
-    combinations = math.comb(28, n)
-    return f"上下顎あわせて {n} 本が欠損している場合、\n組み合わせ数は {combinations:,} 通りです。"
+    # 総数に加えて顎別・左右別・部位別などの内訳を表示する
+    return format_breakdown(int(n))
 
 # チャット応答関数
 def respond(message, chat_history):
@@ -57,8 +58,8 @@ with gr.Blocks(title="RAIDEN v1.320", css=".gradio-container {background-color:r
         with gr.Tab("📊 欠損数チェッカー"):
             gr.Markdown("上下顎あわせて28本のうち、何本欠損しているかに応じた組み合わせ数を計算します。")
             slider = gr.Slider(0, 28, step=1, value=10, label="欠損歯の本数")
-            output = gr.Textbox(label="結果", lines=2)
+            output = gr.Textbox(label="結果", lines=10)
             slider.change(fn=calculate_combinations_28, inputs=slider, outputs=output)
 
-# アプリ起動
-app.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
+# アプリ起動（共通のキュー設定で1つのサーバーから配信）
+serve([("歯科アプリ", "/", app)])
\ No newline at end of file
@@ -0,0 +1,268 @@
+"""
+複数の質問をまとめて処理するバッチ回答
+質問の埋め込みを1回のembed_documentsで計算し、キャッシュ検索を並列に行い、
+キャッシュにない質問は似たもの同士をグループにまとめてナレッジ検索の結果を共有しながら、
+同時実行数を制限してLLMで回答する。結果は入力順にNDJSONで逐次返す。
+
+API:
+    POST /api/batch  {"questions": ["...", "..."], "concurrency": 4}
+    （ヘッダー X-Raiden-Batch-Token に RAIDEN_BATCH_TOKEN の値が必要。未設定ならAPIは使えない）
+    → 1行に1件 {"index": 0, "question": "...", "answer": "...", "from_cache": true}
+"""
+
+import contextvars
+import hmac
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional
+
+import numpy as np
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from langchain_community.chat_message_histories import ChatMessageHistory
+from pydantic import BaseModel
+
+from raiden.chatbot_engine import chat, get_index, build_answer_prompt, CHAT_ERROR_MESSAGE
+from raiden.chatbot_utils import (
+    embedding_model,
+    check_previous_responses,
+    store_responses_in_pinecone,
+    CACHE_INDEX_NAME,
+)
+from raiden.openai_client import priority_lane, PRIORITY_BACKGROUND
+from raiden.request_planner import retrieve_knowledge
+from raiden.text_normalizer import basic_normalize_text
+
+# バッチAPIのトークン（未設定ならバッチAPIは使えない）
+BATCH_TOKEN = os.getenv("RAIDEN_BATCH_TOKEN")
+
+# 1回のリクエストで受け付ける質問数の上限
+BATCH_MAX_QUESTIONS = int(os.getenv("RAIDEN_BATCH_MAX_QUESTIONS", "100"))
+
+# LLMで回答するグループの同時実行数（既定値と上限）
+BATCH_CONCURRENCY = int(os.getenv("RAIDEN_BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = 16
+
+# キャッシュ検索の並列数
+BATCH_CACHE_WORKERS = 8
+
+# 埋め込みの類似度がこれ以上の質問は同じグループとして検索結果を共有する
+BATCH_GROUP_SIMILARITY = 0.9
+
+# グループ内は順に回答するので、同時実行数が活きるようにグループの大きさを制限する
+BATCH_MAX_GROUP_SIZE = 4
+
+def _submit(executor, fn, *args):
+    """呼び出し元のコンテキストを引き継いでスレッドプールで実行する"""
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args)
+
+def group_similar_questions(embeddings, threshold=BATCH_GROUP_SIMILARITY, max_size=BATCH_MAX_GROUP_SIZE):
+    """
+    埋め込みの類似度で質問をグループに分ける（各グループの先頭の質問との類似度で判定する）。
+    max_sizeに達したグループには追加せず、新しいグループを作る。
+
+    Returns:
+    --------
+    list
+        グループごとの質問の位置のリスト
+    """
+    groups = []
+    leaders = []
+    for position, embedding in enumerate(embeddings):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        if leaders:
+            scores = np.vstack(leaders) @ vector
+            scores[[len(group) >= max_size for group in groups]] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] >= threshold:
+                groups[best].append(position)
+                continue
+        leaders.append(vector)
+        groups.append([position])
+    return groups
+
+def _answer_group(questions, positions, embeddings, index, on_answered=None):
+    """
+    1つのグループの質問に順に回答する。ナレッジ検索はグループの先頭の質問で1回だけ行い、
+    その結果を各質問のツールの検索に使う（ツール入力が先頭の質問と十分似ている場合）。
+    ツール結果は質問ごとに別のスコープで持ち、別の質問の回答が混ざらないようにする。
+    正規化後に同じ質問は1回だけ回答する。
+
+    Parameters:
+    -----------
+    on_answered : callable, optional
+        グループの回答が揃ったときに 質問の位置 -> 回答 の辞書を渡して呼ぶ関数（保存に使う）
+
+    Returns:
+    --------
+    dict
+        質問の位置 -> 回答
+    """
+    answers = {}
+    by_text = {}
+    with priority_lane(PRIORITY_BACKGROUND):
+        try:
+            search_results = retrieve_knowledge(index, embeddings[positions[0]])
+        except Exception as e:
+            print(f"バッチのナレッジ検索エラー: {e}")
+            search_results = []
+        for position in positions:
+            key = basic_normalize_text(questions[position])
+            if key not in by_text:
+                by_text[key] = chat(build_answer_prompt(questions[position]), ChatMessageHistory(), index,
+                                    search_results=search_results, search_embedding=embeddings[positions[0]])
+            answers[position] = by_text[key]
+        if on_answered is not None:
+            on_answered(answers)
+    return answers
+
+def _response_storer(questions, embeddings):
+    """
+    生成した回答をグループごとにraiden-cacheへ保存する関数を返す。
+    同じ質問は別のグループで回答しても1回だけ保存する。
+    """
+    stored = set()
+    lock = threading.Lock()
+
+    def store(answers):
+        positions = []
+        with lock:
+            for position in sorted(answers):
+                key = basic_normalize_text(questions[position])
+                if answers[position] != CHAT_ERROR_MESSAGE and key not in stored:
+                    stored.add(key)
+                    positions.append(position)
+        if not positions:
+            return
+        try:
+            store_responses_in_pinecone(
+                [(questions[position], answers[position]) for position in positions],
+                question_embeddings=[embeddings[position] for position in positions],
+            )
+        except Exception as e:
+            print(f"バッチの回答保存エラー: {e}")
+
+    return store
+
+def answer_batch(questions, index, concurrency=BATCH_CONCURRENCY, store=True):
+    """
+    複数の質問に回答し、結果を入力順に1件ずつ返すジェネレーター
+
+    Parameters:
+    -----------
+    questions : list
+        質問のリスト
+    index : VectorStoreIndexWrapper
+        ナレッジインデックス
+    concurrency : int
+        LLMで回答するグループの同時実行数
+    store : bool
+        新しく生成した回答をraiden-cacheに保存するかどうか。グループの回答が揃うたびに保存するので、
+        途中でクライアントが切断しても、回答を始めたグループの分は保存される
+
+    Yields:
+    -------
+    dict
+        {"index": 位置, "question": 質問, "answer": 回答, "from_cache": キャッシュヒットかどうか}
+    """
+    questions = list(questions)
+    if not questions:
+        return
+    start_time = time.time()
+    with priority_lane(PRIORITY_BACKGROUND):
+        embeddings = embedding_model.embed_documents(questions)
+    print(f"バッチ: {len(questions)}件の埋め込み生成 {time.time() - start_time:.3f}秒")
+
+    results = [None] * len(questions)
+    next_position = 0
+
+    def ready():
+        """前から順に揃った結果を返す"""
+        nonlocal next_position
+        while next_position < len(questions) and results[next_position] is not None:
+            yield results[next_position]
+            next_position += 1
+
+    misses = []
+    with ThreadPoolExecutor(max_workers=BATCH_CACHE_WORKERS, thread_name_prefix="raiden-batch-cache") as cache_pool:
+        with priority_lane(PRIORITY_BACKGROUND):
+            lookups = {_submit(cache_pool, check_previous_responses, question, CACHE_INDEX_NAME, embedding): position
+                       for position, (question, embedding) in enumerate(zip(questions, embeddings))}
+        # キャッシュヒットは全ての検索を待たずに、検索が終わったものから入力順に返す
+        while lookups:
+            done, _ = wait(lookups, return_when=FIRST_COMPLETED)
+            for lookup in done:
+                position = lookups.pop(lookup)
+                try:
+                    cached = lookup.result()
+                except Exception as e:
+                    print(f"バッチのキャッシュ検索エラー: {e}")
+                    cached = {"found": False}
+                if cached.get("found"):
+                    results[position] = {"index": position, "question": questions[position],
+                                         "answer": cached["answer"], "from_cache": True}
+                else:
+                    misses.append(position)
+            yield from ready()
+    misses.sort()
+
+    groups = [[misses[i] for i in group]
+              for group in group_similar_questions([embeddings[position] for position in misses])]
+    print(f"バッチ: キャッシュヒット {len(questions) - len(misses)}件, "
+          f"未回答 {len(misses)}件を{len(groups)}グループで生成 ({time.time() - start_time:.3f}秒)")
+
+    on_answered = _response_storer(questions, embeddings) if store else None
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="raiden-batch") as llm_pool:
+        pending = {_submit(llm_pool, _answer_group, questions, group, embeddings, index, on_answered): group
+                   for group in groups}
+        while True:
+            yield from ready()
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = pending.pop(future)
+                try:
+                    answers = future.result()
+                except Exception as e:
+                    print(f"バッチの回答生成エラー: {e}")
+                    answers = {position: CHAT_ERROR_MESSAGE for position in group}
+                for position in group:
+                    results[position] = {"index": position, "question": questions[position],
+                                         "answer": answers[position], "from_cache": False}
+
+    print(f"バッチ: {len(questions)}件の回答完了 {time.time() - start_time:.3f}秒")
+
+class BatchRequest(BaseModel):
+    questions: List[str]
+    concurrency: Optional[int] = None
+    store: bool = True
+
+router = APIRouter()
+
+def _check_batch_token(token):
+    if not BATCH_TOKEN or not token or not hmac.compare_digest(token, BATCH_TOKEN):
+        raise HTTPException(status_code=403, detail="バッチAPIのトークンが正しくありません")
+
+@router.post("/api/batch")
+def batch_endpoint(request: BatchRequest, x_raiden_batch_token: Optional[str] = Header(None)):
+    """質問のリストを受け取り、回答をNDJSONで逐次返す"""
+    _check_batch_token(x_raiden_batch_token)
+    questions = [question.strip() for question in request.questions]
+    if not questions or any(not question for question in questions):
+        raise HTTPException(status_code=400, detail="空の質問が含まれています")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"質問は{BATCH_MAX_QUESTIONS}件までです")
+    concurrency = min(max(1, request.concurrency or BATCH_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+    index = get_index()
+
+    def stream():
+        for result in answer_batch(questions, index, concurrency, request.store):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -0,0 +1,174 @@
+"""
+raiden-cacheの内容をローカルのスナップショットに書き出し・読み込みするモジュール
+
+スナップショットはディレクトリで、次のファイルからなる:
+    vectors.npy        埋め込み行列（float32, 正規化済み）。np.loadでメモリマップして読み込める
+    records.jsonl.gz   ベクトルごとのIDとメタデータ（行番号がvectors.npyの行に対応）
+    manifest.json      件数・次元数・元インデックス名など
+
+使い方:
+    python -m raiden.cache_snapshot export snapshots/raiden-cache
+    python -m raiden.cache_snapshot import snapshots/raiden-cache --index raiden-cache-new
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pinecone import Pinecone
+
+from raiden.chatbot_utils import (
+    PINECONE_API_KEY,
+    CACHE_INDEX_NAME,
+    UPSERT_BATCH_SIZE,
+    iter_index_vectors,
+    upsert_vectors_in_batches,
+)
+from raiden.local_cache import LocalAnswerCache
+
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.jsonl.gz"
+MANIFEST_FILE = "manifest.json"
+
+# 行列をコピーするときのチャンク行数
+COPY_CHUNK_ROWS = 65536
+
+def export_snapshot(path, index_name=CACHE_INDEX_NAME):
+    """
+    インデックスの全ベクトルとメタデータをスナップショットに書き出す。
+    ベクトルは一時ファイルに追記しながら取得するので、件数が多くてもメモリに全件を載せない。
+
+    Returns:
+    --------
+    dict
+        書き出したスナップショットのマニフェスト
+    """
+    os.makedirs(path, exist_ok=True)
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    index = pc.Index(index_name)
+
+    start_time = time.time()
+    raw_path = os.path.join(path, VECTORS_FILE + ".tmp")
+    count = 0
+    dimension = None
+    with open(raw_path, 'wb') as raw_file, gzip.open(os.path.join(path, RECORDS_FILE), 'wt', encoding='utf-8') as records:
+        for vector_id, values, metadata in iter_index_vectors(index):
+            vector = np.asarray(values, dtype=np.float32)
+            if dimension is None:
+                dimension = len(vector)
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+            raw_file.write(vector.tobytes())
+            records.write(json.dumps({"id": vector_id, "metadata": metadata}, ensure_ascii=False) + "\n")
+            count += 1
+            if count % 10000 == 0:
+                print(f"書き出し中: {count}件")
+
+    # 一時ファイルを.npy形式に変換（チャンクごとにコピーしてメモリ使用量を抑える）
+    dimension = dimension or 0
+    vectors_path = os.path.join(path, VECTORS_FILE)
+    output = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=(count, dimension))
+    if count:
+        raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(count, dimension))
+        for start in range(0, count, COPY_CHUNK_ROWS):
+            output[start:start + COPY_CHUNK_ROWS] = raw[start:start + COPY_CHUNK_ROWS]
+        del raw
+    output.flush()
+    del output
+    os.remove(raw_path)
+
+    manifest = {
+        "index_name": index_name,
+        "count": count,
+        "dimension": dimension,
+        "dtype": "float32",
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(os.path.join(path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    print(f"スナップショットを書き出しました: {path} ({count}件, {time.time() - start_time:.1f}秒)")
+    return manifest
+
+def load_snapshot(path, mmap=True):
+    """
+    スナップショットを読み込む
+
+    Parameters:
+    -----------
+    path : str
+        スナップショットのディレクトリ
+    mmap : bool
+        Trueなら埋め込み行列をコピーせずメモリマップで読み込む
+
+    Returns:
+    --------
+    tuple
+        (IDのリスト, 埋め込み行列, メタデータのリスト)
+    """
+    vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r' if mmap else None)
+    ids = []
+    metadata = []
+    with gzip.open(os.path.join(path, RECORDS_FILE), 'rt', encoding='utf-8') as records:
+        for line in records:
+            record = json.loads(line)
+            ids.append(record["id"])
+            metadata.append(record["metadata"])
+    if len(ids) != vectors.shape[0]:
+        raise ValueError(f"スナップショットが壊れています: ID {len(ids)}件, ベクトル {vectors.shape[0]}件")
+    return ids, vectors, metadata
+
+def load_local_cache(path):
+    """スナップショットからプロセス内キャッシュを作る"""
+    start_time = time.time()
+    ids, vectors, metadata = load_snapshot(path, mmap=True)
+    cache = LocalAnswerCache(ids, vectors, metadata)
+    print(f"ローカルキャッシュを読み込みました: {len(cache)}件 ({time.time() - start_time:.2f}秒)")
+    return cache
+
+def import_snapshot(path, index_name, batch_size=UPSERT_BATCH_SIZE, workers=4):
+    """
+    スナップショットをインデックスに一括アップサートする
+
+    Returns:
+    --------
+    int
+        アップサートしたベクトル数
+    """
+    ids, vectors, metadata = load_snapshot(path, mmap=True)
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    index = pc.Index(index_name)
+
+    def upsert_range(start):
+        end = min(start + batch_size, len(ids))
+        batch = [
+            {"id": ids[i], "values": vectors[i].tolist(), "metadata": metadata[i]}
+            for i in range(start, end)
+        ]
+        return upsert_vectors_in_batches(index, batch, batch_size)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        upserted = sum(executor.map(upsert_range, range(0, len(ids), batch_size)))
+    print(f"スナップショットをアップサートしました: {upserted}件 → {index_name} ({time.time() - start_time:.1f}秒)")
+    return upserted
+
+def main():
+    parser = argparse.ArgumentParser(description="回答キャッシュのスナップショットを書き出し・読み込みします")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="スナップショットのディレクトリ")
+    parser.add_argument("--index", default=CACHE_INDEX_NAME, help="対象インデックス名")
+    parser.add_argument("--batch-size", type=int, default=UPSERT_BATCH_SIZE, help="アップサートのバッチサイズ")
+    parser.add_argument("--workers", type=int, default=4, help="並列にアップサートする数")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.path, args.index)
+    else:
+        import_snapshot(args.path, args.index, args.batch_size, args.workers)
+
+if __name__ == "__main__":
+    main()
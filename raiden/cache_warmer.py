@@ -0,0 +1,267 @@
+"""
+よくある質問の回答を事前生成してraiden-cacheを温めるバッチ処理
+質問リストをchatbot_engine.chatで並列に回答し、埋め込みとアップサートをまとめて保存する
+
+使い方:
+    python -m raiden.cache_warmer questions.txt --workers 4 --report warm_report.json
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_community.callbacks import get_openai_callback
+from langchain_community.chat_message_histories import ChatMessageHistory
+
+from raiden.chatbot_engine import chat, get_index, build_answer_prompt, CHAT_ERROR_MESSAGE
+from raiden.chatbot_utils import (
+    embedding_model,
+    check_previous_responses,
+    store_responses_in_pinecone,
+    CACHE_INDEX_NAME,
+    UPSERT_BATCH_SIZE,
+)
+from raiden.openai_client import (
+    priority_lane,
+    is_rate_limit_error,
+    backoff_delay,
+    get_rate_limit_stats,
+    PRIORITY_BACKGROUND,
+)
+
+# text-embedding-3-smallの料金（USD / 1Kトークン）
+EMBEDDING_COST_PER_1K_TOKENS = 0.00002
+
+# 回答生成の再試行回数（API呼び出し単位の429リトライはopenai_client側で行う）
+MAX_RETRIES = 3
+
+# 何件の新規回答ごとにPineconeへ書き込むか（途中で止まっても生成済みの回答を失わないため）
+FLUSH_EVERY = 20
+
+def load_questions(path):
+    """
+    質問リストを読み込む。JSON配列または1行1質問のテキストファイルに対応。
+    空行と重複は除外し、元の順序を保つ。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    if path.endswith('.json'):
+        questions = json.loads(content)
+    else:
+        questions = content.splitlines()
+
+    seen = set()
+    unique_questions = []
+    for question in questions:
+        question = question.strip()
+        if question and question not in seen:
+            seen.add(question)
+            unique_questions.append(question)
+    return unique_questions
+
+def estimate_embedding_cost(texts):
+    """埋め込みコストの概算（日本語は概ね1文字1トークン以下なので文字数で見積もる）"""
+    tokens = sum(len(text) for text in texts)
+    return tokens / 1000 * EMBEDDING_COST_PER_1K_TOKENS
+
+def answer_question(question, index):
+    """
+    1つの質問をエージェントで回答する。レート制限や一時的な失敗はバックオフして再試行する。
+    対話リクエストを妨げないよう、OpenAI呼び出しはバックグラウンドレーンで行う。
+
+    Returns:
+    --------
+    dict
+        {"answer": 回答 or None, "cost": USD, "tokens": トークン数, "attempts": 試行回数, "error": エラー内容}
+    """
+    total_cost = 0.0
+    total_tokens = 0
+    last_error = None
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            with priority_lane(PRIORITY_BACKGROUND), get_openai_callback() as cb:
+                answer = chat(build_answer_prompt(question), ChatMessageHistory(), index)
+            total_cost += cb.total_cost
+            total_tokens += cb.total_tokens
+
+            # chat()は例外を握りつぶして定型文を返すので、その場合は失敗として再試行
+            if answer and answer != CHAT_ERROR_MESSAGE:
+                return {"answer": answer, "cost": total_cost, "tokens": total_tokens,
+                        "attempts": attempt + 1, "error": None}
+            last_error = "chat() returned error message"
+        except Exception as e:
+            last_error = str(e)
+            if not is_rate_limit_error(e):
+                break
+
+        delay = backoff_delay(attempt)
+        print(f"回答生成をリトライします ({attempt + 1}/{MAX_RETRIES}, {delay:.1f}秒後): {question}")
+        time.sleep(delay)
+
+    return {"answer": None, "cost": total_cost, "tokens": total_tokens,
+            "attempts": MAX_RETRIES, "error": last_error}
+
+def find_cached(questions, embeddings, index_name=CACHE_INDEX_NAME, workers=4):
+    """
+    埋め込み済みの質問について、キャッシュに閾値以上の回答があるかを並列に確認する
+
+    Returns:
+    --------
+    list
+        questionsと同じ順のcheck_previous_responsesの結果
+    """
+    results = [None] * len(questions)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(check_previous_responses, question, index_name, embedding): i
+            for i, (question, embedding) in enumerate(zip(questions, embeddings))
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+def flush_pairs(pending, index_name, batch_size, report):
+    """生成済みの回答をまとめてPineconeに保存し、レポートを更新する"""
+    if not pending:
+        return
+    pairs = [(item["question"], item["answer"]) for item in pending]
+    embeddings = [item["embedding"] for item in pending]
+
+    # 拡張処理（LLMで拡張する設定の場合）のコストもここで集計する
+    with priority_lane(PRIORITY_BACKGROUND), get_openai_callback() as cb:
+        ids = store_responses_in_pinecone(pairs, index_name, batch_size, question_embeddings=embeddings)
+    report["cost"]["llm_usd"] += cb.total_cost
+    report["cost"]["llm_tokens"] += cb.total_tokens
+
+    for item, cache_id in zip(pending, ids):
+        report["details"][item["position"]].update(status="new", cache_id=cache_id)
+    report["new_entries"] += len(ids)
+
+    # 保存に失敗した分は失敗として記録
+    for item in pending[len(ids):]:
+        report["details"][item["position"]].update(status="failed", error="store failed")
+        report["failed"] += 1
+    pending.clear()
+
+def warm_cache(questions, workers=4, index_name=CACHE_INDEX_NAME, batch_size=UPSERT_BATCH_SIZE,
+               dry_run=False):
+    """
+    質問リストの回答を事前生成してキャッシュに保存する
+
+    Parameters:
+    -----------
+    questions : list
+        事前生成する質問のリスト
+    workers : int
+        同時に実行する回答生成の数
+    index_name : str
+        キャッシュ用インデックス名
+    batch_size : int
+        1回のアップサートで送るベクトル数
+    dry_run : bool
+        Trueならキャッシュ確認のみ行い、回答生成と保存は行わない
+
+    Returns:
+    --------
+    dict
+        ヒット数、新規登録数、失敗数、コストなどのレポート
+    """
+    start_time = time.time()
+    report = {
+        "total": len(questions),
+        "hits": 0,
+        "new_entries": 0,
+        "failed": 0,
+        "cost": {"llm_usd": 0.0, "llm_tokens": 0, "embedding_usd_estimate": 0.0},
+        "details": [{"question": question, "status": "pending"} for question in questions],
+    }
+    if not questions:
+        return report
+
+    # 1. 全質問の埋め込みを1回のバッチ呼び出しで取得
+    with priority_lane(PRIORITY_BACKGROUND):
+        embeddings = embedding_model.embed_documents(questions)
+    report["cost"]["embedding_usd_estimate"] += estimate_embedding_cost(questions)
+
+    # 2. 既に閾値以上でキャッシュされている質問はスキップ
+    cached = find_cached(questions, embeddings, index_name, workers)
+    misses = []
+    for position, (question, embedding, result) in enumerate(zip(questions, embeddings, cached)):
+        if result.get("found"):
+            report["hits"] += 1
+            report["details"][position].update(
+                status="hit", similarity=result["similarity"], cached_question=result["question"]
+            )
+        else:
+            misses.append((position, question, embedding))
+    print(f"キャッシュ確認完了: ヒット {report['hits']}件 / 未登録 {len(misses)}件")
+
+    if dry_run:
+        for position, _, _ in misses:
+            report["details"][position]["status"] = "miss"
+    else:
+        # 3. 未登録の質問を並列数を制限して回答し、一定件数ごとにまとめて保存
+        index = get_index()
+        pending = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(answer_question, question, index): (position, question, embedding)
+                for position, question, embedding in misses
+            }
+            for future in as_completed(futures):
+                position, question, embedding = futures[future]
+                result = future.result()
+                report["cost"]["llm_usd"] += result["cost"]
+                report["cost"]["llm_tokens"] += result["tokens"]
+                report["details"][position]["attempts"] = result["attempts"]
+
+                if result["answer"] is None:
+                    report["failed"] += 1
+                    report["details"][position].update(status="failed", error=result["error"])
+                    continue
+
+                pending.append({"position": position, "question": question,
+                                "answer": result["answer"], "embedding": embedding})
+                if len(pending) >= FLUSH_EVERY:
+                    flush_pairs(pending, index_name, batch_size, report)
+        flush_pairs(pending, index_name, batch_size, report)
+
+    report["elapsed_seconds"] = round(time.time() - start_time, 2)
+    report["cost"]["total_usd"] = report["cost"]["llm_usd"] + report["cost"]["embedding_usd_estimate"]
+    report["rate_limits"] = get_rate_limit_stats()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="よくある質問の回答を事前生成してキャッシュに保存します")
+    parser.add_argument("questions", help="質問リスト（1行1質問のテキスト、またはJSON配列）")
+    parser.add_argument("--workers", type=int, default=4, help="同時に回答生成する数")
+    parser.add_argument("--index", default=CACHE_INDEX_NAME, help="キャッシュ用インデックス名")
+    parser.add_argument("--batch-size", type=int, default=UPSERT_BATCH_SIZE, help="アップサートのバッチサイズ")
+    parser.add_argument("--report", help="レポートを書き出すJSONファイル")
+    parser.add_argument("--dry-run", action="store_true", help="キャッシュ確認のみ行う")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    print(f"{len(questions)}件の質問を読み込みました")
+
+    report = warm_cache(questions, args.workers, args.index, args.batch_size, args.dry_run)
+
+    print("===== キャッシュ事前生成レポート =====")
+    print(f"質問数: {report['total']}")
+    print(f"キャッシュヒット（スキップ）: {report['hits']}")
+    print(f"新規登録: {report['new_entries']}")
+    print(f"失敗: {report['failed']}")
+    print(f"LLMコスト: ${report['cost']['llm_usd']:.4f} ({report['cost']['llm_tokens']} tokens)")
+    print(f"埋め込みコスト（概算）: ${report['cost']['embedding_usd_estimate']:.6f}")
+    print(f"処理時間: {report['elapsed_seconds']}秒")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"レポートを保存しました: {args.report}")
+
+if __name__ == "__main__":
+    main()
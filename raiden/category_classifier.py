@@ -0,0 +1,242 @@
+"""
+質問の埋め込みから正規カテゴリを判定する最近傍重心分類器
+raiden-cacheに保存済みのメタデータからカテゴリごとの重心を学習し、小さなNumPy配列として保存する
+
+使い方:
+    python -m raiden.category_classifier train    # 重心を学習して保存
+    python -m raiden.category_classifier relabel  # 既存ベクトルのカテゴリを正規カテゴリに書き換え
+"""
+
+import argparse
+import os
+import re
+import threading
+
+import numpy as np
+from pinecone import Pinecone
+from dotenv import load_dotenv
+
+from raiden.local_enhancer import CATEGORY_RULES, DEFAULT_CATEGORY
+
+load_dotenv()
+
+PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
+
+# 正規カテゴリ（Pineconeのフィルターに使う値）
+CANONICAL_CATEGORIES = [category for category, _ in CATEGORY_RULES]
+
+# 学習した重心の保存先
+CENTROIDS_PATH = os.getenv("RAIDEN_CATEGORY_CENTROIDS", "category_centroids.npz")
+
+# 重心を作るのに必要な最小サンプル数
+MIN_SAMPLES_PER_CATEGORY = 3
+
+# 1位と2位の類似度の差がこれ以上のときだけカテゴリで絞り込んで検索する
+CATEGORY_FILTER_MIN_MARGIN = 0.05
+
+def canonicalize_category(raw_category):
+    """
+    LLMが返した自由形式のカテゴリ文字列（例: "治療法、診断"）を正規カテゴリに変換する
+
+    Returns:
+    --------
+    str or None
+        最初に現れる正規カテゴリ。該当しなければNone
+    """
+    if not raw_category:
+        return None
+    for token in re.split(r'[、,/・\s]+', str(raw_category)):
+        if token in CANONICAL_CATEGORIES:
+            return token
+    for category in CANONICAL_CATEGORIES:
+        if category in str(raw_category):
+            return category
+    return None
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+class CategoryClassifier:
+    """
+    カテゴリごとの重心（正規化済み）とのコサイン類似度が最大のカテゴリを返す分類器
+
+    Parameters:
+    -----------
+    centroids : np.ndarray
+        (カテゴリ数, 次元数) の重心行列
+    labels : list
+        重心に対応するカテゴリ名
+    relabeled_indexes : list, optional
+        この重心でカテゴリを書き換え済みのインデックス名
+    """
+
+    def __init__(self, centroids, labels, relabeled_indexes=None):
+        self.centroids = _normalize_rows(np.asarray(centroids, dtype=np.float32))
+        self.labels = list(labels)
+        self.relabeled_indexes = list(relabeled_indexes or [])
+
+    @classmethod
+    def train(cls, embeddings, labels, min_samples=MIN_SAMPLES_PER_CATEGORY):
+        """埋め込みとカテゴリのリストから重心を学習する"""
+        embeddings = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        labels = np.asarray(labels)
+        centroid_labels = []
+        centroids = []
+        for category in CANONICAL_CATEGORIES:
+            mask = labels == category
+            if mask.sum() >= min_samples:
+                centroid_labels.append(category)
+                centroids.append(embeddings[mask].mean(axis=0))
+        if not centroids:
+            raise ValueError("重心を作れるカテゴリがありません")
+        return cls(np.vstack(centroids), centroid_labels)
+
+    def save(self, path=CENTROIDS_PATH):
+        np.savez(path, centroids=self.centroids, labels=np.array(self.labels),
+                 relabeled_indexes=np.array(self.relabeled_indexes, dtype=str))
+
+    @classmethod
+    def load(cls, path=CENTROIDS_PATH):
+        data = np.load(path)
+        relabeled = data["relabeled_indexes"].tolist() if "relabeled_indexes" in data.files else []
+        return cls(data["centroids"], data["labels"].tolist(), relabeled)
+
+    def predict(self, embedding):
+        """
+        埋め込みのカテゴリを判定する
+
+        Returns:
+        --------
+        tuple
+            (カテゴリ, 類似度, 2位との類似度の差)
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        scores = self.centroids @ vector
+        order = np.argsort(scores)[::-1]
+        best = order[0]
+        margin = float(scores[best] - scores[order[1]]) if len(order) > 1 else 1.0
+        return self.labels[best], float(scores[best]), margin
+
+_classifier = None
+_classifier_loaded = False
+_classifier_lock = threading.Lock()
+
+def get_classifier():
+    """保存済みの重心があれば分類器を読み込んで返す（1回だけ読み込む）。なければNone"""
+    global _classifier, _classifier_loaded
+    with _classifier_lock:
+        if not _classifier_loaded:
+            _classifier_loaded = True
+            if os.path.exists(CENTROIDS_PATH):
+                try:
+                    _classifier = CategoryClassifier.load(CENTROIDS_PATH)
+                    print(f"カテゴリ重心を読み込みました: {_classifier.labels}")
+                except Exception as e:
+                    print(f"カテゴリ重心の読み込みエラー: {e}")
+        return _classifier
+
+def classify_embedding(embedding, fallback=None):
+    """
+    書き込み時に使うカテゴリ判定。分類器がなければfallbackを正規化して返す（API呼び出しなし）
+    """
+    classifier = get_classifier()
+    if classifier is not None:
+        category, _, _ = classifier.predict(embedding)
+        return category
+    return canonicalize_category(fallback) or DEFAULT_CATEGORY
+
+def category_filter_for(embedding, min_margin=CATEGORY_FILTER_MIN_MARGIN):
+    """検索時の絞り込みカテゴリ。判定に自信がない場合や分類器がない場合はNone"""
+    classifier = get_classifier()
+    if classifier is None:
+        return None
+    category, score, margin = classifier.predict(embedding)
+    if margin < min_margin:
+        return None
+    return category
+
+def is_relabeled(index_name):
+    """
+    読み込んだ重心でインデックスのカテゴリを書き換え済みかどうか
+    （書き換え前は自由形式のカテゴリが残っているので、絞り込み検索で取りこぼすことがある）
+    """
+    classifier = get_classifier()
+    return classifier is not None and index_name in classifier.relabeled_indexes
+
+def train_from_index(index_name, path=CENTROIDS_PATH):
+    """raiden-cacheのメタデータのカテゴリから重心を学習して保存する"""
+    from raiden.chatbot_utils import CACHE_INDEX_NAME, iter_index_vectors
+
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    index = pc.Index(index_name or CACHE_INDEX_NAME)
+
+    embeddings = []
+    labels = []
+    skipped = 0
+    for _, values, metadata in iter_index_vectors(index):
+        category = canonicalize_category(metadata.get("category"))
+        if category is None:
+            skipped += 1
+            continue
+        embeddings.append(values)
+        labels.append(category)
+    print(f"学習データ: {len(labels)}件 (カテゴリ不明でスキップ: {skipped}件)")
+
+    classifier = CategoryClassifier.train(embeddings, labels)
+    classifier.save(path)
+    counts = {category: labels.count(category) for category in classifier.labels}
+    print(f"カテゴリ重心を保存しました: {path} {counts}")
+    return classifier
+
+def relabel_index(index_name, classifier=None, path=None):
+    """
+    既存ベクトルのcategoryを正規カテゴリに書き換える（最初の元の値はcategory_rawに残す）。
+    pathを渡すと、書き換え済みであることを重心のファイルに記録する。
+    """
+    from raiden.chatbot_utils import CACHE_INDEX_NAME, iter_index_vectors
+
+    classifier = classifier or get_classifier()
+    index_name = index_name or CACHE_INDEX_NAME
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    index = pc.Index(index_name)
+
+    updated = 0
+    for vector_id, values, metadata in iter_index_vectors(index):
+        raw_category = metadata.get("category")
+        if classifier is not None:
+            category, _, _ = classifier.predict(values)
+        else:
+            category = canonicalize_category(raw_category) or DEFAULT_CATEGORY
+        if category != raw_category:
+            new_metadata = {"category": category}
+            # 2回目以降の書き換えで、元の値を正規カテゴリで上書きしない
+            if "category_raw" not in metadata:
+                new_metadata["category_raw"] = raw_category or ""
+            index.update(id=vector_id, set_metadata=new_metadata)
+            updated += 1
+    print(f"カテゴリを書き換えました: {updated}件")
+
+    if classifier is not None and path is not None and index_name not in classifier.relabeled_indexes:
+        classifier.relabeled_indexes.append(index_name)
+        classifier.save(path)
+        print(f"書き換え済みとして記録しました: {index_name} → {path}")
+    return updated
+
+def main():
+    parser = argparse.ArgumentParser(description="キャッシュのカテゴリ分類器を学習・適用します")
+    parser.add_argument("command", choices=["train", "relabel"])
+    parser.add_argument("--index", default=None, help="対象インデックス名（デフォルトはraiden-cache）")
+    parser.add_argument("--path", default=CENTROIDS_PATH, help="重心の保存先")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train_from_index(args.index, args.path)
+    else:
+        classifier = CategoryClassifier.load(args.path) if os.path.exists(args.path) else None
+        relabel_index(args.index, classifier, args.path if classifier is not None else None)
+
+if __name__ == "__main__":
+    main()
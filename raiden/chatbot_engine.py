@@ -17,7 +17,10 @@ from langchain.agents import AgentType
 from pinecone import Pinecone
 import time
 
-from raiden.custom import CustomVectorStoreQATool
+from raiden.custom import CustomVectorStoreQATool, tool_result_scope
+from raiden.openai_client import RateLimitedChatOpenAI, RateLimitedOpenAIEmbeddings
+from raiden.deadline import remaining_time, record_degradation
+from raiden.profiling import profiled
 
 # chatbot_utilsからの関数インポート
 from raiden.chatbot_utils import check_previous_responses
@@ -40,12 +43,37 @@ pc = Pinecone(api_key=PINECONE_API_KEY)
 index_name = "raiden"
 
 # グローバル変数の最適化
-llm = ChatOpenAI(model_name="gpt-4", temperature=0,)
+llm = RateLimitedChatOpenAI(model_name="gpt-4", temperature=0,)
 tools = None
 
+# エージェントの最大イテレーション数と、リクエストの残り時間から上限を決めるための目安
+MAX_AGENT_ITERATIONS = 6
+SECONDS_PER_ITERATION = 8  # 1イテレーション（gpt-4呼び出し + ツール実行）にかかる時間の目安
+# 通常の質問はツール呼び出し1〜2回と最終回答で終わるので、残り時間にこれだけのイテレーションが
+# 入らないときだけ上限を下げる（それ以外はmax_execution_timeで打ち切る）
+MIN_UNCAPPED_ITERATIONS = 3
+FINAL_ANSWER_RESERVE_SECONDS = 5  # 打ち切り後の最終回答生成（early_stopping_method="generate"）用
+
+# エージェント実行に失敗したときに返すメッセージ
+CHAT_ERROR_MESSAGE = "申し訳ありません。もう一度質問してください。"
+
+# 新規回答生成時にエージェントへ渡すプロンプト
+ANSWER_PROMPT_TEMPLATE = """
+        1. 専門知識に基づき、質問に関連する情報を要約して回答してください。        
+        2. 回答は日本語で作成し、結論と臨床的な参考事例を含めてください。
+        3. 直接関連する情報がない場合は、最も近い情報を提供し、その旨を明示してください。
+        4. 歯科医療に関する質問（歯牙移植、歯科治療、歯科技工所など）は非常に専門的であるため、必ずベクトル検索ツールを使用してください。自身の知識だけで回答せず、必ずツールを使用してください。
+
+        質問: {message}
+        """
+
+def build_answer_prompt(message: str) -> str:
+    """ユーザーの質問からエージェント用のプロンプトを作成する"""
+    return ANSWER_PROMPT_TEMPLATE.format(message=message)
+
 def create_index() -> VectorStoreIndexWrapper:    
     index = pc.Index(index_name)
-    embedding = OpenAIEmbeddings(model="text-embedding-3-small")
+    embedding = RateLimitedOpenAIEmbeddings(model="text-embedding-3-small")
     
     stats = index.describe_index_stats()
     print(f"Total vectors in index: {stats.total_vector_count}")    
@@ -92,7 +120,17 @@ def create_tools(index: VectorStoreIndexWrapper, llm) ->List[BaseTool]:
     return [qa_tool]
 
 
-def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapper) -> str:
+@profiled(root=True)
+def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapper,
+         search_results=None, callbacks=None, search_embedding=None) -> str:
+    """
+    エージェントで質問に回答する
+
+    search_resultsに事前に取得した検索結果（(Document, score)のリスト）を渡すと、
+    ログ用のPinecone検索を省略する。さらにsearch_embeddingに検索に使った埋め込みを渡すと、
+    ツール入力がその質問と十分似ている場合にツールの検索もこの結果で済ませる。
+    callbacksはエージェント実行時のコールバック。
+    """
     start_time = time.time()
     
     global tools
@@ -105,8 +143,11 @@ def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapp
     
     # ここでPinecone検索の挙動を確認してみる！
     print("\n========== Pinecone Vector Search (Logging) ==========")
-    query_text = message  # ユーザーのメッセージそのまま検索に使う
-    results = index.vectorstore.similarity_search_with_score(query_text, k=15)
+    if search_results is None:
+        query_text = message  # ユーザーのメッセージそのまま検索に使う
+        results = index.vectorstore.similarity_search_with_score(query_text, k=15)
+    else:
+        results = search_results  # 並列に取得済みの検索結果を使う
 
     for i, (doc, score) in enumerate(results):
         print(f"\n--- Result {i+1} ---")
@@ -126,13 +167,26 @@ def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapp
     )
     print(f"Memory setup time: {time.time() - memory_start:.2f}s")
 
+    # リクエストの残り時間に応じてイテレーション数と実行時間の上限を決める
+    max_iterations = MAX_AGENT_ITERATIONS
+    max_execution_time = None
+    remaining = remaining_time()
+    if remaining is not None:
+        max_execution_time = max(1.0, remaining - FINAL_ANSWER_RESERVE_SECONDS)
+        affordable_iterations = int(max_execution_time // SECONDS_PER_ITERATION)
+        if affordable_iterations < MIN_UNCAPPED_ITERATIONS:
+            max_iterations = max(1, affordable_iterations)
+            record_degradation("cap_agent_iterations")
+        print(f"Agent limits: max_iterations={max_iterations}, max_execution_time={max_execution_time:.1f}s")
+
     agent_start = time.time()
     agent_chain = initialize_agent(
         tools,
         llm,
         agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
         memory=memory,
-        max_iterations=6,
+        max_iterations=max_iterations,
+        max_execution_time=max_execution_time,
         early_stopping_method="generate",
         verbose=True
     )
@@ -140,7 +194,14 @@ def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapp
 
     try:
         invoke_start = time.time()
-        result = agent_chain.invoke(input=message)
+        # 同じリクエスト内で同一・類似の質問によるツール呼び出しをまとめる
+        with tool_result_scope() as tool_scope:
+            if search_results and search_embedding is not None:
+                tool_scope.add_prefetched(search_embedding, search_results)
+            result = agent_chain.invoke(input=message, config={"callbacks": callbacks})
+        if tool_scope.hits or tool_scope.prefetch_hits:
+            print(f"Tool calls served from request scope: {tool_scope.hits}, "
+                  f"retrievals served from prefetch: {tool_scope.prefetch_hits}")
         print(f"Agent execution time: {time.time() - invoke_start:.2f}s")
         print(f"Total processing time: {time.time() - start_time:.2f}s")
 
@@ -149,6 +210,6 @@ def chat(message: str, history: ChatMessageHistory, index: VectorStoreIndexWrapp
         return result['output']
     except Exception as e:
         print(f"Error: {e}")
-        return "申し訳ありません。もう一度質問してください。"
+        return CHAT_ERROR_MESSAGE
     
     
\ No newline at end of file
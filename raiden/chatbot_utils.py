@@ -1,4 +1,6 @@
 from uuid import uuid4
+import itertools
+import threading
 import time
 import os
 from dotenv import load_dotenv
@@ -8,18 +10,41 @@ import json
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 from raiden.text_normalizer import basic_normalize_text
+from raiden.openai_client import RateLimitedChatOpenAI, RateLimitedOpenAIEmbeddings
+from raiden.llm_cache import cached_llm_call, LLMResponseCache
+from raiden.local_enhancer import enhance_locally, seed_keyword_corpus, CORPUS_MAX_DOCUMENTS
+from raiden.category_classifier import classify_embedding, category_filter_for, is_relabeled
+from raiden.deadline import time_allows, record_degradation, DeadlineExceeded
+from raiden.profiling import profiled
 
 # 環境変数のロード
 load_dotenv()
 
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
-embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
-enhancement_llm = ChatOpenAI(model_name="gpt-4-turbo", temperature=0)
+embedding_model = RateLimitedOpenAIEmbeddings(model="text-embedding-3-small")
+enhancement_llm = RateLimitedChatOpenAI(model_name="gpt-4-turbo", temperature=0)
 
 CACHE_INDEX_NAME = "raiden-cache"
 
 SIMILARITY_THRESHOLD = 0.8  # 希望通りに0.85に設定
 
+UPSERT_BATCH_SIZE = 100  # 1回のアップサートで送るベクトル数
+
+# プロセス内キャッシュとして読み込むスナップショット（raiden.cache_snapshotで書き出したもの）
+LOCAL_CACHE_SNAPSHOT = os.getenv("RAIDEN_LOCAL_CACHE_SNAPSHOT")
+
+# 親レコードのメタデータのキャッシュ（保存済みの回答は書き換えないので長めに保持する）
+response_metadata_cache = LLMResponseCache(max_entries=1024, ttl_seconds=60 * 60)
+
+# Q&Aの拡張方法
+#   local: ローカル抽出のみ（APIを呼ばない。デフォルト）
+#   llm:   保存のたびにgpt-4-turboで拡張する
+#   batch: 対話中の保存はローカル抽出、一括保存時は複数ペアをまとめてgpt-4-turboで拡張する
+ENHANCEMENT_MODE = os.getenv("RAIDEN_ENHANCEMENT_MODE", "local")
+ENHANCEMENT_BATCH_SIZE = 5  # 1回のLLM呼び出しで拡張するQ&Aペア数
+ENHANCEMENT_MIN_SECONDS = 10  # LLMで拡張するのに必要なリクエストの残り時間（秒）
+
+@profiled()
 def enhance_with_ai(question, answer):
     """
     質問と回答にAIを使って類義語や要約を追加する
@@ -48,6 +73,7 @@ def enhance_with_ai(question, answer):
 2. 回答の要約 (50文字以内)
 3. 質問のキーワード (5つまで)
 4. 回答のカテゴリ（例: 治療法、診断、予防、症状、技術、材料）
+5. 同じ意味の質問の言い換え (3つ)
 
 質問: {question}
 
@@ -58,18 +84,21 @@ def enhance_with_ai(question, answer):
   "question_summary": "質問の要約",
   "answer_summary": "回答の要約",
   "keywords": ["キーワード1", "キーワード2", "キーワード3", "キーワード4", "キーワード5"],
-  "category": "カテゴリ"
+  "category": "カテゴリ",
+  "alternative_questions": ["言い換え1", "言い換え2", "言い換え3"]
 }}
 
 出力はJSON形式のみにしてください。説明などは不要です。
 類義語はできるだけ多様にしてください。例えば「自家歯牙移植のメリットは?」と「自家歯の移植の利点は?」のように異なる言い回しや言葉を使ってください。
         """
         
-        # LLMに処理を依頼
-        response = enhancement_llm.invoke(prompt)
+        # LLMに処理を依頼（同じ質問・回答ならキャッシュ済みの応答を使う）
+        content = cached_llm_call(
+            enhancement_llm, prompt, lambda: enhancement_llm.invoke(prompt).content
+        )
         
         # 応答をパースしてJSONに変換
-        enhanced_data = json.loads(response.content)
+        enhanced_data = json.loads(content)
         
         print(f"AI拡張結果:")
         print(f"  要約: {enhanced_data.get('question_summary', 'なし')}")
@@ -81,16 +110,326 @@ def enhance_with_ai(question, answer):
         return enhanced_data
     except Exception as e:
         print(f"AI拡張処理エラー: {e}")
-        # エラー時はデフォルト値を返す
-        return {
-            "question_summary": question[:30] + "..." if len(question) > 30 else question,
-            "answer_summary": answer[:50] + "..." if len(answer) > 50 else answer,
-            "alternative_questions": [],
-            "keywords": [],
-            "category": "未分類"
-        }
+        # エラー時はローカル抽出の結果を返す
+        return enhance_locally(question, answer)
+
+@profiled()
+def enhance_batch_with_ai(pairs, batch_size=ENHANCEMENT_BATCH_SIZE):
+    """
+    複数のQ&Aペアをまとめて1回のLLM呼び出しで拡張する（一括保存用）
+    
+    Parameters:
+    -----------
+    pairs : list
+        (質問, 回答) のリスト
+    batch_size : int
+        1回のLLM呼び出しで拡張するペア数
+    
+    Returns:
+    --------
+    list
+        pairsと同じ順の拡張情報の辞書。失敗したペアはローカル抽出の結果
+    """
+    results = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        items = "\n\n".join(
+            f"[{i}]\n質問: {question}\n回答: {answer}" for i, (question, answer) in enumerate(batch)
+        )
+        prompt = f"""
+以下の歯科医療に関する質問と回答のペア（{len(batch)}件）それぞれに対して、次の拡張情報を生成してください:
+
+1. 質問の要約 (30文字以内)
+2. 回答の要約 (50文字以内)
+3. 質問のキーワード (5つまで)
+4. 回答のカテゴリ（例: 治療法、診断、予防、症状、技術、材料）
+5. 同じ意味の質問の言い換え (3つ)
+
+{items}
+
+出力はペアの番号順に並べたJSON配列で返してください:
+[
+  {{
+    "question_summary": "質問の要約",
+    "answer_summary": "回答の要約",
+    "keywords": ["キーワード1", "キーワード2"],
+    "category": "カテゴリ",
+    "alternative_questions": ["言い換え1", "言い換え2", "言い換え3"]
+  }}
+]
+
+出力はJSON形式のみにしてください。説明などは不要です。
+        """
+        try:
+            content = cached_llm_call(
+                enhancement_llm, prompt, lambda: enhancement_llm.invoke(prompt).content
+            )
+            enhanced_list = json.loads(content)
+            if not isinstance(enhanced_list, list) or len(enhanced_list) != len(batch):
+                raise ValueError(f"件数が一致しません: {len(batch)}件中 {len(enhanced_list)}件")
+            results.extend(enhanced_list)
+            print(f"AI一括拡張完了: {len(batch)}件")
+        except Exception as e:
+            print(f"AI一括拡張処理エラー: {e}")
+            results.extend(enhance_locally(question, answer) for question, answer in batch)
+    return results
+
+@profiled()
+def enhance_qa(question, answer):
+    """
+    設定（ENHANCEMENT_MODE）に応じてQ&Aペアを拡張する。
+    llmモード以外ではAPIを呼ばずにローカルで要約・キーワード・カテゴリを作る。
+    llmモードでもリクエストの残り時間が足りなければローカル抽出に切り替える。
+    """
+    if ENHANCEMENT_MODE == "llm":
+        if time_allows(ENHANCEMENT_MIN_SECONDS):
+            return enhance_with_ai(question, answer)
+        record_degradation("skip_enhancement")
+    start_keyword_corpus_seeding()
+    return enhance_locally(question, answer)
+
+def connect_cache_index(pc, index_name=CACHE_INDEX_NAME):
+    """
+    キャッシュ用インデックスに接続する。存在しない場合は'raiden'インデックスを代替として使う。
+    
+    Parameters:
+    -----------
+    pc : Pinecone
+        Pineconeクライアント
+    index_name : str
+        接続するインデックス名
+    
+    Returns:
+    --------
+    tuple
+        (インデックス, 実際に接続したインデックス名)。接続できなければ (None, index_name)
+    """
+    try:
+        pinecone_index = pc.Index(index_name)
+        print(f"インデックス {index_name} に接続しました")
+        return pinecone_index, index_name
+    except Exception as e:
+        print(f"インデックス {index_name} が見つかりません: {e}")
+    
+    # インデックスが存在するか確認
+    indexes = pc.list_indexes()
+    print(f"利用可能なインデックス: {indexes}")
+    if not indexes or index_name not in [idx.name for idx in indexes]:
+        print(f"インデックス {index_name} が存在しません。作成してください。")
+        # 代替としてraidenインデックスを使用
+        print(f"代替として 'raiden' インデックスを使用します")
+        index_name = "raiden"
+        try:
+            return pc.Index(index_name), index_name
+        except Exception as e:
+            print(f"代替インデックスへの接続も失敗: {e}")
+            return None, index_name
+    try:
+        return pc.Index(index_name), index_name
+    except Exception as e:
+        print(f"インデックス接続エラー: {e}")
+        return None, index_name
+
+_local_cache = None
+_local_cache_loaded = False
+
+def get_local_cache():
+    """スナップショットが設定されていればプロセス内キャッシュを読み込んで返す（1回だけ）。なければNone"""
+    global _local_cache, _local_cache_loaded
+    if not _local_cache_loaded:
+        _local_cache_loaded = True
+        if LOCAL_CACHE_SNAPSHOT:
+            try:
+                from raiden.cache_snapshot import load_local_cache
+                _local_cache = load_local_cache(LOCAL_CACHE_SNAPSHOT)
+            except Exception as e:
+                print(f"ローカルキャッシュの読み込みエラー: {e}")
+    return _local_cache
+
+def add_to_local_cache(vectors):
+    """新しく保存したベクトルをプロセス内キャッシュにも追加する"""
+    local_cache = get_local_cache()
+    if local_cache is None:
+        return
+    for vector in vectors:
+        local_cache.add(vector["id"], vector["values"], vector["metadata"])
+
+@profiled()
+def search_local_cache(query_embedding):
+    """
+    プロセス内キャッシュから閾値を超える類似質問を探す。見つからなければNone
+    """
+    local_cache = get_local_cache()
+    if local_cache is None:
+        return None
+    matches = local_cache.search(query_embedding, top_k=1)
+    if not matches or matches[0][1] <= SIMILARITY_THRESHOLD:
+        return None
+    vector_id, score = matches[0]
+    metadata = local_cache.get_metadata(vector_id)
+    if not metadata or "question" not in metadata:
+        return None
+    print(f"ローカルキャッシュでヒット: {vector_id} (スコア: {score})")
+    return {
+        "found": True,
+        "question": metadata["question"],
+        "answer": metadata["text"],
+        "similarity": score,
+        "timestamp": metadata.get("timestamp", "不明"),
+        "category": metadata.get("category", "未分類"),
+        "summary": metadata.get("answer_summary", "")
+    }
+
+def parent_id_of(vector_id):
+    """類義語ベクトル（{親ID}-alt-{番号}）のIDから親レコードのIDを返す"""
+    return vector_id.split("-alt-")[0]
+
+@profiled()
+def fetch_response_metadata(vector_id, index=None, index_name=CACHE_INDEX_NAME):
+    """
+    マッチしたベクトルの親レコードから質問・回答などのメタデータを取得する
+    
+    Parameters:
+    -----------
+    vector_id : str
+        マッチしたベクトルのID（親レコードでも類義語ベクトルでもよい）
+    index : pinecone.Index, optional
+        接続済みのインデックス（Noneならindex_nameに接続する）
+    index_name : str
+        インデックス名
+    
+    Returns:
+    --------
+    dict or None
+        親レコードのメタデータ。見つからなければNone
+    """
+    parent_id = parent_id_of(vector_id)
+    cached = response_metadata_cache.get(parent_id)
+    if cached is not None:
+        return cached
+    
+    if index is None:
+        index = Pinecone(api_key=PINECONE_API_KEY).Index(index_name)
+    response = index.fetch(ids=[parent_id])
+    vector = response.vectors.get(parent_id)
+    if vector is None or not vector.metadata:
+        return None
+    
+    metadata = dict(vector.metadata)
+    response_metadata_cache.set(parent_id, metadata)
+    return metadata
+
+def build_response_metadata(question, answer, enhanced_data):
+    """
+    Q&Aペアと拡張情報からPineconeに保存するメタデータを作成する
+    """
+    return {
+        "text": answer,  # 検索用にtextフィールドに回答を保存
+        "question": question,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "type": "chatbot_response",
+        "question_summary": enhanced_data.get("question_summary", ""),
+        "answer_summary": enhanced_data.get("answer_summary", ""),
+        "alternative_questions": enhanced_data.get("alternative_questions", []),
+        "keywords": enhanced_data.get("keywords", []),
+        "category": enhanced_data.get("category", "未分類")
+    }
+
+def valid_alternative_questions(enhanced_data):
+    """短すぎる類義語を除外した (番号, 類義語) のリストを返す"""
+    alt_questions = enhanced_data.get("alternative_questions", []) or []
+    valid = []
+    for i, alt_question in enumerate(alt_questions):
+        if alt_question and len(alt_question) > 5:  # 短すぎる類義語は除外
+            valid.append((i, alt_question))
+        else:
+            print(f"類義語 {i+1}: '{alt_question}' - 短すぎるためスキップ")
+    return valid
+
+def upsert_vectors_in_batches(pinecone_index, vectors, batch_size=UPSERT_BATCH_SIZE):
+    """
+    ベクトルをbatch_size件ずつまとめてアップサートする
+    
+    Returns:
+    --------
+    int
+        アップサートしたベクトル数
+    """
+    upserted = 0
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start:start + batch_size]
+        pinecone_index.upsert(vectors=batch)
+        upserted += len(batch)
+    return upserted
+
+def build_response_vectors(question, answer, question_embedding, enhanced_data, alt_embeddings=None):
+    """
+    1つのQ&Aペアについて、オリジナル質問と類義語のアップサート用ベクトルを作成する
+    
+    Parameters:
+    -----------
+    question : str
+        ユーザーからの質問
+    answer : str
+        チャットボットの回答
+    question_embedding : list
+        質問の埋め込みベクトル
+    enhanced_data : dict
+        AI拡張情報
+    alt_embeddings : list, optional
+        valid_alternative_questions() の順に対応する類義語の埋め込みベクトル
+    
+    Returns:
+    --------
+    tuple
+        (一意のID, アップサート用ベクトルのリスト)
+    """
+    # Q&Aペア用の一意のIDを作成
+    unique_id = str(uuid4())
+    metadata = build_response_metadata(question, answer, enhanced_data)
+    # 質問の埋め込みから正規カテゴリを判定（API呼び出しなし）。フィルター検索に使う
+    metadata["category"] = classify_embedding(question_embedding, metadata["category"])
+    # 回答本文などは親レコード（オリジナル質問のベクトル）にだけ持たせ、
+    # 類義語ベクトルには親IDと絞り込み用の項目だけを持たせる
+    child_metadata = {
+        "type": metadata["type"],
+        "category": metadata["category"],
+        "parent_id": unique_id,
+    }
+    vectors = [{"id": unique_id, "values": question_embedding, "metadata": metadata}]
+    
+    alt_questions = valid_alternative_questions(enhanced_data)
+    if alt_questions and alt_embeddings:
+        # 元の質問と類義語の類似度の計算と出力
+        original_embedding = np.array(question_embedding).reshape(1, -1)
+        similarities = cosine_similarity(original_embedding, np.array(alt_embeddings))[0]
+        print(f"===== 類義語の類似度分析 =====")
+        for (i, alt_question), alt_embedding, similarity in zip(alt_questions, alt_embeddings, similarities):
+            print(f"類義語 {i+1}: '{alt_question}'")
+            print(f"  元の質問との類似度: {similarity:.4f}")
+            vectors.append({
+                "id": f"{unique_id}-alt-{i}",
+                "values": alt_embedding,
+                "metadata": child_metadata  # 回答本文は親レコードから取得する
+            })
+    return unique_id, vectors
+
+def embed_alternative_questions(texts):
+    """
+    類義語の埋め込みをまとめて取得する。時間の予算が尽きた場合は類義語を諦めて空のリストを返す
+    （類義語がなくても元の質問と回答は保存する）
+    """
+    if not texts:
+        return []
+    try:
+        return embedding_model.embed_documents(texts)
+    except DeadlineExceeded as e:
+        print(f"類義語の埋め込みを省略します: {e}")
+        record_degradation("skip_alternative_questions")
+        return []
 
-def store_response_in_pinecone(question, answer, index_name=CACHE_INDEX_NAME):
+@profiled()
+def store_response_in_pinecone(question, answer, index_name=CACHE_INDEX_NAME, question_embedding=None):
     """
     質問と回答のペアをPineconeに保存する関数。AIで拡張した情報も保存。
     
@@ -102,6 +441,8 @@ def store_response_in_pinecone(question, answer, index_name=CACHE_INDEX_NAME):
         チャットボットの回答
     index_name : str
         Pineconeのインデックス名（デフォルトは"raiden-cache"）
+    question_embedding : list, optional
+        計算済みの質問埋め込み（Noneなら取得する）
     
     Returns:
     --------
@@ -112,102 +453,32 @@ def store_response_in_pinecone(question, answer, index_name=CACHE_INDEX_NAME):
         # Pineconeの初期化
         pc = Pinecone(api_key=PINECONE_API_KEY)
         
-        # インデックスが存在するか確認し、なければ作成を試みる
-        try:
-            pinecone_index = pc.Index(index_name)
-            print(f"インデックス {index_name} に接続しました")
-        except Exception as e:
-            print(f"インデックス {index_name} が見つかりません: {e}")
-            # インデックスが存在するか確認
-            indexes = pc.list_indexes()
-            print(f"利用可能なインデックス: {indexes}")
-            if not indexes or index_name not in [idx.name for idx in indexes]:
-                print(f"インデックス {index_name} が存在しません。作成してください。")
-                # 代替としてraidenインデックスを使用
-                print(f"代替として 'raiden' インデックスを使用します")
-                index_name = "raiden"
-                try:
-                    pinecone_index = pc.Index(index_name)
-                except Exception as e:
-                    print(f"代替インデックスへの接続も失敗: {e}")
-                    return False
-            else:
-                try:
-                    pinecone_index = pc.Index(index_name)
-                except Exception as e:
-                    print(f"インデックス接続エラー: {e}")
-                    return False
-        
-        # AI拡張情報を取得
-        enhanced_data = enhance_with_ai(question, answer)
+        # インデックスが存在するか確認し、なければ代替インデックスに接続
+        pinecone_index, index_name = connect_cache_index(pc, index_name)
+        if pinecone_index is None:
+            return False
         
-        # Q&Aペア用の一意のIDを作成
-        unique_id = str(uuid4())
+        # 拡張情報を取得
+        enhanced_data = enhance_qa(question, answer)
         
         # 質問の埋め込みを取得
-        question_embedding = embedding_model.embed_query(question)
+        if question_embedding is None:
+            question_embedding = embedding_model.embed_query(question)
         print(f"質問の埋め込みベクトル生成完了 (長さ: {len(question_embedding)})")
         
-        # 質問と回答を含むメタデータを準備
-        metadata = {
-            "text": answer,  # 検索用にtextフィールドに回答を保存
-            "question": question,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "type": "chatbot_response",
-            "question_summary": enhanced_data.get("question_summary", ""),
-            "answer_summary": enhanced_data.get("answer_summary", ""),
-            "alternative_questions": enhanced_data.get("alternative_questions", []),
-            "keywords": enhanced_data.get("keywords", []),
-            "category": enhanced_data.get("category", "未分類")
-        }
+        # 類義語の埋め込みはまとめて1回で取得
+        alt_questions = valid_alternative_questions(enhanced_data)
+        print(f"類義語の数: {len(alt_questions)}")
+        alt_embeddings = embed_alternative_questions([q for _, q in alt_questions])
         
-        # ベクトルをPineconeにアップサート
-        pinecone_index.upsert(
-            vectors=[
-                {
-                    "id": unique_id,
-                    "values": question_embedding,
-                    "metadata": metadata
-                }
-            ]
+        unique_id, vectors = build_response_vectors(
+            question, answer, question_embedding, enhanced_data, alt_embeddings
         )
-        print(f"オリジナル質問ベクトルをアップサート: {unique_id}")
-        
-        # 類義語のインデックスも追加
-        alt_questions = enhanced_data.get("alternative_questions", [])
-        print(f"類義語の数: {len(alt_questions)}")
         
-        # 元の質問と類義語の類似度の計算と出力
-        if alt_questions:
-            original_embedding = np.array(question_embedding).reshape(1, -1)
-            print(f"===== 類義語の類似度分析 =====")
-            
-            for i, alt_question in enumerate(alt_questions):
-                if alt_question and len(alt_question) > 5:  # 短すぎる類義語は除外
-                    print(f"類義語 {i+1}: '{alt_question}'")
-                    
-                    # 類義語の埋め込みベクトルを取得
-                    alt_embedding = embedding_model.embed_query(alt_question)
-                    alt_embedding_array = np.array(alt_embedding).reshape(1, -1)
-                    
-                    # 元の質問との類似度を計算
-                    similarity = cosine_similarity(original_embedding, alt_embedding_array)[0][0]
-                    print(f"  元の質問との類似度: {similarity:.4f}")
-                    
-                    # 類義語をアップサート
-                    alt_id = f"{unique_id}-alt-{i}"
-                    pinecone_index.upsert(
-                        vectors=[
-                            {
-                                "id": alt_id,
-                                "values": alt_embedding,
-                                "metadata": metadata  # 同じメタデータを使用
-                            }
-                        ]
-                    )
-                    print(f"  類義語ベクトルをアップサート: {alt_id}")
-                else:
-                    print(f"類義語 {i+1}: '{alt_question}' - 短すぎるためスキップ")
+        # オリジナル質問と類義語のベクトルをまとめてアップサート
+        upserted = upsert_vectors_in_batches(pinecone_index, vectors)
+        add_to_local_cache(vectors)
+        print(f"ベクトルをアップサート: {unique_id} ({upserted}件)")
         
         print(f"拡張Q&AをIDで保存しました: {unique_id} (インデックス: {index_name})")
         return True
@@ -217,7 +488,154 @@ def store_response_in_pinecone(question, answer, index_name=CACHE_INDEX_NAME):
         traceback.print_exc()
         return False
 
-def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
+@profiled()
+def store_responses_in_pinecone(pairs, index_name=CACHE_INDEX_NAME, batch_size=UPSERT_BATCH_SIZE,
+                                question_embeddings=None):
+    """
+    複数のQ&Aペアをまとめて保存する。埋め込みは質問・類義語それぞれ1回のバッチ呼び出しで取得し、
+    アップサートもbatch_size件ずつまとめて行う。
+    
+    Parameters:
+    -----------
+    pairs : list
+        (質問, 回答) のリスト
+    index_name : str
+        Pineconeのインデックス名（デフォルトは"raiden-cache"）
+    batch_size : int
+        1回のアップサートで送るベクトル数
+    question_embeddings : list, optional
+        計算済みの質問埋め込み（pairsと同じ順）。Noneならまとめて取得する
+    
+    Returns:
+    --------
+    list
+        保存したQ&AペアのID（pairsと同じ順）。失敗した場合は空のリスト
+    """
+    if not pairs:
+        return []
+    try:
+        pc = Pinecone(api_key=PINECONE_API_KEY)
+        pinecone_index, index_name = connect_cache_index(pc, index_name)
+        if pinecone_index is None:
+            return []
+        
+        if ENHANCEMENT_MODE in ("llm", "batch"):
+            enhanced_list = enhance_batch_with_ai(pairs)
+        else:
+            start_keyword_corpus_seeding()
+            enhanced_list = [enhance_locally(question, answer) for question, answer in pairs]
+        if question_embeddings is None:
+            question_embeddings = embedding_model.embed_documents([question for question, _ in pairs])
+        
+        # 全ペアの類義語を1回の埋め込み呼び出しで処理
+        alt_lists = [valid_alternative_questions(enhanced_data) for enhanced_data in enhanced_list]
+        flat_alts = [alt for alts in alt_lists for _, alt in alts]
+        flat_alt_embeddings = embed_alternative_questions(flat_alts)
+        
+        unique_ids = []
+        vectors = []
+        offset = 0
+        for (question, answer), question_embedding, enhanced_data, alts in zip(
+            pairs, question_embeddings, enhanced_list, alt_lists
+        ):
+            alt_embeddings = flat_alt_embeddings[offset:offset + len(alts)]
+            offset += len(alts)
+            unique_id, pair_vectors = build_response_vectors(
+                question, answer, question_embedding, enhanced_data, alt_embeddings
+            )
+            unique_ids.append(unique_id)
+            vectors.extend(pair_vectors)
+        
+        upserted = upsert_vectors_in_batches(pinecone_index, vectors, batch_size)
+        add_to_local_cache(vectors)
+        print(f"{len(pairs)}件のQ&Aを保存しました (ベクトル数: {upserted}, インデックス: {index_name})")
+        return unique_ids
+    except Exception as e:
+        print(f"Pineconeへの一括保存エラー: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+def iter_index_vectors(index, batch_size=100):
+    """インデックス内の全ベクトルを (id, values, metadata) で順に返す"""
+    for ids in index.list():
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            response = index.fetch(ids=ids[start:start + batch_size])
+            for vector_id, vector in response.vectors.items():
+                yield vector_id, vector.values, vector.metadata or {}
+
+_keyword_seed_started = False
+_keyword_seed_lock = threading.Lock()
+
+def _seed_keyword_corpus():
+    try:
+        local_cache = get_local_cache()
+        if local_cache is not None:
+            records = local_cache.metadata
+        else:
+            pc = Pinecone(api_key=PINECONE_API_KEY)
+            pinecone_index, _ = connect_cache_index(pc)
+            if pinecone_index is None:
+                return
+            records = itertools.islice(
+                (metadata for _, _, metadata in iter_index_vectors(pinecone_index) if metadata.get("question")),
+                CORPUS_MAX_DOCUMENTS,
+            )
+        seed_keyword_corpus(records)
+    except Exception as e:
+        print(f"キーワード抽出のコーパス初期化エラー: {e}")
+
+def start_keyword_corpus_seeding():
+    """
+    保存済みのQ&A（ローカルキャッシュ、なければraiden-cache）でキーワード抽出のコーパスを
+    バックグラウンドで1回だけ初期化する。初期化が終わるまでは、それまでのコーパスで抽出する。
+    """
+    global _keyword_seed_started
+    with _keyword_seed_lock:
+        if _keyword_seed_started:
+            return
+        _keyword_seed_started = True
+    threading.Thread(target=_seed_keyword_corpus, name="raiden-keyword-seed", daemon=True).start()
+
+def compact_cache_index(index_name=CACHE_INDEX_NAME, batch_size=UPSERT_BATCH_SIZE):
+    """
+    旧形式（類義語ベクトルにも回答全文を持たせていた）のキャッシュを、
+    類義語ベクトルには親IDと絞り込み用の項目だけを持たせる形式に書き換える
+    
+    Returns:
+    --------
+    int
+        書き換えたベクトル数
+    """
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    index = pc.Index(index_name)
+    
+    pending = []
+    rewritten = 0
+    for vector_id, values, metadata in iter_index_vectors(index):
+        if "-alt-" not in vector_id or "text" not in metadata:
+            continue
+        # メタデータの項目は削除できないので、同じIDで値ごと上書きする
+        pending.append({
+            "id": vector_id,
+            "values": values,
+            "metadata": {
+                "type": metadata.get("type", "chatbot_response"),
+                "category": metadata.get("category", "未分類"),
+                "parent_id": parent_id_of(vector_id),
+            }
+        })
+        if len(pending) >= batch_size:
+            rewritten += upsert_vectors_in_batches(index, pending, batch_size)
+            pending = []
+    rewritten += upsert_vectors_in_batches(index, pending, batch_size)
+    print(f"類義語ベクトルのメタデータを圧縮しました: {rewritten}件 (インデックス: {index_name})")
+    return rewritten
+
+@profiled()
+def check_previous_responses(query, index_name=CACHE_INDEX_NAME, query_embedding=None,
+                             use_category_filter=True):
     print(f"DEBUG: 渡された検索クエリ → {query}")
     """
     以前に類似の質問が答えられているかチェックする関数
@@ -229,12 +647,16 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
         ユーザークエリ
     index_name : str
         Pineconeのインデックス名（デフォルトは"raiden-cache"）
+    query_embedding : list, optional
+        計算済みのクエリ埋め込み（バッチで埋め込んだ場合などに再計算を省く）
+    use_category_filter : bool
+        カテゴリ分類器で判定したカテゴリで検索範囲を絞り込むかどうか
     
     Returns:
     --------
     dict
         類似の質問が見つかった場合は質問と回答を含む辞書
-        見つからなかった場合は {"found": False}
+        見つからなかった場合は {"found": False}（閾値未満の候補があれば"best_candidate"を含む）
     """
     print(f"===== 類似質問検索開始 =====")
     print(f"検索クエリ: '{query}'")
@@ -242,9 +664,16 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
     
     try:
         # クエリの埋め込みを取得
-        query_embedding = embedding_model.embed_query(query)
+        if query_embedding is None:
+            query_embedding = embedding_model.embed_query(query)
         print(f"埋め込みベクトル生成完了 (長さ: {len(query_embedding)})")
         
+        # プロセス内キャッシュでヒットすればPineconeに問い合わせない
+        if index_name == CACHE_INDEX_NAME:
+            local_result = search_local_cache(query_embedding)
+            if local_result is not None:
+                return local_result
+        
         # インデックスに対して類似の質問をクエリ
         pc = Pinecone(api_key=PINECONE_API_KEY)
         
@@ -298,23 +727,47 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
         # 類似度しきい値を出力
         print(f"類似度閾値: {SIMILARITY_THRESHOLD}")
         
+        # カテゴリを判定できる場合はカテゴリで絞り込んで検索範囲を狭める
+        category = category_filter_for(query_embedding) if use_category_filter else None
+        query_filter = {"type": "chatbot_response"}
+        if category:
+            query_filter["category"] = category
+            print(f"カテゴリで絞り込み: {category}")
+        
         # 類似の質問を検索
         query_results = index.query(
             vector=query_embedding,
             top_k=5,  # より多くの候補を取得
-            include_metadata=True,
-            filter={"type": "chatbot_response"}
+            include_metadata=False,  # メタデータは最良マッチの親レコードだけ後から取得する
+            filter=query_filter
         )
         
         print(f"検索結果: {len(query_results.matches)}件")
         
+        # カテゴリで絞り込んで候補がなければ、カテゴリなしで再検索する。
+        # カテゴリを書き換える前のインデックスは自由記述のカテゴリが残っているので、閾値を超える候補がないときも再検索する
+        # （書き換え後は、ミスのたびに2回検索しないよう候補が0件のときだけにする）
+        needs_requery = not query_results.matches or (
+            not is_relabeled(index_name)
+            and not any(match.score > SIMILARITY_THRESHOLD for match in query_results.matches)
+        )
+        if category and needs_requery:
+            print("カテゴリの絞り込みなしで再検索します")
+            query_results = index.query(
+                vector=query_embedding,
+                top_k=5,
+                include_metadata=False,
+                filter={"type": "chatbot_response"}
+            )
+            print(f"絞り込みなし検索結果: {len(query_results.matches)}件")
+        
         # もし結果がなければ、フィルターなしで再試行
         if not query_results.matches:
             print("フィルターなしで再検索します")
             query_results = index.query(
                 vector=query_embedding,
                 top_k=5,
-                include_metadata=True
+                include_metadata=False
             )
             print(f"フィルターなし検索結果: {len(query_results.matches)}件")
         
@@ -328,18 +781,6 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
             print(f"マッチ {i+1}:")
             print(f"  ID: {match.id}")
             print(f"  スコア: {match.score}")
-            
-            if 'question' in match.metadata:
-                print(f"  質問: {match.metadata['question']}")
-                
-                # 類義語リスト
-                alt_questions = match.metadata.get("alternative_questions", [])
-                if alt_questions:
-                    print(f"  類義語:")
-                    for j, alt in enumerate(alt_questions):
-                        print(f"    {j+1}: '{alt}'")
-            
-            print(f"  タイムスタンプ: {match.metadata.get('timestamp', 'なし')}")
         
         # 良いマッチがあるかチェック
         if query_results.matches and len(query_results.matches) > 0:
@@ -351,17 +792,35 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
             if best_match.score > SIMILARITY_THRESHOLD:
                 print(f"閾値を超えるマッチが見つかりました: {best_match.score} > {SIMILARITY_THRESHOLD}")
                 
+                # 回答本文は親レコードにだけ保存されているので、最良マッチの分だけ取得する
+                metadata = fetch_response_metadata(best_match.id, index)
+                if metadata is None or "question" not in metadata:
+                    print(f"マッチ {best_match.id} の回答が見つかりません")
+                    return {"found": False}
+                print(f"  質問: {metadata['question']}")
+                print(f"  タイムスタンプ: {metadata.get('timestamp', 'なし')}")
+                
                 return {
                     "found": True,
-                    "question": best_match.metadata["question"],
-                    "answer": best_match.metadata["text"],
+                    "question": metadata["question"],
+                    "answer": metadata["text"],
                     "similarity": best_match.score,
-                    "timestamp": best_match.metadata.get("timestamp", "不明"),
-                    "category": best_match.metadata.get("category", "未分類"),
-                    "summary": best_match.metadata.get("answer_summary", "")
+                    "timestamp": metadata.get("timestamp", "不明"),
+                    "category": metadata.get("category", "未分類"),
+                    "summary": metadata.get("answer_summary", "")
                 }
             else:
                 print(f"類似度が閾値未満: {best_match.score} < {SIMILARITY_THRESHOLD}")
+                print(f"===== 類似質問検索終了 =====")
+                # 時間切れ時の縮退用に、閾値未満の最良候補も返す（回答本文は必要になったときに取得する）
+                return {
+                    "found": False,
+                    "best_candidate": {
+                        "id": best_match.id,
+                        "similarity": best_match.score,
+                        "index_name": index_name,
+                    }
+                }
         else:
             print("マッチする質問が見つかりませんでした")
         
@@ -373,6 +832,7 @@ def check_previous_responses(query, index_name=CACHE_INDEX_NAME):
         traceback.print_exc()
         return {"found": False}
     
+@profiled()
 def search_cached_answer(question: str):
     """
     質問から類似質問を検索し、キャッシュ回答を返す。
@@ -1,8 +1,112 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from typing import Optional
+
+import numpy as np
 from langchain_core.tools import BaseTool
 from langchain_community.tools.vectorstore.tool import BaseVectorStoreTool
 from langchain_core.callbacks import CallbackManagerForToolRun, AsyncCallbackManagerForToolRun
 
+from raiden.llm_cache import cached_llm_call, acached_llm_call, document_id
+from raiden.multi_query import split_compound_question, multi_query_retrieve, amulti_query_retrieve
+from raiden.near_duplicates import collapse_near_duplicates, get_near_duplicate_index
+from raiden.text_normalizer import basic_normalize_text
+
+# RetrievalQAに渡すチャンク数
+RETRIEVAL_K = 13
+
+# 近似重複を除いてもRETRIEVAL_K件残るように多めに検索する件数
+RETRIEVAL_FETCH_K = 20
+
+# 同じリクエスト内で、これ以上類似したツール入力は同じ質問とみなして前回の結果を返す
+TOOL_RESULT_SIMILARITY_THRESHOLD = 0.95
+
+# ツール入力とこれ以上類似した質問で事前に検索済みなら、その検索結果を使って検索を省く
+PREFETCH_SIMILARITY_THRESHOLD = 0.85
+
+class ToolResultScope:
+    """
+    1リクエスト（エージェントの1回の実行）の間だけツールの結果を覚えておく
+
+    正規化したテキストが同じ入力はそのまま、埋め込みの類似度が閾値以上の入力は
+    既に発行した質問と同じとみなし、検索とLLM呼び出しを省いて前回の結果を返す。
+    また、リクエストの開始時に並列で取得したナレッジ検索の結果を登録しておくと、
+    ツール入力が十分似ていればツールの検索をその結果で置き換える。
+    """
+
+    def __init__(self, similarity_threshold=TOOL_RESULT_SIMILARITY_THRESHOLD,
+                 prefetch_similarity_threshold=PREFETCH_SIMILARITY_THRESHOLD):
+        self.similarity_threshold = similarity_threshold
+        self.prefetch_similarity_threshold = prefetch_similarity_threshold
+        self.results = {}  # 正規化した入力 -> 結果
+        self.embeddings = []  # (正規化した埋め込み, 正規化した入力)
+        self.prefetched = []  # (正規化した埋め込み, 検索結果の(Document, score)のリスト)
+        self.hits = 0
+        self.prefetch_hits = 0
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def find_exact(self, query):
+        result = self.results.get(basic_normalize_text(query))
+        if result is not None:
+            self.hits += 1
+            print(f"ツール結果を再利用（同一入力）: {query}")
+        return result
+
+    def find_similar(self, embedding):
+        if not self.embeddings:
+            return None
+        vector = self._unit(embedding)
+        matrix = np.vstack([issued for issued, _ in self.embeddings])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            self.hits += 1
+            issued_query = self.embeddings[best][1]
+            print(f"ツール結果を再利用（類似度 {scores[best]:.3f}）: {issued_query}")
+            return self.results[issued_query]
+        return None
+
+    def add(self, query, embedding, result):
+        key = basic_normalize_text(query)
+        self.results[key] = result
+        if embedding is not None:
+            self.embeddings.append((self._unit(embedding), key))
+
+    def add_prefetched(self, embedding, search_results):
+        """事前に取得した検索結果（(Document, score)のリスト）を登録する。同じ結果は1回だけ登録する"""
+        if any(results is search_results for _, results in self.prefetched):
+            return
+        self.prefetched.append((self._unit(embedding), search_results))
+
+    def find_prefetched(self, embedding):
+        """ツール入力と十分似た質問で取得済みの検索結果があれば、そのDocumentのリストを返す"""
+        if not self.prefetched:
+            return None
+        vector = self._unit(embedding)
+        scores = np.vstack([issued for issued, _ in self.prefetched]) @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.prefetch_similarity_threshold:
+            return None
+        self.prefetch_hits += 1
+        print(f"事前に取得した検索結果を使用（類似度 {scores[best]:.3f}）")
+        return [doc for doc, _ in self.prefetched[best][1]]
+
+_tool_result_scope = ContextVar("raiden_tool_result_scope", default=None)
+
+@contextmanager
+def tool_result_scope(similarity_threshold=TOOL_RESULT_SIMILARITY_THRESHOLD):
+    """ブロック内のCustomVectorStoreQAToolの呼び出し結果をリクエスト単位で再利用する"""
+    scope = ToolResultScope(similarity_threshold)
+    token = _tool_result_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _tool_result_scope.reset(token)
+
 class CustomVectorStoreQATool(BaseVectorStoreTool, BaseTool):
     """Tool for the VectorDBQA chain. To be initialized with name and chain."""
 
@@ -12,32 +116,111 @@ class CustomVectorStoreQATool(BaseVectorStoreTool, BaseTool):
             "Useful for when you need to answer questions about {name}. "
             "Whenever you need information about {description} "
             "you should ALWAYS use this. "
-            "Input should be a fully formed question."
+            "Input should be a fully formed question. "
+            "A comparison of several treatments can be asked as one question."
         )
         return template.format(name=name, description=description)
 
-    def _run(
-        self,
-        query: str,
-        run_manager: Optional[CallbackManagerForToolRun] = None,
-    ) -> str:
-        """Use the tool."""
+    def _build_chain(self):
         from langchain.chains.retrieval_qa.base import RetrievalQA
 
         # retrieverにkを渡す
         retriever = self.vectorstore.as_retriever(
-            search_kwargs={"k": 13}  # ← ここを可変にしてもOK！
+            search_kwargs={"k": RETRIEVAL_FETCH_K}  # ← ここを可変にしてもOK！
         )
 
-        chain = RetrievalQA.from_chain_type(
+        return RetrievalQA.from_chain_type(
             self.llm,
             retriever=retriever
         )
 
-        return chain.invoke(
-            {chain.input_key: query},
-            config={"callbacks": run_manager.get_child() if run_manager else None},
-        )[chain.output_key]
+    def _find_in_scope(self, scope, query, embedding=None):
+        """
+        同じリクエスト内で既に発行した質問と同一（embeddingがあれば類似）なら前回の結果を返す
+        """
+        if scope is None:
+            return None
+        if embedding is None:
+            return scope.find_exact(query)
+        return scope.find_similar(embedding)
+
+    def _plan_retrieval(self, scope, query, embedding):
+        """
+        検索の方法を決める。比較などの複合的な質問はサブクエリに分けて並列に検索し、
+        元の質問をリクエスト開始時に並列で検索済みなら、その結果を使う
+
+        Returns:
+        --------
+        tuple
+            (サブクエリのリスト, 検索済みのDocumentのリストまたはNone, multi_query_retrieveに渡す引数の辞書)
+        """
+        queries = split_compound_question(query)
+        prefetched = scope.find_prefetched(embedding) if scope is not None else None
+        multi_query_kwargs = {
+            "precomputed": {query: embedding} if embedding is not None else None,
+            "prefetched": {query: prefetched} if prefetched is not None else None,
+        }
+        return queries, prefetched, multi_query_kwargs
+
+    @staticmethod
+    def _combine_inputs(chain, docs, query):
+        """
+        近似重複を1つにまとめたチャンクで回答生成の入力を作る
+        （内容がほぼ同じチャンクで上位が埋まらないようにRETRIEVAL_K件にする）
+
+        Returns:
+        --------
+        tuple
+            (combine_documents_chainへの入力, LLMキャッシュのキーに使うチャンクID)
+        """
+        docs = collapse_near_duplicates(docs, RETRIEVAL_K, get_near_duplicate_index())
+        inputs = {chain.combine_documents_chain.input_key: docs, "question": query}
+        return inputs, [document_id(doc) for doc in docs]
+
+    @staticmethod
+    def _remember(scope, query, embedding, answer):
+        if scope is not None:
+            scope.add(query, embedding, answer)
+        return answer
+
+    def _run(
+        self,
+        query: str,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        chain = self._build_chain()
+        callbacks = run_manager.get_child() if run_manager else None
+
+        scope = _tool_result_scope.get()
+        cached = self._find_in_scope(scope, query)
+        if cached is not None:
+            return cached
+        embedding = self.vectorstore.embeddings.embed_query(query) if scope is not None else None
+        cached = self._find_in_scope(scope, query, embedding)
+        if cached is not None:
+            return cached
+
+        # 検索結果を先に取得し、同じ質問・同じチャンクならLLM呼び出しを省く
+        queries, prefetched, multi_query_kwargs = self._plan_retrieval(scope, query, embedding)
+        if len(queries) > 1:
+            docs = multi_query_retrieve(self.vectorstore, queries, RETRIEVAL_FETCH_K, **multi_query_kwargs)
+        elif prefetched is not None:
+            docs = prefetched
+        elif embedding is not None:
+            docs = self.vectorstore.similarity_search_by_vector(embedding, k=RETRIEVAL_FETCH_K)
+        else:
+            docs = chain.retriever.invoke(query, config={"callbacks": callbacks})
+        inputs, context_ids = self._combine_inputs(chain, docs, query)
+        combine_chain = chain.combine_documents_chain
+
+        answer = cached_llm_call(
+            self.llm,
+            query,
+            lambda: combine_chain.invoke(inputs, config={"callbacks": callbacks})[combine_chain.output_key],
+            context_ids=context_ids,
+        )
+        return self._remember(scope, query, embedding, answer)
 
     async def _arun(
         self,
@@ -45,20 +228,33 @@ class CustomVectorStoreQATool(BaseVectorStoreTool, BaseTool):
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool asynchronously."""
-        from langchain.chains.retrieval_qa.base import RetrievalQA
+        chain = self._build_chain()
+        callbacks = run_manager.get_child() if run_manager else None
 
-        retriever = self.vectorstore.as_retriever(
-            search_kwargs={"k": 13}
-        )
+        scope = _tool_result_scope.get()
+        cached = self._find_in_scope(scope, query)
+        if cached is not None:
+            return cached
+        embedding = await self.vectorstore.embeddings.aembed_query(query) if scope is not None else None
+        cached = self._find_in_scope(scope, query, embedding)
+        if cached is not None:
+            return cached
 
-        chain = RetrievalQA.from_chain_type(
-            self.llm,
-            retriever=retriever
-        )
+        queries, prefetched, multi_query_kwargs = self._plan_retrieval(scope, query, embedding)
+        if len(queries) > 1:
+            docs = await amulti_query_retrieve(self.vectorstore, queries, RETRIEVAL_FETCH_K, **multi_query_kwargs)
+        elif prefetched is not None:
+            docs = prefetched
+        elif embedding is not None:
+            docs = await self.vectorstore.asimilarity_search_by_vector(embedding, k=RETRIEVAL_FETCH_K)
+        else:
+            docs = await chain.retriever.ainvoke(query, config={"callbacks": callbacks})
+        inputs, context_ids = self._combine_inputs(chain, docs, query)
+        combine_chain = chain.combine_documents_chain
+
+        async def generate():
+            output = await combine_chain.ainvoke(inputs, config={"callbacks": callbacks})
+            return output[combine_chain.output_key]
 
-        return (
-            await chain.ainvoke(
-                {chain.input_key: query},
-                config={"callbacks": run_manager.get_child() if run_manager else None},
-            )
-        )[chain.output_key]
\ No newline at end of file
+        answer = await acached_llm_call(self.llm, query, generate, context_ids=context_ids)
+        return self._remember(scope, query, embedding, answer)
@@ -0,0 +1,99 @@
+"""
+リクエストごとの処理時間の予算（デッドライン）を管理するモジュール
+respondで開始したデッドラインをcontextvarで各処理に伝え、時間切れ・縮退の発生回数を記録する
+"""
+
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 1リクエストあたりの処理時間の予算（秒）
+REQUEST_BUDGET_SECONDS = float(os.getenv("RAIDEN_REQUEST_BUDGET_SECONDS", "45"))
+
+# 現在のリクエストのデッドライン
+_current_deadline = ContextVar("raiden_deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    """デッドラインまでに処理が終わらなかったことを表す例外"""
+
+class Deadline:
+    """
+    処理の締め切り時刻を保持する
+
+    Parameters:
+    -----------
+    budget_seconds : float
+        開始時点からの予算（秒）
+    """
+
+    def __init__(self, budget_seconds):
+        self.budget_seconds = budget_seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget_seconds
+
+    def remaining(self):
+        """残り時間（秒）。締め切りを過ぎていれば0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        """残り時間がseconds以上あるかどうか"""
+        return self.remaining() >= seconds
+
+    def check(self, stage, min_seconds=0.0):
+        """締め切りを過ぎているか、残り時間がmin_seconds未満ならDeadlineExceededを投げる"""
+        if self.expired() or not self.allows(min_seconds):
+            record_timeout(stage)
+            raise DeadlineExceeded(f"{stage}: 処理時間の予算 {self.budget_seconds:.1f}秒 を超えました")
+
+@contextmanager
+def deadline_scope(budget_seconds=REQUEST_BUDGET_SECONDS):
+    """ブロック内の処理に共通のデッドラインを設定する"""
+    deadline = Deadline(budget_seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+def current_deadline():
+    """現在のコンテキストのデッドライン（設定されていなければNone）"""
+    return _current_deadline.get()
+
+def remaining_time(default=None):
+    """現在のデッドラインまでの残り時間。デッドラインがなければdefault"""
+    deadline = current_deadline()
+    return deadline.remaining() if deadline is not None else default
+
+def time_allows(seconds):
+    """デッドラインがないか、残り時間がseconds以上あるかどうか"""
+    deadline = current_deadline()
+    return deadline is None or deadline.allows(seconds)
+
+# 時間切れ・縮退の発生回数
+_metrics_lock = threading.Lock()
+_timeouts = Counter()
+_degradations = Counter()
+
+def record_timeout(stage):
+    with _metrics_lock:
+        _timeouts[stage] += 1
+    print(f"デッドライン超過: {stage}")
+
+def record_degradation(kind):
+    with _metrics_lock:
+        _degradations[kind] += 1
+    print(f"縮退処理: {kind}")
+
+def get_deadline_metrics():
+    """段階ごとの時間切れ回数と、縮退処理の種類ごとの回数を返す"""
+    with _metrics_lock:
+        return {"timeouts": dict(_timeouts), "degradations": dict(_degradations)}
@@ -0,0 +1,157 @@
+"""
+temperature=0のLLM呼び出し結果をメモ化するローカルキャッシュ
+キーはモデル名・プロンプト・参照したコンテキストのチャンクIDのハッシュで、
+LRUとTTLで古いエントリを追い出す
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# キャッシュの上限件数と有効期限（秒）
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("RAIDEN_LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("RAIDEN_LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+class LLMResponseCache:
+    """
+    スレッドセーフなLRU + TTLキャッシュ
+
+    Parameters:
+    -----------
+    max_entries : int
+        保持する最大件数。超えたら最も長く使われていないエントリから削除する
+    ttl_seconds : float
+        エントリの有効期限（秒）
+    """
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def make_key(model, prompt, context_ids=()):
+        """モデル名・プロンプト・コンテキストのチャンクIDからキーを作る"""
+        payload = json.dumps([model, prompt, list(context_ids)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """キャッシュ済みの応答を返す。なければNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """ヒット数・ミス数・ヒット率・件数などを返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+# プロセス内で共有するキャッシュ
+llm_cache = LLMResponseCache()
+
+
+def model_name_of(llm):
+    """LangChainのLLMオブジェクトからモデル名を取り出す"""
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+
+def is_deterministic(llm):
+    """temperature=0のモデルだけをメモ化の対象にする"""
+    return getattr(llm, "temperature", None) == 0
+
+
+def document_id(doc):
+    """チャンクのID。メタデータにIDがなければ本文のハッシュを使う"""
+    doc_id = doc.metadata.get("id") if doc.metadata else None
+    if doc_id:
+        return str(doc_id)
+    return hashlib.md5(doc.page_content.encode('utf-8')).hexdigest()
+
+
+def cached_llm_call(llm, prompt, fn, context_ids=(), cache=llm_cache):
+    """
+    LLM呼び出しをメモ化して実行する
+
+    Parameters:
+    -----------
+    llm : object
+        呼び出すLLM（モデル名とtemperatureの確認に使う）
+    prompt : str
+        プロンプト（質問）
+    fn : callable
+        キャッシュにない場合に実行する、応答文字列を返す関数
+    context_ids : list
+        プロンプトに含めるコンテキストのチャンクID
+    cache : LLMResponseCache
+        使用するキャッシュ
+
+    Returns:
+    --------
+    str
+        LLMの応答
+    """
+    key, cached = _lookup(llm, prompt, context_ids, cache)
+    if cached is not None:
+        return cached
+
+    result = fn()
+    if key is not None:
+        cache.set(key, result)
+    return result
+
+
+async def acached_llm_call(llm, prompt, afn, context_ids=(), cache=llm_cache):
+    """cached_llm_callの非同期版。afnは応答文字列を返すコルーチンを返す関数"""
+    key, cached = _lookup(llm, prompt, context_ids, cache)
+    if cached is not None:
+        return cached
+
+    result = await afn()
+    if key is not None:
+        cache.set(key, result)
+    return result
+
+
+def _lookup(llm, prompt, context_ids, cache):
+    """メモ化の対象ならキーとキャッシュ済みの応答を返す。対象外なら(None, None)"""
+    if not is_deterministic(llm):
+        return None, None
+    key = cache.make_key(model_name_of(llm), prompt, context_ids)
+    cached = cache.get(key)
+    if cached is not None:
+        print(f"LLMキャッシュヒット: {model_name_of(llm)}")
+    return key, cached
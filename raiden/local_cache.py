@@ -0,0 +1,136 @@
+"""
+プロセス内で保持するQ&Aキャッシュ
+スナップショットから読み込んだ埋め込み行列（メモリマップ可）に対して類似質問を検索し、
+ヒットすればPineconeへ問い合わせずに回答を返す。
+埋め込みはint8に量子化したり次元を切り詰めたりして省メモリで保持できる
+（float16はfloat32への展開が遅く検索の経路に向かないので、このキャッシュでは使えない）。
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from raiden.quantization import QuantizedMatrix
+
+# ローカルキャッシュの埋め込みの精度（float32 / int8）と切り詰める次元数
+LOCAL_CACHE_PRECISIONS = ("float32", "int8")
+LOCAL_CACHE_PRECISION = os.getenv("RAIDEN_LOCAL_CACHE_PRECISION", "float32")
+LOCAL_CACHE_DIMENSIONS = int(os.getenv("RAIDEN_LOCAL_CACHE_DIMENSIONS", "0")) or None
+
+# 起動後に追加されたベクトルを入れる配列の最初の行数
+ADDED_VECTORS_INITIAL_ROWS = 64
+
+class LocalAnswerCache:
+    """
+    埋め込み行列とメタデータを保持し、コサイン類似度で検索する
+
+    Parameters:
+    -----------
+    ids : list
+        ベクトルのID
+    vectors : np.ndarray
+        (件数, 次元数) の正規化済み埋め込み行列。np.load(mmap_mode='r')の結果をそのまま渡せる
+    metadata : list
+        ベクトルごとのメタデータ（親レコードは回答全文、類義語ベクトルは親IDのみ）
+    precision : str
+        埋め込みを保持する精度（LOCAL_CACHE_PRECISIONSのいずれか。float32ならメモリマップのままコピーしない）
+    dimensions : int, optional
+        切り詰める次元数
+    """
+
+    def __init__(self, ids, vectors, metadata, precision=LOCAL_CACHE_PRECISION, dimensions=LOCAL_CACHE_DIMENSIONS):
+        if precision not in LOCAL_CACHE_PRECISIONS:
+            raise ValueError(f"ローカルキャッシュで使えない精度です: {precision}（{' / '.join(LOCAL_CACHE_PRECISIONS)}）")
+        self.ids = list(ids)
+        self.vectors = QuantizedMatrix.from_float(vectors, precision, dimensions)
+        self.metadata = list(metadata)
+        self._positions = {vector_id: i for i, vector_id in enumerate(self.ids)}
+        # 起動後に追加されたベクトル（読み込んだ行列はメモリマップのまま書き換えない）。
+        # 先頭の_added_count行が有効で、足りなくなったら倍の大きさの配列に移す
+        self._added_vectors = None
+        self._added_count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimension(self):
+        return self.vectors.shape[1]
+
+    @property
+    def nbytes(self):
+        """埋め込みの保持に使っているバイト数"""
+        added = self._added_vectors.nbytes if self._added_vectors is not None else 0
+        return self.vectors.nbytes + added
+
+    def add(self, vector_id, embedding, metadata):
+        """新しく保存したベクトルを追加する（件数が少ないのでfloat32のまま保持する）"""
+        vector = self.vectors.prepare_query(embedding)
+        with self._lock:
+            if self._added_vectors is None or self._added_count == len(self._added_vectors):
+                # 古い配列は検索中のスナップショットが参照していることがあるので、書き換えずに新しい配列へ移す
+                grown = np.empty((max(ADDED_VECTORS_INITIAL_ROWS, 2 * self._added_count), len(vector)),
+                                 dtype=np.float32)
+                if self._added_count:
+                    grown[:self._added_count] = self._added_vectors[:self._added_count]
+                self._added_vectors = grown
+            self._added_vectors[self._added_count] = vector
+            self._added_count += 1
+            self._positions[vector_id] = len(self.ids)
+            self.ids.append(vector_id)
+            self.metadata.append(metadata)
+
+    def _scores(self, query, added):
+        scores = self.vectors.scores(query)
+        if len(added):
+            scores = np.concatenate([scores, added @ query])
+        return scores
+
+    def search(self, embedding, top_k=5, type_filter="chatbot_response"):
+        """
+        類似度の高い順に (ID, スコア) を返す
+
+        Parameters:
+        -----------
+        embedding : list
+            クエリの埋め込み
+        top_k : int
+            返す件数
+        type_filter : str, optional
+            メタデータのtypeで絞り込む（Noneなら絞り込まない）
+        """
+        if not self.ids:
+            return []
+        query = self.vectors.prepare_query(embedding)
+        # ロックの中では追加済みの行の範囲だけを取り出し、スコアの計算はロックの外で行う
+        # （追加済みの行とIDとメタデータは追記のみなので、取り出した時点の位置はそのまま参照できる）
+        with self._lock:
+            added = self._added_vectors[:self._added_count] if self._added_count else np.empty((0, 0), np.float32)
+        scores = self._scores(query, added)
+
+        # 絞り込みで候補が減っても足りるように多めに取ってから並べ替える
+        candidates = min(len(scores), top_k * 4)
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for position in top:
+            if type_filter is not None and self.metadata[position].get("type") != type_filter:
+                continue
+            results.append((self.ids[position], float(scores[position])))
+            if len(results) >= top_k:
+                break
+        return results
+
+    def get_metadata(self, vector_id):
+        """ベクトルの親レコードのメタデータを返す（類義語ベクトルなら親をたどる）"""
+        position = self._positions.get(vector_id)
+        if position is None:
+            return None
+        metadata = self.metadata[position]
+        parent_id = metadata.get("parent_id")
+        if parent_id and parent_id != vector_id and "text" not in metadata:
+            return self.get_metadata(parent_id)
+        return metadata
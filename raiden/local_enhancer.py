@@ -0,0 +1,231 @@
+"""
+LLMを使わずにQ&Aペアの拡張情報（要約・キーワード・カテゴリ・類義質問）を作るモジュール
+キーワードはこれまでのQ&AをコーパスにしたTF-IDF、カテゴリはルールベースで判定する
+"""
+
+import math
+import re
+import threading
+from collections import Counter, deque
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from raiden.text_normalizer import basic_normalize_text
+
+# TF-IDFのコーパスとして保持するQ&Aの件数
+CORPUS_MAX_DOCUMENTS = 5000
+
+# この件数のQ&Aが追加されるたびにTF-IDFを学習し直す（書き込みごとには学習しない）
+CORPUS_REFIT_INTERVAL = 200
+
+# 漢字・カタカナの連続（2文字以上）と英数字の単語をキーワード候補とする
+TOKEN_PATTERN = re.compile(r'[一-龯々ヶ]{2,}|[ァ-ヴー]{2,}|[A-Za-z][A-Za-z0-9\-]+')
+
+# キーワードとして意味の薄い語
+STOP_WORDS = {
+    "場合", "必要", "可能", "以下", "以上", "方法", "情報", "関連", "回答", "質問",
+    "具体的", "一般的", "重要", "注意", "確認", "説明", "内容", "対応", "状態", "結果",
+}
+
+# カテゴリ判定のルール（カテゴリ, 手がかりとなる語）。先に書いたものほど同点時に優先する
+CATEGORY_RULES = [
+    ("症状", ["痛み", "痛い", "腫れ", "出血", "しみる", "違和感", "症状", "ぐらつ", "動揺", "口臭"]),
+    ("診断", ["診断", "検査", "レントゲン", "CT", "X線", "鑑別", "所見", "判定", "評価"]),
+    ("予防", ["予防", "歯磨き", "ブラッシング", "フッ素", "定期検診", "メンテナンス", "セルフケア", "再発防止"]),
+    ("材料", ["材料", "セラミック", "レジン", "ジルコニア", "金属", "合金", "接着剤", "セメント", "印象材"]),
+    ("技術", ["術式", "手技", "手順", "テクニック", "技術", "切開", "縫合", "固定", "技工"]),
+    ("治療法", ["治療", "移植", "再植", "インプラント", "抜歯", "矯正", "ブリッジ", "入れ歯", "義歯", "根管", "処置"]),
+]
+DEFAULT_CATEGORY = "未分類"
+
+# 類義質問を作るための言い換え（text_normalizerの表記ゆれとは逆方向の展開）
+PARAPHRASES = [
+    ("メリット", "利点"),
+    ("デメリット", "欠点"),
+    ("自家歯牙移植", "自家歯の移植"),
+    ("歯牙再植", "歯の再植"),
+    ("虫歯", "むし歯"),
+    ("歯医者", "歯科医院"),
+    ("教えてください", "知りたいです"),
+    ("とは", "について"),
+]
+
+def tokenize(text):
+    """キーワード候補となる語を抽出する"""
+    return [token for token in TOKEN_PATTERN.findall(basic_normalize_text(text)) if token not in STOP_WORDS]
+
+def truncate_summary(text, limit):
+    """最初の文を取り出し、limit文字を超える場合は切り詰める"""
+    if not text:
+        return ""
+    text = re.sub(r'\s+', ' ', text).strip()
+    first_sentence = re.split(r'(?<=[。？！?!])', text, maxsplit=1)[0].strip()
+    summary = first_sentence or text
+    return summary[:limit] + "..." if len(summary) > limit else summary
+
+def classify_category(question, answer=""):
+    """手がかり語の出現数でカテゴリを判定する（質問中の語は回答中の語の2倍に数える）"""
+    best_category = DEFAULT_CATEGORY
+    best_score = 0
+    for category, terms in CATEGORY_RULES:
+        score = sum(2 * question.count(term) + answer.count(term) for term in terms)
+        if score > best_score:
+            best_category = category
+            best_score = score
+    return best_category
+
+def generate_alternative_questions(question, max_alternatives=3):
+    """言い換え表に従って類義質問を作る"""
+    alternatives = []
+    for source, target in PARAPHRASES:
+        for before, after in ((source, target), (target, source)):
+            if before in question:
+                alternative = question.replace(before, after)
+                if alternative != question and alternative not in alternatives:
+                    alternatives.append(alternative)
+                break
+        if len(alternatives) >= max_alternatives:
+            break
+    return alternatives
+
+class KeywordExtractor:
+    """
+    これまでに保存したQ&Aをコーパスとし、TF-IDFの重みが大きい語をキーワードとして返す
+
+    学習は起動時のシード（seed）と、CORPUS_REFIT_INTERVAL件追加されるごとの1回だけ行い、
+    それまでは前回学習した語彙とIDFのまま抽出する。コーパスが小さいうちは件数が倍になるごとに学習し直す。
+    学習し直すときはバックグラウンドのスレッドで学習し、終わったら入れ替える（その間も前回の学習結果で抽出する）。
+    """
+
+    def __init__(self, max_documents=CORPUS_MAX_DOCUMENTS, refit_interval=CORPUS_REFIT_INTERVAL):
+        self.refit_interval = refit_interval
+        self._corpus = deque(maxlen=max_documents)
+        self._vectorizer = None
+        self._added_since_fit = 0
+        self._fitted_size = 0
+        self._refitting = False
+        self._lock = threading.Lock()
+
+    def add_documents(self, texts):
+        texts = [text for text in texts if text]
+        with self._lock:
+            self._corpus.extend(texts)
+            self._added_since_fit += len(texts)
+
+    def seed(self, texts):
+        """既存のQ&Aでコーパスを初期化し、1回だけ学習する"""
+        with self._lock:
+            self._corpus.extend(text for text in texts if text)
+            documents = list(self._corpus)
+            self._added_since_fit = 0
+        if documents:
+            self._install(self._fit(documents), len(documents))
+        print(f"キーワード抽出のコーパスを初期化しました: {len(documents)}件")
+
+    @staticmethod
+    def _fit(documents):
+        vectorizer = TfidfVectorizer(tokenizer=tokenize, lowercase=False, token_pattern=None)
+        vectorizer.fit(documents)
+        return vectorizer
+
+    def _install(self, vectorizer, fitted_size):
+        with self._lock:
+            self._vectorizer = vectorizer
+            self._fitted_size = fitted_size
+
+    def _refit(self, documents):
+        try:
+            self._install(self._fit(documents), len(documents))
+        except Exception as e:
+            print(f"キーワード抽出の学習エラー: {e}")
+        finally:
+            with self._lock:
+                self._refitting = False
+
+    def _start_refit(self):
+        """ロックを取った状態で呼ぶ。学習中でなければ、現在のコーパスの学習をバックグラウンドで始める"""
+        if self._refitting or not self._corpus:
+            return
+        self._refitting = True
+        self._added_since_fit = 0
+        threading.Thread(target=self._refit, args=(list(self._corpus),),
+                         name="raiden-keyword-refit", daemon=True).start()
+
+    def extract(self, text, top_k=5):
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        with self._lock:
+            refit_after = max(1, min(self.refit_interval, self._fitted_size))
+            if self._vectorizer is None or self._added_since_fit >= refit_after:
+                self._start_refit()
+            vectorizer = self._vectorizer
+            fitted_size = self._fitted_size
+
+        # 前回の学習後に現れた語は、どの文書にも出ていない語としてIDFを最大にする（smooth_idfと同じ式）。
+        # まだ一度も学習していなければ、全ての語を未知の語として出現回数で順位を付ける
+        unseen_idf = math.log(1 + fitted_size) + 1
+        vocabulary = vectorizer.vocabulary_ if vectorizer is not None else {}
+        counts = Counter(tokens)
+        scores = {
+            token: count * (vectorizer.idf_[vocabulary[token]] if token in vocabulary else unseen_idf)
+            for token, count in counts.items()
+        }
+        # 同点のときは先に出てきた語を優先する
+        return sorted(scores, key=lambda token: -scores[token])[:top_k]
+
+# プロセス内で共有するキーワード抽出器
+keyword_extractor = KeywordExtractor()
+
+def seed_keyword_corpus(records):
+    """
+    保存済みのQ&Aのメタデータ（questionとtextを持つもの）でキーワード抽出のコーパスを初期化する
+
+    Parameters:
+    -----------
+    records : iterable
+        raiden-cacheのメタデータ。類義語ベクトルなど質問を持たないものは無視する
+    """
+    texts = [f"{record['question']}\n{record.get('text', '')}"
+             for record in records if record and record.get("question")]
+    keyword_extractor.seed(texts[-CORPUS_MAX_DOCUMENTS:])
+
+def enhance_locally(question, answer):
+    """
+    LLMを使わずにQ&Aペアの拡張情報を作る（enhance_with_aiと同じ形式の辞書を返す）
+
+    Parameters:
+    -----------
+    question : str
+        ユーザーからの質問
+    answer : str
+        チャットボットの回答
+
+    Returns:
+    --------
+    dict
+        拡張された情報を含む辞書
+    """
+    # 質問の語を優先するため、質問を2回含めてキーワードを抽出する
+    document = f"{question}\n{question}\n{answer}"
+    keywords = keyword_extractor.extract(document, top_k=5)
+    # コーパスに加えるだけで、学習し直すのはCORPUS_REFIT_INTERVAL件たまってから
+    keyword_extractor.add_documents([f"{question}\n{answer}"])
+    return {
+        "question_summary": truncate_summary(question, 30),
+        "answer_summary": truncate_summary(answer, 50),
+        "alternative_questions": generate_alternative_questions(question),
+        "keywords": keywords,
+        "category": classify_category(question, answer),
+    }
+
+if __name__ == "__main__":
+    samples = [
+        ("自家歯牙移植のメリットは？", "自家歯牙移植は歯根膜を残したまま移植できるため、天然歯と同様の感覚が得られます。インプラントと比べて費用も抑えられます。"),
+        ("前歯のブリッジが取れてしまいました。どうすれば良いでしょうか？", "まずは外れたブリッジを保管し、早めに歯科医院を受診してください。セメントで再装着できる場合があります。"),
+        ("歯茎から出血するのはなぜですか？", "歯周病の初期症状である可能性があります。ブラッシングの方法を見直し、定期検診で歯石を除去してもらいましょう。"),
+    ]
+    for question, answer in samples:
+        print(question)
+        print(enhance_locally(question, answer))
+        print()
@@ -0,0 +1,362 @@
+"""
+欠損歯パターン（上下顎28本）の列挙・分類・集計エンジン
+歯の有無を28ビットのビットマスクで表し、分類ごとの件数は組み合わせ的に、
+パターンの列挙はNumPyでベクトル化してチャンクごとに行う
+
+ビットの並び（歯列弓に沿った順）:
+    ビット 0〜13  上顎 17 16 15 14 13 12 11 | 21 22 23 24 25 26 27
+    ビット14〜27  下顎 47 46 45 44 43 42 41 | 31 32 33 34 35 36 37
+同じ顎の中で隣り合うビットが隣在歯になる（11と21、41と31も隣り合う）
+"""
+
+import math
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+TEETH_PER_ARCH = 14
+TOTAL_TEETH = 28
+ARCH_MASK = (1 << TEETH_PER_ARCH) - 1
+
+# 各ビットに対応するFDI歯番号
+UPPER_TEETH = [17, 16, 15, 14, 13, 12, 11, 21, 22, 23, 24, 25, 26, 27]
+LOWER_TEETH = [47, 46, 45, 44, 43, 42, 41, 31, 32, 33, 34, 35, 36, 37]
+TOOTH_NUMBERS = UPPER_TEETH + LOWER_TEETH
+
+# 1つの顎の中での右側（患者の右）と前歯部（中切歯〜犬歯）のビット
+RIGHT_SIDE_BITS = 0b00000001111111
+LEFT_SIDE_BITS = ARCH_MASK & ~RIGHT_SIDE_BITS
+ANTERIOR_BITS = 0b00001111110000
+POSTERIOR_BITS = ARCH_MASK & ~ANTERIOR_BITS
+
+# 分類の名前
+ARCH_CLASSES = ["なし", "上顎のみ", "下顎のみ", "上下顎"]
+SIDE_CLASSES = ["なし", "右側のみ", "左側のみ", "両側"]
+REGION_CLASSES = ["なし", "前歯部のみ", "臼歯部のみ", "前歯部・臼歯部"]
+SYMMETRY_CLASSES = ["非対称", "左右対称"]
+
+# 列挙時に一度に返すパターン数の目安
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+def gosper_masks(n, bits=TOTAL_TEETH):
+    """
+    popcountがnのbitsビットのマスクを昇順に列挙する（Gosperのハック）
+
+    ベクトル化した列挙の検証用。Pythonのループなので大きなnでは遅い。
+    """
+    if n == 0:
+        yield 0
+        return
+    if n > bits:
+        return
+    mask = (1 << n) - 1
+    limit = 1 << bits
+    while mask < limit:
+        yield mask
+        lowest = mask & -mask
+        ripple = mask + lowest
+        mask = (((ripple ^ mask) >> 2) // lowest) | ripple
+
+def _classify(has_first, has_second):
+    """2つの領域のどちらに欠損があるかで 0:なし 1:前者のみ 2:後者のみ 3:両方 を返す"""
+    if isinstance(has_first, np.ndarray):
+        return has_first.astype(np.int64) + 2 * has_second.astype(np.int64)
+    return int(has_first) + 2 * int(has_second)
+
+def _build_arch_tables():
+    """1つの顎の14ビットのマスク全16384通りについて特徴量のルックアップ表を作る"""
+    masks = np.arange(1 << TEETH_PER_ARCH, dtype=np.uint32)
+    bits = (masks[:, None] >> np.arange(TEETH_PER_ARCH, dtype=np.uint32)) & 1
+
+    popcount = bits.sum(axis=1).astype(np.int64)
+    # 左右反転（正中で折り返す）したマスク
+    mirrored = (bits[:, ::-1] << np.arange(TEETH_PER_ARCH, dtype=np.uint32)).sum(axis=1).astype(np.uint32)
+    # 連続欠損区間の数 = 欠損の始まり（前のビットが0で自分が1）の数
+    starts = masks & ~(masks << 1) & ARCH_MASK
+    runs = ((starts[:, None] >> np.arange(TEETH_PER_ARCH, dtype=np.uint32)) & 1).sum(axis=1).astype(np.int64)
+    # 最長の連続欠損の長さ
+    max_run = np.zeros(len(masks), dtype=np.int64)
+    current = np.zeros(len(masks), dtype=np.int64)
+    for position in range(TEETH_PER_ARCH):
+        current = np.where(bits[:, position] == 1, current + 1, 0)
+        max_run = np.maximum(max_run, current)
+
+    return {
+        "popcount": popcount,
+        "mirrored": mirrored,
+        "runs": runs,
+        "max_run": max_run,
+        "right": (masks & RIGHT_SIDE_BITS) != 0,
+        "left": (masks & LEFT_SIDE_BITS) != 0,
+        "anterior": (masks & ANTERIOR_BITS) != 0,
+        "posterior": (masks & POSTERIOR_BITS) != 0,
+    }
+
+ARCH_TABLES = _build_arch_tables()
+
+# 本数ごとの1つの顎のマスク（列挙に使う）
+ARCH_MASKS_BY_COUNT = [
+    np.flatnonzero(ARCH_TABLES["popcount"] == count).astype(np.uint32)
+    for count in range(TEETH_PER_ARCH + 1)
+]
+
+def pattern_features(masks):
+    """
+    28ビットのマスク配列から分類用の特徴量を計算する
+
+    Returns:
+    --------
+    dict
+        arch / side / region（分類の番号）、symmetric（左右対称か）、
+        gap_runs（連続欠損区間の数）、max_gap（最長の連続欠損）の配列
+    """
+    masks = np.asarray(masks, dtype=np.uint32)
+    upper = masks & ARCH_MASK
+    lower = masks >> TEETH_PER_ARCH
+    t = ARCH_TABLES
+    return {
+        "arch": _classify(upper != 0, lower != 0),
+        "side": _classify(t["right"][upper] | t["right"][lower], t["left"][upper] | t["left"][lower]),
+        "region": _classify(t["anterior"][upper] | t["anterior"][lower], t["posterior"][upper] | t["posterior"][lower]),
+        "symmetric": (t["mirrored"][upper] == upper) & (t["mirrored"][lower] == lower),
+        "gap_runs": t["runs"][upper] + t["runs"][lower],
+        "max_gap": np.maximum(t["max_run"][upper], t["max_run"][lower]),
+    }
+
+def _matches(features, arch=None, side=None, region=None, symmetric=None, max_gap=None, gap_runs=None):
+    """特徴量が条件を満たすかどうかの真偽値配列（Noneの条件は無視する）"""
+    keep = np.ones(len(features["arch"]), dtype=bool)
+    if arch is not None:
+        keep &= features["arch"] == ARCH_CLASSES.index(arch)
+    if side is not None:
+        keep &= features["side"] == SIDE_CLASSES.index(side)
+    if region is not None:
+        keep &= features["region"] == REGION_CLASSES.index(region)
+    if symmetric is not None:
+        keep &= features["symmetric"] == bool(symmetric)
+    if max_gap is not None:
+        keep &= features["max_gap"] <= max_gap
+    if gap_runs is not None:
+        keep &= features["gap_runs"] == gap_runs
+    return keep
+
+def iter_patterns(n, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """
+    n本欠損のパターンのうち条件を満たすものを、uint32のマスク配列のチャンクで順に返す
+
+    上顎の本数mごとに「上顎m本のマスク × 下顎n-m本のマスク」の直積をブロック単位で作るので、
+    C(28,14)≒4000万通りでもメモリを一定に保ったまま列挙できる。
+
+    Parameters:
+    -----------
+    n : int
+        欠損歯の本数（0〜28）
+    chunk_size : int
+        1チャンクあたりのパターン数の目安
+    filters : dict
+        arch / side / region（分類名）、symmetric（bool）、max_gap / gap_runs（int）
+    """
+    if not (0 <= n <= TOTAL_TEETH):
+        return
+    for upper_count in range(max(0, n - TEETH_PER_ARCH), min(n, TEETH_PER_ARCH) + 1):
+        uppers = ARCH_MASKS_BY_COUNT[upper_count]
+        lowers = ARCH_MASKS_BY_COUNT[n - upper_count] << np.uint32(TEETH_PER_ARCH)
+        block = max(1, chunk_size // len(lowers))
+        for start in range(0, len(uppers), block):
+            masks = (uppers[start:start + block, None] | lowers[None, :]).ravel()
+            if filters:
+                masks = masks[_matches(pattern_features(masks), **filters)]
+            if len(masks):
+                yield masks
+
+@lru_cache(maxsize=None)
+def _arch_groups():
+    """
+    1つの顎のマスクを特徴量の組ごとにまとめた件数表
+    (本数, 区間数, 最長区間, 右, 左, 前歯, 臼歯, 対称) -> 件数
+    """
+    t = ARCH_TABLES
+    keys = zip(
+        t["popcount"].tolist(), t["runs"].tolist(), t["max_run"].tolist(),
+        t["right"].tolist(), t["left"].tolist(), t["anterior"].tolist(), t["posterior"].tolist(),
+        (t["mirrored"] == np.arange(1 << TEETH_PER_ARCH)).tolist(),
+    )
+    return Counter(keys)
+
+@lru_cache(maxsize=None)
+def _pair_table(n):
+    """
+    上顎・下顎の特徴量の組の直積のうち合計n本になるものを、結合した特徴量と件数の配列にする。
+    件数は「上顎の組の件数 × 下顎の組の件数」なので、パターンを1つずつ数える必要はない。
+    """
+    groups = list(_arch_groups().items())
+    rows = []
+    for (u_pop, u_runs, u_max, u_right, u_left, u_ant, u_post, u_sym), u_count in groups:
+        for (l_pop, l_runs, l_max, l_right, l_left, l_ant, l_post, l_sym), l_count in groups:
+            if u_pop + l_pop != n:
+                continue
+            rows.append((
+                _classify(u_pop > 0, l_pop > 0),
+                _classify(u_right or l_right, u_left or l_left),
+                _classify(u_ant or l_ant, u_post or l_post),
+                u_sym and l_sym,
+                u_runs + l_runs,
+                max(u_max, l_max),
+                u_count * l_count,
+            ))
+    columns = list(zip(*rows)) if rows else [()] * 7
+    features = {
+        "arch": np.array(columns[0], dtype=np.int64),
+        "side": np.array(columns[1], dtype=np.int64),
+        "region": np.array(columns[2], dtype=np.int64),
+        "symmetric": np.array(columns[3], dtype=bool),
+        "gap_runs": np.array(columns[4], dtype=np.int64),
+        "max_gap": np.array(columns[5], dtype=np.int64),
+    }
+    return features, np.array(columns[6], dtype=np.int64)
+
+def count_patterns(n, **filters):
+    """
+    n本欠損のパターンのうち条件を満たすものの件数（列挙せずに組み合わせ的に数える）
+
+    Parameters:
+    -----------
+    n : int
+        欠損歯の本数（0〜28）
+    filters : dict
+        iter_patternsと同じ条件
+    """
+    if not (0 <= n <= TOTAL_TEETH):
+        return 0
+    features, counts = _pair_table(n)
+    return int(counts[_matches(features, **filters)].sum())
+
+@lru_cache(maxsize=None)
+def breakdown(n):
+    """
+    n本欠損のパターン数を分類ごとに集計した表
+
+    Returns:
+    --------
+    dict
+        {"total": 総数, "arch": {分類名: 件数}, "side": {...}, "region": {...},
+         "symmetry": {...}, "gap_runs": {区間数: 件数}, "max_gap": {最長区間: 件数}}
+    """
+    features, counts = _pair_table(n)
+
+    def tally(values, labels=None):
+        result = {}
+        for value in sorted(set(values.tolist())):
+            key = labels[int(value)] if labels is not None else int(value)
+            result[key] = int(counts[values == value].sum())
+        return result
+
+    return {
+        "total": math.comb(TOTAL_TEETH, n) if 0 <= n <= TOTAL_TEETH else 0,
+        "arch": tally(features["arch"], ARCH_CLASSES),
+        "side": tally(features["side"], SIDE_CLASSES),
+        "region": tally(features["region"], REGION_CLASSES),
+        "symmetry": tally(features["symmetric"].astype(np.int64), SYMMETRY_CLASSES),
+        "gap_runs": tally(features["gap_runs"]),
+        "max_gap": tally(features["max_gap"]),
+    }
+
+def mask_to_teeth(mask):
+    """マスクを欠損歯のFDI歯番号のリストに変換する"""
+    return [TOOTH_NUMBERS[bit] for bit in range(TOTAL_TEETH) if (int(mask) >> bit) & 1]
+
+def format_breakdown(n):
+    """breakdown(n)を画面表示用の文字列にする"""
+    table = breakdown(n)
+    lines = [f"上下顎あわせて {n} 本が欠損している場合、\n組み合わせ数は {table['total']:,} 通りです。", ""]
+    for title, key in (("顎別", "arch"), ("左右別", "side"), ("部位別", "region"), ("対称性", "symmetry")):
+        items = " / ".join(f"{label}: {count:,}" for label, count in table[key].items())
+        lines.append(f"【{title}】 {items}")
+    items = " / ".join(f"{runs}区間: {count:,}" for runs, count in table["gap_runs"].items())
+    lines.append(f"【連続欠損の区間数】 {items}")
+    items = " / ".join(f"{length}歯: {count:,}" for length, count in table["max_gap"].items())
+    lines.append(f"【最長の連続欠損】 {items}")
+    return "\n".join(lines)
+
+def sample_patterns(n, limit=10, **filters):
+    """条件を満たすパターンを先頭からlimit件、欠損歯番号のリストで返す"""
+    samples = []
+    for chunk in iter_patterns(n, chunk_size=max(limit, 1024), **filters):
+        for mask in chunk[:limit - len(samples)]:
+            samples.append(mask_to_teeth(mask))
+        if len(samples) >= limit:
+            break
+    return samples
+
+# 画面の選択肢で「指定なし」を表す値
+ANY_CLASS = "指定なし"
+
+def describe_filtered_patterns(n, arch=ANY_CLASS, side=ANY_CLASS, region=ANY_CLASS, symmetry=ANY_CLASS, max_gap=TEETH_PER_ARCH, limit=10):
+    """
+    画面で選んだ条件に該当するパターンの件数と例を表示用の文字列にする
+
+    Parameters:
+    -----------
+    n : int
+        欠損歯の本数
+    arch, side, region, symmetry : str
+        各分類の分類名（ANY_CLASSなら絞り込まない）
+    max_gap : int
+        最長の連続欠損の上限
+    limit : int
+        例として表示するパターン数
+    """
+    n = int(n)
+    filters = {
+        "arch": None if arch == ANY_CLASS else arch,
+        "side": None if side == ANY_CLASS else side,
+        "region": None if region == ANY_CLASS else region,
+        "symmetric": None if symmetry == ANY_CLASS else symmetry == "左右対称",
+        "max_gap": None if max_gap is None or int(max_gap) >= TEETH_PER_ARCH else int(max_gap),
+    }
+    filters = {key: value for key, value in filters.items() if value is not None}
+    count = count_patterns(n, **filters)
+    lines = [f"条件に該当するパターンは {count:,} 通りです。"]
+    if count:
+        lines.append("")
+        lines.append(f"例（先頭{min(limit, count)}件、欠損歯の番号）:")
+        for teeth in sample_patterns(n, limit=limit, **filters):
+            lines.append("  " + (", ".join(str(tooth) for tooth in teeth) or "欠損なし"))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import time
+
+    # 小さいnで、組み合わせ的な集計と総当たり（Gosperのハック）の結果が一致することを確認
+    for n in range(0, 6):
+        masks = np.fromiter(gosper_masks(n), dtype=np.uint32)
+        features = pattern_features(masks)
+        table = breakdown(n)
+        assert len(masks) == table["total"]
+        for key, labels in (("arch", ARCH_CLASSES), ("side", SIDE_CLASSES), ("region", REGION_CLASSES)):
+            brute = {labels[v]: int(c) for v, c in zip(*np.unique(features[key], return_counts=True))}
+            assert brute == table[key], (n, key, brute, table[key])
+        for key in ("gap_runs", "max_gap"):
+            brute = {int(v): int(c) for v, c in zip(*np.unique(features[key], return_counts=True))}
+            assert brute == table[key], (n, key, brute, table[key])
+        assert int(features["symmetric"].sum()) == table["symmetry"].get("左右対称", 0)
+        assert count_patterns(n, symmetric=True) == (math.comb(14, n // 2) if n % 2 == 0 else 0)
+        assert count_patterns(n, arch="上顎のみ") == (math.comb(14, n) if n else 0)
+    print("集計と総当たりの結果が一致しました (n=0〜5)")
+
+    start = time.perf_counter()
+    table = breakdown(14)
+    print(f"n=14 の集計: {time.perf_counter() - start:.3f}秒")
+    print(format_breakdown(14))
+
+    start = time.perf_counter()
+    total = sum(len(chunk) for chunk in iter_patterns(14))
+    print(f"n=14 の全列挙: {total:,}件 {time.perf_counter() - start:.2f}秒")
+
+    start = time.perf_counter()
+    filters = {"arch": "上下顎", "region": "臼歯部のみ", "max_gap": 3}
+    total = sum(len(chunk) for chunk in iter_patterns(10, **filters))
+    assert total == count_patterns(10, **filters)
+    print(f"n=10 上下顎・臼歯部のみ・最長3歯以下: {total:,}件 {time.perf_counter() - start:.2f}秒")
+    print(sample_patterns(10, limit=3, **filters))
@@ -0,0 +1,211 @@
+"""
+複合的な質問を複数の検索クエリに分けて並列に検索するモジュール
+「インプラント治療と自家歯牙移植術の違い」のような比較の質問は、元の質問に加えて
+比較対象ごとのクエリで同時に検索し、チャンクIDで重複を除いてから1回の回答生成に渡す。
+（エージェントが比較対象ごとにツールを呼び、検索とRetrievalQAを何度も繰り返すのを避ける）
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from raiden.llm_cache import cached_llm_call, document_id
+from raiden.text_normalizer import basic_normalize_text
+
+# 元の質問を含めたサブクエリ数の上限
+MAX_SUB_QUERIES = 4
+
+# ルールで分割できなかった質問をLLMで分割するかどうかと、そのモデル
+MULTI_QUERY_USE_LLM = os.getenv("RAIDEN_MULTI_QUERY_USE_LLM", "false").lower() == "true"
+MULTI_QUERY_MODEL = os.getenv("RAIDEN_MULTI_QUERY_MODEL", "gpt-4o-mini")
+
+# 比較の質問（「AとBの違い」「AとBはどちらが」など）
+COMPARISON_PATTERN = re.compile(
+    r'^(?P<items>.+?)(?:の(?:違い|比較|相違点?|差異?|使い分け)|(?:は|では|の)?どちら|を比較)'
+)
+# 複数の対象について尋ねる質問（「AとBについて」など）
+ENUMERATION_PATTERN = re.compile(r'^(?P<items>.+?)(?:について|に関して|とは)')
+# 比較対象の区切り。「と」「や」は直前がひらがなでない（名詞の終わり）場合だけ区切りとみなす
+# （「しみるときと痛いとき」の「とき」や「ときと」で分けない）
+ITEM_SEPARATOR = re.compile(r'(?<![ぁ-ゖ])[とや]|,|および|及び|・|\bvs\.?\b|\bVS\.?\b')
+# 文の区切り（正規化後は「。」が「.」、「？」が「?」になる）
+SENTENCE_END = re.compile(r'(?<=[?!.])\s*')
+
+MULTI_QUERY_PROMPT = """次の歯科に関する質問が複数の事柄を尋ねている場合、検索用の短い質問に分割してください。
+分割の必要がなければ空の配列を返してください。出力はJSONの文字列配列のみとしてください（最大{max_queries}件）。
+
+質問: {question}"""
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="raiden-multi-query")
+_split_llm = None
+
+def _split_items(items):
+    parts = [part.strip(" ,.") for part in ITEM_SEPARATOR.split(items)]
+    parts = [part for part in parts if len(part) >= 2]
+    return parts if len(parts) >= 2 else []
+
+def split_by_rules(question):
+    """
+    正規化した質問をルールで分割する
+
+    Returns:
+    --------
+    list
+        サブクエリ（元の質問は含まない）。分割できなければ空のリスト
+    """
+    text = basic_normalize_text(question)
+
+    # 複数の文で別々のことを尋ねている場合は質問文ごとに分ける
+    sentences = [sentence.strip() for sentence in SENTENCE_END.split(text)]
+    questions = [sentence for sentence in sentences if sentence.endswith("?") and len(sentence) >= 5]
+    if len(questions) >= 2:
+        return questions
+
+    match = COMPARISON_PATTERN.match(text)
+    if match:
+        return _split_items(match.group("items"))
+
+    match = ENUMERATION_PATTERN.match(text)
+    if match:
+        return [f"{item}について" for item in _split_items(match.group("items"))]
+    return []
+
+def _looks_compound(question):
+    text = basic_normalize_text(question)
+    return "と" in text or "や" in text or text.count("?") >= 2
+
+def split_by_llm(question, max_queries=MAX_SUB_QUERIES - 1):
+    """軽量なLLMを1回呼んで質問を分割する（結果はメモ化される）。失敗したら空のリスト"""
+    global _split_llm
+    if _split_llm is None:
+        from raiden.openai_client import RateLimitedChatOpenAI
+        _split_llm = RateLimitedChatOpenAI(model_name=MULTI_QUERY_MODEL, temperature=0)
+    prompt = MULTI_QUERY_PROMPT.format(question=question, max_queries=max_queries)
+    try:
+        content = cached_llm_call(_split_llm, prompt, lambda: _split_llm.invoke(prompt).content)
+        match = re.search(r'\[.*\]', content, re.DOTALL)
+        queries = json.loads(match.group(0)) if match else []
+        return [str(query).strip() for query in queries if str(query).strip()][:max_queries]
+    except Exception as e:
+        print(f"質問の分割エラー: {e}")
+        return []
+
+def split_compound_question(question, use_llm=MULTI_QUERY_USE_LLM):
+    """
+    検索に使うクエリのリストを返す。分割した場合は先頭に元の質問を含める
+
+    Parameters:
+    -----------
+    question : str
+        質問
+    use_llm : bool
+        ルールで分割できず複合的に見える質問を、LLMで分割するかどうか
+
+    Returns:
+    --------
+    list
+        検索クエリ。分割しなかった場合は [question]
+    """
+    sub_queries = split_by_rules(question)
+    if not sub_queries and use_llm and _looks_compound(question):
+        sub_queries = split_by_llm(question)
+
+    queries = [question]
+    seen = {basic_normalize_text(question)}
+    for query in sub_queries:
+        key = basic_normalize_text(query)
+        if key and key not in seen:
+            seen.add(key)
+            queries.append(query)
+    return queries[:MAX_SUB_QUERIES]
+
+def merge_results(result_lists, k):
+    """
+    クエリごとの検索結果を順位の高い順に交互に取り出し、チャンクIDで重複を除いてk件にまとめる
+    （比較対象のどちらかのチャンクだけで埋まらないようにする）
+    """
+    merged = []
+    seen = set()
+    for rank in range(max((len(results) for results in result_lists), default=0)):
+        for results in result_lists:
+            if rank >= len(results):
+                continue
+            doc = results[rank]
+            doc_id = document_id(doc)
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            merged.append(doc)
+            if len(merged) >= k:
+                return merged
+    return merged
+
+def _submit(fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, fn, *args, **kwargs)
+
+def multi_query_retrieve(vectorstore, queries, k, precomputed=None, prefetched=None):
+    """
+    複数のクエリの埋め込みを1回のバッチで計算し、並列に検索して結果をまとめる
+
+    Parameters:
+    -----------
+    vectorstore : VectorStore
+        検索するベクトルストア
+    queries : list
+        検索クエリ
+    k : int
+        まとめた結果の件数（クエリごとにもk件ずつ検索する）
+    precomputed : dict, optional
+        計算済みの埋め込み（クエリ -> 埋め込み）
+    prefetched : dict, optional
+        取得済みの検索結果（クエリ -> Documentのリスト）。これらのクエリは検索しない
+    """
+    prefetched = prefetched or {}
+    searched = [query for query in queries if query not in prefetched]
+    precomputed = precomputed or {}
+    missing = [query for query in searched if query not in precomputed]
+    embeddings = dict(precomputed)
+    if missing:
+        embeddings.update(zip(missing, vectorstore.embeddings.embed_documents(missing)))
+
+    futures = {query: _submit(vectorstore.similarity_search_by_vector, embeddings[query], k=k) for query in searched}
+    result_lists = [prefetched[query] if query in prefetched else futures[query].result() for query in queries]
+    docs = merge_results(result_lists, k)
+    print(f"マルチクエリ検索: {len(queries)}クエリ → {len(docs)}チャンク {queries}")
+    return docs
+
+async def amulti_query_retrieve(vectorstore, queries, k, precomputed=None, prefetched=None):
+    """multi_query_retrieveの非同期版"""
+    prefetched = prefetched or {}
+    searched = [query for query in queries if query not in prefetched]
+    precomputed = precomputed or {}
+    missing = [query for query in searched if query not in precomputed]
+    embeddings = dict(precomputed)
+    if missing:
+        embeddings.update(zip(missing, await vectorstore.embeddings.aembed_documents(missing)))
+
+    searched_lists = await asyncio.gather(
+        *(vectorstore.asimilarity_search_by_vector(embeddings[query], k=k) for query in searched)
+    )
+    results = dict(zip(searched, searched_lists))
+    return merge_results([prefetched[query] if query in prefetched else results[query] for query in queries], k)
+
+if __name__ == "__main__":
+    test_questions = [
+        "インプラント治療と自家歯牙移植術の違いについて教えてください。",
+        "ブリッジと入れ歯はどちらが長持ちしますか？",
+        "歯牙再植と自家歯牙移植について知りたいです。",
+        "親知らずを抜いた後の痛みはいつまで続きますか？腫れはどうすれば引きますか？",
+        "根管治療の期間はどのくらいですか？",
+        # 「と」「や」が語の一部の場合は分割しない
+        "歯がしみるときと痛いときの違いは何ですか？",
+        "冷たいものや甘いものがしみるのはどちらが原因ですか？",
+        "ときどき歯茎が腫れるのと出血するのはどちらが問題ですか？",
+    ]
+    for question in test_questions:
+        print(question)
+        print(f"  → {split_compound_question(question, use_llm=False)}")
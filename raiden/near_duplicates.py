@@ -0,0 +1,480 @@
+"""
+ナレッジベースのチャンクの近似重複をMinHash/LSHで検出するモジュール
+basic_normalize_textで正規化した本文の文字5-gramからMinHash署名（one permutation hashing）を作り、
+バンドごとのキーが一致したチャンクだけを推定Jaccard係数で確かめて同じクラスタにまとめる。
+
+- チャンクを追加するたびに既存のチャンクと照合する（インクリメンタル）
+- 検索時には、取得したチャンクのうち同じクラスタ・推定Jaccard係数が閾値以上のものを1つにまとめる
+- 署名は下位16ビットだけをnp.savezで保存する（1チャンクあたり128バイト + ID）
+
+使い方:
+    python -m raiden.near_duplicates build                  # raidenインデックスの未登録チャンクを追加して保存
+    python -m raiden.near_duplicates benchmark --chunks 1000000
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import threading
+import time
+
+import numpy as np
+
+from raiden.llm_cache import document_id
+from raiden.text_normalizer import basic_normalize_text
+
+# MinHashの関数の数と、LSHのバンド数（1バンドあたり8行 → 類似度およそ0.77以上で候補になる）
+NUM_PERM = 64
+NUM_BANDS = 8
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+
+# 文字n-gramの長さ
+SHINGLE_SIZE = 5
+
+# 推定Jaccard係数がこれ以上なら近似重複とみなす
+DUPLICATE_THRESHOLD = 0.8
+
+# 保存先
+NEAR_DUPLICATE_INDEX_PATH = os.getenv("RAIDEN_NEAR_DUPLICATE_INDEX", "near_duplicates.npz")
+
+# 追加分のバンドキーを辞書で持つ件数の上限（超えたらソート済み配列にまとめる）
+PENDING_FLUSH_SIZE = 100000
+
+# 一度に署名を計算するチャンク数
+SIGNATURE_BATCH_SIZE = 2048
+
+_SHINGLE_BASE = np.uint64(1000003)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+_BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+_EMPTY_BIN = np.uint32(0xFFFFFFFF)
+# 空のビンを右隣のビンの値で埋めるときに、距離ごとにずらす量
+_DENSIFY_OFFSET = 0x9E3779B1
+
+def _normalize(text):
+    normalized = basic_normalize_text(text).replace(" ", "")
+    # n-gramが1つも作れない短いチャンクは埋めて、全体を1つのn-gramとして扱う
+    return normalized.ljust(SHINGLE_SIZE, "\0")
+
+def compute_signatures(texts):
+    """
+    テキストのリストからMinHash署名（下位16ビット）を計算する
+
+    Returns:
+    --------
+    np.ndarray
+        (件数, NUM_PERM) のuint16配列
+    """
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint16)
+    for start in range(0, len(texts), SIGNATURE_BATCH_SIZE):
+        batch = [_normalize(text) for text in texts[start:start + SIGNATURE_BATCH_SIZE]]
+        lengths = np.array([len(text) for text in batch])
+        ends = np.cumsum(lengths)
+        codes = np.frombuffer("".join(batch).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+        # バッチ全体を連結したまま文字n-gramの多項式ハッシュを計算し（uint64の桁あふれはそのまま使う）、
+        # チャンクの境界をまたぐn-gramを除く
+        count = len(codes) - SHINGLE_SIZE + 1
+        value = np.zeros(count, dtype=np.uint64)
+        for offset in range(SHINGLE_SIZE):
+            value = value * _SHINGLE_BASE + codes[offset:offset + count]
+        chunk_of = np.repeat(np.arange(len(batch)), lengths)[:count]
+        flat = value[np.arange(count) + SHINGLE_SIZE <= ends[chunk_of]]
+
+        # one permutation hashing: n-gramのハッシュを1回だけ計算し、上位ビットで NUM_PERM 個のビンに振り分けて
+        # ビンごとの最小値を署名にする（ハッシュ関数を NUM_PERM 個使う方法と同じ精度で計算量は1/NUM_PERM）
+        flat = flat * _MIX_1
+        flat ^= flat >> np.uint64(29)
+        flat *= _MIX_2
+        flat ^= flat >> np.uint64(32)
+        bins = ((flat >> np.uint64(32)) % np.uint64(NUM_PERM)).astype(np.int64)
+        owners = np.repeat(np.arange(len(batch)), lengths - SHINGLE_SIZE + 1)
+        minimums = np.full(len(batch) * NUM_PERM, _EMPTY_BIN, dtype=np.uint32)
+        np.minimum.at(minimums, owners * NUM_PERM + bins, (flat & np.uint64(0xFFFFFFFF)).astype(np.uint32))
+        minimums = minimums.reshape(len(batch), NUM_PERM)
+
+        # n-gramが入らなかったビンは、右隣（循環）の空でないビンの値を距離に応じてずらして埋める
+        filled = minimums.copy()
+        for distance in range(1, NUM_PERM):
+            empty = filled == _EMPTY_BIN
+            if not empty.any():
+                break
+            source = np.roll(minimums, -distance, axis=1)
+            take = empty & (source != _EMPTY_BIN)
+            filled[take] = source[take] + np.uint32((_DENSIFY_OFFSET * distance) & 0xFFFFFFFF)
+        signatures[start:start + len(batch)] = (filled & np.uint32(0xFFFF)).astype(np.uint16)
+    return signatures
+
+def band_keys(signatures):
+    """署名をバンドごとに1つのuint64キーにまとめる。(件数, NUM_BANDS) を返す"""
+    rows = signatures.astype(np.uint64).reshape(len(signatures), NUM_BANDS, ROWS_PER_BAND)
+    keys = np.zeros((len(signatures), NUM_BANDS), dtype=np.uint64)
+    for row in range(ROWS_PER_BAND):
+        keys = keys * _BAND_MIX + rows[:, :, row]
+    return keys
+
+def estimate_similarity(signature, others):
+    """署名どうしの一致率（推定Jaccard係数）"""
+    return (np.asarray(others) == signature).mean(axis=-1)
+
+class NearDuplicateIndex:
+    """
+    チャンクのMinHash署名とクラスタを保持するLSHインデックス
+
+    各バンドについて、キーが最初に現れたチャンクの位置をソート済み配列（まとめて追加した分）と
+    辞書（最近追加した分）で持つ。clusters[i]はチャンクiが属するクラスタの代表（最初のチャンク）の位置。
+    """
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.ids = []
+        # 1件ずつ追加しても全体をコピーしないよう、容量を倍々に増やす配列に持つ
+        self._signatures = np.empty((0, NUM_PERM), dtype=np.uint16)
+        self._clusters = np.empty(0, dtype=np.int64)
+        self._positions = {}
+        self._sorted_keys = [np.empty(0, dtype=np.uint64) for _ in range(NUM_BANDS)]
+        self._sorted_positions = [np.empty(0, dtype=np.int64) for _ in range(NUM_BANDS)]
+        self._pending = [{} for _ in range(NUM_BANDS)]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self._positions
+
+    @property
+    def signatures(self):
+        return self._signatures[:len(self.ids)]
+
+    @property
+    def clusters(self):
+        return self._clusters[:len(self.ids)]
+
+    def _reserve(self, size):
+        if size <= len(self._clusters):
+            return
+        capacity = max(size, 2 * len(self._clusters), 1024)
+        signatures = np.empty((capacity, NUM_PERM), dtype=np.uint16)
+        signatures[:len(self.ids)] = self.signatures
+        clusters = np.empty(capacity, dtype=np.int64)
+        clusters[:len(self.ids)] = self.clusters
+        self._signatures, self._clusters = signatures, clusters
+
+    @property
+    def nbytes(self):
+        """署名とクラスタの配列が使うバイト数"""
+        sorted_bytes = sum(keys.nbytes + positions.nbytes
+                           for keys, positions in zip(self._sorted_keys, self._sorted_positions))
+        return self.signatures.nbytes + self.clusters.nbytes + sorted_bytes
+
+    def _flush_pending(self):
+        for band in range(NUM_BANDS):
+            pending = self._pending[band]
+            if not pending:
+                continue
+            keys = np.concatenate([self._sorted_keys[band], np.fromiter(pending.keys(), dtype=np.uint64, count=len(pending))])
+            positions = np.concatenate([self._sorted_positions[band],
+                                        np.fromiter(pending.values(), dtype=np.int64, count=len(pending))])
+            order = np.argsort(keys, kind="stable")
+            self._sorted_keys[band] = keys[order]
+            self._sorted_positions[band] = positions[order]
+            self._pending[band] = {}
+
+    def _sorted_candidates(self, keys):
+        """ソート済み配列からバンドキーが一致する既存チャンクの位置を探す（なければ-1）"""
+        candidates = np.full(keys.shape, -1, dtype=np.int64)
+        for band in range(NUM_BANDS):
+            sorted_keys = self._sorted_keys[band]
+            if not len(sorted_keys):
+                continue
+            found = np.searchsorted(sorted_keys, keys[:, band])
+            found = np.minimum(found, len(sorted_keys) - 1)
+            hit = sorted_keys[found] == keys[:, band]
+            candidates[hit, band] = self._sorted_positions[band][found[hit]]
+        return candidates
+
+    def add_signatures(self, chunk_ids, signatures):
+        """
+        署名を計算済みのチャンクを追加する（登録済みのIDは無視する）
+
+        Returns:
+        --------
+        int
+            既存のチャンクの近似重複と判定された件数
+        """
+        with self._lock:
+            keep = []
+            seen = set()
+            for i, chunk_id in enumerate(chunk_ids):
+                if chunk_id not in self._positions and chunk_id not in seen:
+                    seen.add(chunk_id)
+                    keep.append(i)
+            if not keep:
+                return 0
+            chunk_ids = [chunk_ids[i] for i in keep]
+            signatures = np.asarray(signatures, dtype=np.uint16)[keep]
+
+            first = len(self.ids)
+            keys = band_keys(signatures)
+            sorted_candidates = self._sorted_candidates(keys)
+            self._reserve(first + len(chunk_ids))
+            self._signatures[first:first + len(chunk_ids)] = signatures
+            self._clusters[first:first + len(chunk_ids)] = np.arange(first, first + len(chunk_ids))
+            self.ids.extend(chunk_ids)
+
+            duplicates = 0
+            key_rows = keys.tolist()
+            candidate_rows = sorted_candidates.tolist()
+            for i, (key_row, candidate_row) in enumerate(zip(key_rows, candidate_rows)):
+                position = first + i
+                self._positions[chunk_ids[i]] = position
+                candidates = {candidate for candidate in candidate_row if candidate >= 0}
+                for band, key in enumerate(key_row):
+                    pending = self._pending[band]
+                    candidate = pending.get(key)
+                    if candidate is not None:
+                        candidates.add(candidate)
+                    elif candidate_row[band] < 0:
+                        pending[key] = position
+                if candidates:
+                    candidates = list(candidates)
+                    similarities = estimate_similarity(signatures[i], self.signatures[candidates])
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        self._clusters[position] = self._clusters[candidates[best]]
+                        duplicates += 1
+
+            if len(self._pending[0]) >= PENDING_FLUSH_SIZE:
+                self._flush_pending()
+            return duplicates
+
+    def add(self, chunk_ids, texts):
+        """チャンクのIDと本文を追加する。取り込み処理から呼ぶ"""
+        return self.add_signatures(list(chunk_ids), compute_signatures(list(texts)))
+
+    def cluster_of(self, chunk_id):
+        position = self._positions.get(chunk_id)
+        return None if position is None else int(self.clusters[position])
+
+    def signature_of(self, chunk_id):
+        position = self._positions.get(chunk_id)
+        return None if position is None else self.signatures[position]
+
+    def save(self, path=NEAR_DUPLICATE_INDEX_PATH):
+        """署名・クラスタ・IDを保存する（LSHのキーは読み込み時に署名から作り直す）"""
+        with self._lock:
+            ids = np.frombuffer("\n".join(self.ids).encode("utf-8"), dtype=np.uint8)
+            np.savez(path, signatures=self.signatures, clusters=self.clusters.astype(np.int32),
+                     ids=ids, threshold=np.float32(self.threshold))
+
+    @classmethod
+    def load(cls, path=NEAR_DUPLICATE_INDEX_PATH):
+        data = np.load(path)
+        index = cls(threshold=float(data["threshold"]))
+        raw_ids = data["ids"].tobytes().decode("utf-8")
+        index.ids = raw_ids.split("\n") if raw_ids else []
+        index._signatures = data["signatures"]
+        index._clusters = data["clusters"].astype(np.int64)
+        index._positions = {chunk_id: position for position, chunk_id in enumerate(index.ids)}
+
+        # 各バンドでキーが最初に現れた位置だけをソート済み配列にする
+        keys = band_keys(index.signatures)
+        for band in range(NUM_BANDS):
+            unique_keys, first_positions = np.unique(keys[:, band], return_index=True)
+            index._sorted_keys[band] = unique_keys
+            index._sorted_positions[band] = first_positions.astype(np.int64)
+        return index
+
+def collapse_near_duplicates(docs, k=None, index=None, threshold=DUPLICATE_THRESHOLD):
+    """
+    検索結果のチャンクから近似重複を除き、順位の高いものを残す
+
+    Parameters:
+    -----------
+    docs : list
+        検索結果のDocument（順位順）
+    k : int, optional
+        残す件数の上限
+    index : NearDuplicateIndex, optional
+        登録済みのチャンクはクラスタと署名を再利用する（未登録のチャンクは署名をその場で計算する）
+    threshold : float
+        近似重複とみなす推定Jaccard係数
+    """
+    if not docs:
+        return docs
+    doc_ids = [document_id(doc) for doc in docs]
+    signatures = [index.signature_of(doc_id) if index is not None else None for doc_id in doc_ids]
+    missing = [i for i, signature in enumerate(signatures) if signature is None]
+    if missing:
+        computed = compute_signatures([docs[i].page_content for i in missing])
+        for i, signature in zip(missing, computed):
+            signatures[i] = signature
+
+    kept = []
+    kept_clusters = set()
+    collapsed = 0
+    for i, doc in enumerate(docs):
+        cluster = index.cluster_of(doc_ids[i]) if index is not None else None
+        duplicate = cluster is not None and cluster in kept_clusters
+        if not duplicate and kept:
+            duplicate = estimate_similarity(signatures[i], [signatures[j] for j in kept]).max() >= threshold
+        if duplicate:
+            collapsed += 1
+            continue
+        kept.append(i)
+        if cluster is not None:
+            kept_clusters.add(cluster)
+        if k is not None and len(kept) >= k:
+            break
+    if collapsed:
+        print(f"近似重複のチャンクを除外: {collapsed}件")
+    return [docs[i] for i in kept]
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+def get_near_duplicate_index():
+    """保存済みのインデックスがあれば読み込んで返す（1回だけ読み込む）。なければNone"""
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            _index_loaded = True
+            if os.path.exists(NEAR_DUPLICATE_INDEX_PATH):
+                try:
+                    _index = NearDuplicateIndex.load(NEAR_DUPLICATE_INDEX_PATH)
+                    print(f"近似重複インデックスを読み込みました: {len(_index)}件")
+                except Exception as e:
+                    print(f"近似重複インデックスの読み込みエラー: {e}")
+        return _index
+
+def chunk_id_of(metadata, text):
+    """Pineconeのメタデータからチャンクのキーを作る（検索時のdocument_idと同じ規則）"""
+    if metadata.get("id"):
+        return str(metadata["id"])
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+def build_from_index(index_name="raiden", path=NEAR_DUPLICATE_INDEX_PATH, batch_size=1000):
+    """raidenインデックスのチャンクのうち未登録のものを追加して保存する"""
+    from pinecone import Pinecone
+    from raiden.chatbot_utils import PINECONE_API_KEY, iter_index_vectors
+
+    index = NearDuplicateIndex.load(path) if os.path.exists(path) else NearDuplicateIndex()
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    pinecone_index = pc.Index(index_name)
+
+    start_time = time.time()
+    ids, texts = [], []
+    added = duplicates = 0
+    for _, _, metadata in iter_index_vectors(pinecone_index):
+        text = metadata.get("text") or ""
+        chunk_id = chunk_id_of(metadata, text)
+        if not text or chunk_id in index:
+            continue
+        ids.append(chunk_id)
+        texts.append(text)
+        if len(ids) >= batch_size:
+            duplicates += index.add(ids, texts)
+            added += len(ids)
+            ids, texts = [], []
+    if ids:
+        duplicates += index.add(ids, texts)
+        added += len(ids)
+    index.save(path)
+    print(f"近似重複インデックスを保存しました: {path} (追加 {added}件, うち近似重複 {duplicates}件, "
+          f"合計 {len(index)}件, {time.time() - start_time:.1f}秒)")
+    return index
+
+def _synthetic_corpus(chunks, duplicate_ratio=0.1, length=200, seed=0):
+    """ランダムな日本語の文字列と、その一部を書き換えた近似重複からなる合成コーパス"""
+    rng = np.random.default_rng(seed)
+    alphabet = np.concatenate([np.arange(0x3041, 0x3097), np.arange(0x30A1, 0x30FB), np.arange(0x4E00, 0x4E00 + 2000)])
+    alphabet = alphabet.astype(np.uint32)
+    texts = []
+    sources = []  # 近似重複の元のチャンクの位置（元でなければ-1）
+    for i in range(chunks):
+        if i > 0 and rng.random() < duplicate_ratio:
+            source = int(rng.integers(0, i))
+            codes = np.frombuffer(texts[source].encode("utf-32-le"), dtype=np.uint32).copy()
+            # 数文字だけ書き換える（転記ゆれ・改行位置の違いなどを想定）
+            edits = rng.integers(0, len(codes), size=max(1, len(codes) // 100))
+            codes[edits] = alphabet[rng.integers(0, len(alphabet), size=len(edits))]
+            texts.append(codes.tobytes().decode("utf-32-le"))
+            sources.append(source)
+        else:
+            codes = alphabet[rng.integers(0, len(alphabet), size=length)]
+            texts.append(codes.tobytes().decode("utf-32-le"))
+            sources.append(-1)
+    return texts, np.array(sources)
+
+def benchmark(chunks=1000000, batch_size=50000, duplicate_ratio=0.1, path="near_duplicates_benchmark.npz"):
+    """
+    合成コーパスで構築速度・検出率・メモリと保存サイズ・読み込み時間・検索時の除外の時間を計測する
+    """
+    start = time.perf_counter()
+    texts, sources = _synthetic_corpus(chunks, duplicate_ratio)
+    print(f"合成コーパス: {chunks:,}件 (近似重複 {int((sources >= 0).sum()):,}件) {time.perf_counter() - start:.1f}秒")
+
+    index = NearDuplicateIndex()
+    start = time.perf_counter()
+    signature_time = 0.0
+    for batch_start in range(0, chunks, batch_size):
+        batch_texts = texts[batch_start:batch_start + batch_size]
+        signature_start = time.perf_counter()
+        signatures = compute_signatures(batch_texts)
+        signature_time += time.perf_counter() - signature_start
+        index.add_signatures([f"chunk-{i}" for i in range(batch_start, batch_start + len(batch_texts))], signatures)
+    elapsed = time.perf_counter() - start
+    print(f"構築: {elapsed:.1f}秒 ({chunks / elapsed:,.0f}件/秒, うち署名計算 {signature_time:.1f}秒)")
+
+    planted = sources >= 0
+    detected = index.clusters != np.arange(chunks)
+    # 近似重複の元が別の近似重複の場合もあるので、同じクラスタに入ったかどうかで判定する
+    correct = index.clusters[planted] == index.clusters[sources[planted]]
+    print(f"検出: 再現率 {correct.mean():.4f}, 誤検出 {int((detected & ~planted).sum())}件")
+    print(f"メモリ: {index.nbytes / 1e6:.1f}MB")
+
+    index.save(path)
+    print(f"保存サイズ: {os.path.getsize(path) / 1e6:.1f}MB")
+    start = time.perf_counter()
+    loaded = NearDuplicateIndex.load(path)
+    print(f"読み込み: {time.perf_counter() - start:.2f}秒")
+
+    # 読み込んだ後に1件ずつ追加する場合（半分は既存チャンクと同じ本文、半分は新しい本文）
+    additions = 1000
+    start = time.perf_counter()
+    for i in range(additions):
+        loaded.add([f"extra-{i}"], [texts[i] if i % 2 else texts[i][::-1]])
+    print(f"1件ずつの追加: {(time.perf_counter() - start) / additions * 1000:.3f}ms/件")
+
+    # 検索時の除外（未登録の20チャンク、うち半分が近似重複）
+    from langchain_core.documents import Document
+    docs = []
+    for i in range(10):
+        docs.append(Document(page_content=texts[i]))
+        docs.append(Document(page_content=texts[i][:-2] + "追記"))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(100):
+            kept = collapse_near_duplicates(docs, 13)
+    print(f"検索時の除外: {(time.perf_counter() - start) * 10:.2f}ms/回 ({len(docs)}件 → {len(kept)}件)")
+    os.remove(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="ナレッジベースの近似重複インデックスを構築・計測します")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index", default="raiden", help="対象インデックス名")
+    parser.add_argument("--path", default=NEAR_DUPLICATE_INDEX_PATH, help="保存先")
+    parser.add_argument("--chunks", type=int, default=1000000, help="ベンチマークのチャンク数")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_from_index(args.index, args.path)
+    else:
+        benchmark(args.chunks)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,593 @@
+"""
+OpenAI呼び出しを共有のレート制限・同時実行制御の下で行うためのクライアント層
+モデルごとのトークンバケット（RPM・TPM）、429とレイテンシに応じたAIMDによる同時実行数の調整、
+ジッター付きリトライ、優先度レーン（対話 > バックグラウンド書き込み）を提供する
+
+ローカルの偽サーバーに対して試す場合は OPENAI_BASE_URL を設定すれば
+ChatOpenAI / OpenAIEmbeddings の接続先がそのサーバーになる。
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from raiden.deadline import current_deadline, record_timeout, DeadlineExceeded
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 優先度レーン（値が小さいほど優先）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# 現在のリクエストの優先度レーン
+_current_priority = ContextVar("raiden_openai_priority", default=PRIORITY_INTERACTIVE)
+
+# バックグラウンドレーンが使わずに残しておくバケット容量の割合
+BACKGROUND_RESERVE_RATIO = 0.2
+
+# リトライ設定
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1.0  # 秒
+RETRY_MAX_DELAY = 60.0  # 秒
+
+# リクエストのデッドラインまでにこれだけの時間が残っていなければ、呼び出し・リトライを行わない
+MIN_ATTEMPT_SECONDS = 1.0
+
+# モデルごとの既定の制限値（OpenAIの利用ティアに合わせてRAIDEN_RATE_LIMITSで上書きできる）
+DEFAULT_MODEL_LIMITS = {
+    "gpt-4": {"rpm": 500, "tpm": 10000, "max_concurrency": 8},
+    "gpt-4-turbo": {"rpm": 500, "tpm": 30000, "max_concurrency": 8},
+    "text-embedding-3-small": {"rpm": 3000, "tpm": 1000000, "max_concurrency": 16},
+}
+FALLBACK_MODEL_LIMITS = {"rpm": 500, "tpm": 10000, "max_concurrency": 8}
+
+# 応答トークン数の見積もり（実際の使用量が分かれば後から補正する）
+DEFAULT_COMPLETION_TOKENS = 500
+
+
+def get_priority():
+    """現在のコンテキストの優先度レーンを返す"""
+    return _current_priority.get()
+
+
+@contextmanager
+def priority_lane(priority):
+    """
+    ブロック内のOpenAI呼び出しを指定した優先度レーンで実行する
+
+    スレッドプールのワーカーにはコンテキストが引き継がれないため、ワーカー関数の中で使うこと。
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def is_rate_limit_error(error):
+    """429（レート制限）由来の例外かどうかを判定する"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    if type(error).__name__ == "RateLimitError":
+        return True
+    return "rate limit" in str(error).lower()
+
+
+def is_retryable_error(error):
+    """リトライすれば成功する可能性のある一時的なエラーかどうかを判定する"""
+    if is_rate_limit_error(error):
+        return True
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError", "InternalServerError"):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and status_code >= 500
+
+
+def retry_after_seconds(error):
+    """レスポンスヘッダのRetry-Afterがあれば秒数を返す"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """ジッター付き指数バックオフの待ち時間（秒）。Retry-Afterがあればそれを下限にする"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    retry_after = retry_after_seconds(error) if error is not None else None
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def estimate_tokens(text):
+    """トークン数の概算（日本語は概ね1文字1トークン以下なので文字数で見積もる）"""
+    return max(1, len(text))
+
+
+class TokenBucket:
+    """
+    1分あたりの上限を持つトークンバケット
+
+    バックグラウンドレーンは容量のBACKGROUND_RESERVE_RATIOを残すまでしか消費できないので、
+    バーストしても対話リクエストの分が確保される。
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0  # 1秒あたりの補充量
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        必要な量が貯まるまで待ってから消費する
+
+        Returns:
+        --------
+        float or None
+            消費した量（補正や返却に使う）。timeout秒以内に貯まらなければNone
+        """
+        reserve = self.capacity * BACKGROUND_RESERVE_RATIO if priority > PRIORITY_INTERACTIVE else 0.0
+        # 容量から残す分を引いた量を超える要求はいつまでも満たされないので、その量で頭打ちにする
+        amount = min(float(amount), self.capacity - reserve)
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens - amount >= reserve:
+                    self._tokens -= amount
+                    return amount
+                wait = (amount + reserve - self._tokens) / self.rate
+            if give_up_at is not None:
+                left = give_up_at - time.monotonic()
+                # 待っても間に合わないことが分かっていれば、その場で諦める
+                if left <= 0 or wait > left:
+                    return None
+                wait = min(wait, left)
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, delta):
+        """見積もりと実際の使用量の差を反映する（正なら追加消費、負なら返却）"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - delta)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMDで上限を調整する同時実行数リミッター
+
+    成功するたびに上限を少しずつ増やし（加算増加）、429を受けたら半分に、
+    レイテンシが目標を超えたら1割減らす（乗算減少）。
+    待っているリクエストは優先度レーン順、同じレーン内では到着順に実行される。
+    """
+
+    def __init__(self, initial, min_limit=1, max_limit=64, latency_target=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """枠が空くまで待つ。timeout秒以内に空かなければ待ち行列から外れてFalseを返す"""
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, ticket)
+            while self._waiters[0] != ticket or self._in_flight >= max(self.min_limit, self.limit):
+                left = give_up_at - time.monotonic() if give_up_at is not None else None
+                if left is not None and left <= 0:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    # 先頭で待っていた場合は、次のリクエストに順番を譲る
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(left)
+            heapq.heappop(self._waiters)
+            self._in_flight += 1
+            self._cond.notify_all()
+            return True
+
+    def release(self, latency=None, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self._limit = max(self.min_limit, self._limit / 2)
+            elif self.latency_target is not None and latency is not None and latency > self.latency_target:
+                self._limit = max(self.min_limit, self._limit * 0.9)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / max(self._limit, 1))
+            self._cond.notify_all()
+
+
+class ModelLimiter:
+    """1つのモデルに対するRPM・TPMのバケットと同時実行数リミッターの組"""
+
+    def __init__(self, model, rpm, tpm, max_concurrency, latency_target=None):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveConcurrency(
+            initial=max(1, max_concurrency // 2),
+            max_limit=max_concurrency,
+            latency_target=latency_target,
+        )
+        self.stats = {"calls": 0, "throttled": 0, "retries": 0, "failures": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _acquire(self, estimated_tokens, priority, deadline):
+        """
+        1回の試行の前にレート制限と同時実行数の枠を確保する
+        （デッドラインがあれば、試行の時間を残して待てる間だけ待ち、間に合わなければDeadlineExceededを投げる）
+        """
+        stage = f"openai:{self.model}"
+        if deadline is not None:
+            deadline.check(stage, MIN_ATTEMPT_SECONDS)
+
+        def wait_left():
+            return None if deadline is None else max(0.0, deadline.remaining() - MIN_ATTEMPT_SECONDS)
+
+        taken_requests = self.requests.acquire(1, priority, wait_left())
+        taken_tokens = None
+        if taken_requests is not None:
+            taken_tokens = self.tokens.acquire(estimated_tokens, priority, wait_left())
+        if taken_tokens is not None and self.concurrency.acquire(priority, wait_left()):
+            return
+        # 確保できた分は返してから諦める
+        if taken_requests is not None:
+            self.requests.adjust(-taken_requests)
+        if taken_tokens is not None:
+            self.tokens.adjust(-taken_tokens)
+        self._count("failures")
+        record_timeout(stage)
+        raise DeadlineExceeded(f"{stage}: レート制限の枠を待つ時間が残っていません（残り {deadline.remaining():.1f}秒）")
+
+    def _retry_delay(self, error, attempt, deadline):
+        """
+        失敗した試行の枠を返し、リトライまでの待ち時間を返す。リトライしない場合はNone
+        （デッドラインまでにリトライする時間がなければDeadlineExceededを投げる）
+        """
+        throttled = is_rate_limit_error(error)
+        self.concurrency.release(throttled=throttled)
+        if throttled:
+            self._count("throttled")
+        if not is_retryable_error(error) or attempt == MAX_RETRIES - 1:
+            self._count("failures")
+            return None
+        delay = backoff_delay(attempt, error)
+        if deadline is not None and not deadline.allows(delay + MIN_ATTEMPT_SECONDS):
+            self._count("failures")
+            record_timeout(f"openai:{self.model}")
+            raise DeadlineExceeded(
+                f"openai:{self.model}: リトライする時間が残っていません（残り {deadline.remaining():.1f}秒）"
+            ) from error
+        self._count("retries")
+        logger.warning(f"{self.model} 呼び出しをリトライします ({attempt + 1}/{MAX_RETRIES}, {delay:.1f}秒後): {error}")
+        return delay
+
+    def _finish(self, result, started, estimated_tokens, usage_tokens):
+        """成功した試行の枠を返し、実際の使用トークン数でTPMを補正する"""
+        self.concurrency.release(latency=time.monotonic() - started)
+        self._count("calls")
+        if usage_tokens is not None:
+            actual = usage_tokens(result)
+            if actual:
+                self.tokens.adjust(actual - estimated_tokens)
+        return result
+
+    def call(self, fn, estimated_tokens=1, priority=None, usage_tokens=None):
+        """
+        レート制限と同時実行制御の下でfnを実行する。一時的なエラーはジッター付きでリトライする。
+
+        Parameters:
+        -----------
+        fn : callable
+            引数なしで呼び出すOpenAI呼び出し
+        estimated_tokens : int
+            消費トークン数の見積もり
+        priority : int, optional
+            優先度レーン（省略時は現在のコンテキストのレーン）
+        usage_tokens : callable, optional
+            fnの戻り値から実際の使用トークン数を取り出す関数（TPMの補正に使う）
+        """
+        if priority is None:
+            priority = get_priority()
+        # リクエストのデッドラインは試行ごとに確かめる（リトライで予算を超えないようにする）
+        deadline = current_deadline()
+
+        for attempt in range(MAX_RETRIES):
+            self._acquire(estimated_tokens, priority, deadline)
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            return self._finish(result, started, estimated_tokens, usage_tokens)
+
+    async def acall(self, fn, estimated_tokens=1, priority=None, usage_tokens=None):
+        """
+        callの非同期版。fnはコルーチンを返す引数なしの関数。
+        枠の確保はスレッドで待つので、待っている間もイベントループを止めない。
+        """
+        if priority is None:
+            priority = get_priority()
+        deadline = current_deadline()
+
+        for attempt in range(MAX_RETRIES):
+            await asyncio.to_thread(self._acquire, estimated_tokens, priority, deadline)
+            started = time.monotonic()
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            return self._finish(result, started, estimated_tokens, usage_tokens)
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["concurrency_limit"] = self.concurrency.limit
+        stats["in_flight"] = self.concurrency.in_flight
+        return stats
+
+
+def _load_model_limits():
+    """既定の制限値に環境変数RAIDEN_RATE_LIMITS（JSON）の設定を重ねる"""
+    limits = {model: dict(values) for model, values in DEFAULT_MODEL_LIMITS.items()}
+    override = os.getenv("RAIDEN_RATE_LIMITS")
+    if override:
+        try:
+            for model, values in json.loads(override).items():
+                limits.setdefault(model, dict(FALLBACK_MODEL_LIMITS)).update(values)
+        except (ValueError, AttributeError) as e:
+            logger.error(f"RAIDEN_RATE_LIMITSの読み込みエラー: {e}")
+    return limits
+
+
+_model_limits = _load_model_limits()
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model):
+    """モデルごとのリミッターを返す（プロセス内で共有される）"""
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            limits = _model_limits.get(model, FALLBACK_MODEL_LIMITS)
+            limiter = ModelLimiter(
+                model,
+                rpm=limits["rpm"],
+                tpm=limits["tpm"],
+                max_concurrency=limits["max_concurrency"],
+                latency_target=limits.get("latency_target"),
+            )
+            _limiters[model] = limiter
+        return limiter
+
+
+def get_rate_limit_stats():
+    """全モデルの呼び出し数・429の回数・現在の同時実行上限などを返す"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {model: limiter.snapshot() for model, limiter in limiters.items()}
+
+
+def _chat_usage_tokens(result):
+    usage = (getattr(result, "llm_output", None) or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """共有のリミッターを通してリクエストするChatOpenAI（リトライはリミッター側で行う）"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("max_retries", 0)
+        super().__init__(**kwargs)
+
+    def _request_kwargs(self, kwargs):
+        # リクエストのデッドラインがあれば、試行ごとにその時点の残り時間をタイムアウトにする
+        # （超過の判定はリミッター側で試行ごとに行う）
+        call_kwargs = dict(kwargs)
+        deadline = current_deadline()
+        if deadline is not None and "timeout" not in kwargs:
+            call_kwargs["timeout"] = max(MIN_ATTEMPT_SECONDS, deadline.remaining())
+        return call_kwargs
+
+    def _estimate(self, messages):
+        prompt_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+        return prompt_tokens + (self.max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return get_limiter(self.model_name).call(
+            lambda: super(RateLimitedChatOpenAI, self)._generate(
+                messages, stop=stop, run_manager=run_manager, **self._request_kwargs(kwargs)
+            ),
+            estimated_tokens=self._estimate(messages),
+            usage_tokens=_chat_usage_tokens,
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await get_limiter(self.model_name).acall(
+            lambda: super(RateLimitedChatOpenAI, self)._agenerate(
+                messages, stop=stop, run_manager=run_manager, **self._request_kwargs(kwargs)
+            ),
+            estimated_tokens=self._estimate(messages),
+            usage_tokens=_chat_usage_tokens,
+        )
+
+
+class RateLimitedOpenAIEmbeddings(OpenAIEmbeddings):
+    """共有のリミッターを通してリクエストするOpenAIEmbeddings"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("max_retries", 0)
+        super().__init__(**kwargs)
+
+    def embed_documents(self, texts, chunk_size=0):
+        estimated = sum(estimate_tokens(text) for text in texts)
+        return get_limiter(self.model).call(
+            lambda: super(RateLimitedOpenAIEmbeddings, self).embed_documents(texts, chunk_size),
+            estimated_tokens=estimated,
+        )
+
+    def embed_query(self, text):
+        # 親クラスのembed_queryはembed_documentsを呼ぶので、ここでは二重に制限しない
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts, chunk_size=0):
+        estimated = sum(estimate_tokens(text) for text in texts)
+        return await get_limiter(self.model).acall(
+            lambda: super(RateLimitedOpenAIEmbeddings, self).aembed_documents(texts, chunk_size),
+            estimated_tokens=estimated,
+        )
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+if __name__ == "__main__":
+    # 429を返す偽のAPIに対してAIMDとリトライの挙動を確認する
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    class FakeRateLimitError(Exception):
+        status_code = 429
+
+    class FakeServer:
+        """同時に受け付けられるリクエスト数を超えると429を返す偽サーバー"""
+
+        def __init__(self, capacity):
+            self.capacity = capacity
+            self.active = 0
+            self.lock = threading.Lock()
+
+        def request(self):
+            with self.lock:
+                if self.active >= self.capacity:
+                    raise FakeRateLimitError("rate limit exceeded")
+                self.active += 1
+            try:
+                time.sleep(0.05)
+                return "ok"
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    server = FakeServer(capacity=4)
+    limiter = ModelLimiter("fake-model", rpm=6000, tpm=600000, max_concurrency=16)
+    RETRY_BASE_DELAY = 0.05
+
+    def worker(priority):
+        with priority_lane(priority):
+            return limiter.call(server.request, estimated_tokens=10)
+
+    threads = [
+        threading.Thread(target=worker, args=(PRIORITY_BACKGROUND if i % 2 else PRIORITY_INTERACTIVE,))
+        for i in range(100)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"処理時間: {time.time() - start:.2f}秒")
+    print(f"統計: {limiter.snapshot()}")
+
+    # デッドラインを超えてリトライしないこと（タイムアウトし続ける呼び出しでも予算内に打ち切る）
+    from raiden.deadline import deadline_scope
+
+    class APITimeoutError(Exception):
+        """openaiのAPITimeoutErrorと同じ名前の偽の例外（リトライ対象になる）"""
+
+    def always_timeout():
+        time.sleep(0.2)
+        raise APITimeoutError("timed out")
+
+    start = time.time()
+    try:
+        with deadline_scope(1.5):
+            limiter.call(always_timeout)
+    except DeadlineExceeded as e:
+        print(f"デッドラインで打ち切り: {time.time() - start:.2f}秒 ({e})")
+    assert time.time() - start < 1.5, "デッドラインを超えてリトライしています"
+
+    # 非同期の呼び出しも同じリミッターを通ること
+    async def async_request():
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def async_workers():
+        return await asyncio.gather(*(limiter.acall(async_request, estimated_tokens=10) for _ in range(20)))
+
+    calls_before = limiter.snapshot()["calls"]
+    assert asyncio.run(async_workers()) == ["ok"] * 20
+    assert limiter.snapshot()["calls"] == calls_before + 20
+    print(f"非同期呼び出し: {limiter.snapshot()}")
+
+    # バックグラウンドレーンで容量の8割を超える見積もりでも、満タンのバケットからすぐに取得できること
+    bucket = TokenBucket(10000)
+    start = time.time()
+    bucket.acquire(9000, PRIORITY_BACKGROUND)
+    assert time.time() - start < 0.5, "バックグラウンドレーンの大きな要求が待たされています"
+    print(f"バックグラウンドの大きな要求: {time.time() - start:.3f}秒で取得")
+
+    # 枠が空かないまま締め切りが近づいたら、待ち続けずに打ち切って待ち行列から外れること
+    busy = ModelLimiter("busy-model", rpm=6000, tpm=600000, max_concurrency=1)
+    busy.concurrency.acquire()
+    start = time.time()
+    try:
+        with deadline_scope(1.5):
+            busy.call(lambda: "ok")
+    except DeadlineExceeded as e:
+        print(f"枠待ちを打ち切り: {time.time() - start:.2f}秒 ({e})")
+    assert time.time() - start < 1.5, "デッドラインを超えて枠を待っています"
+    assert not busy.concurrency._waiters, "打ち切った待ちが待ち行列に残っています"
+    busy.concurrency.release()
+    assert busy.call(lambda: "ok") == "ok"
@@ -0,0 +1,280 @@
+"""
+リクエスト単位のサンプリングプロファイラー
+有効になったリクエストの処理中だけ、関わったスレッドのスタックを一定間隔で採取し、
+flamegraph.pl や speedscope で読める collapsed stack 形式（.folded）で保存する
+
+有効にする方法:
+    - リクエストヘッダー X-Raiden-Profile: 1（X-Raiden-Admin-Token に RAIDEN_ADMIN_TOKEN の値も必要）
+    - 管理用API POST /admin/profiling {"enabled": true} または {"sample_rate": 0.05}
+      （ヘッダー X-Raiden-Admin-Token に RAIDEN_ADMIN_TOKEN の値が必要）
+    - 環境変数 RAIDEN_PROFILE_ALL=true / RAIDEN_PROFILE_SAMPLE_RATE=0.05
+
+無効のときは、@profiledを付けた関数の呼び出しごとにContextVarを1回読むだけで済む。
+"""
+
+import functools
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from pydantic import BaseModel
+
+# プロファイルの保存先と、残しておくファイル数の上限
+PROFILE_DIR = os.getenv("RAIDEN_PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("RAIDEN_PROFILE_MAX_FILES", "50"))
+
+# スタックを採取する間隔（秒）
+PROFILE_INTERVAL = float(os.getenv("RAIDEN_PROFILE_INTERVAL", "0.005"))
+
+# リクエストごとにプロファイルを要求するヘッダーと、管理用トークンのヘッダー
+PROFILE_HEADER = "x-raiden-profile"
+ADMIN_TOKEN_HEADER = "x-raiden-admin-token"
+
+# 管理用APIのトークン（未設定なら管理用APIは使えない）
+ADMIN_TOKEN = os.getenv("RAIDEN_ADMIN_TOKEN")
+
+_settings = {
+    "enabled": os.getenv("RAIDEN_PROFILE_ALL", "false").lower() == "true",
+    "sample_rate": float(os.getenv("RAIDEN_PROFILE_SAMPLE_RATE", "0")),
+}
+
+_current_session = ContextVar("raiden_profile_session", default=None)
+_requested = ContextVar("raiden_profile_requested", default=False)
+
+class ProfileSession:
+    """
+    1リクエスト分のプロファイル。処理に関わっているスレッドを登録し、そのスタックだけを数える
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.stacks = Counter()
+        self.samples = 0
+        self._threads = {}  # スレッドID -> 登録数（同じスレッドで入れ子に呼ばれる場合がある）
+        self._lock = threading.Lock()
+
+    def enter_thread(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] = self._threads.get(thread_id, 0) + 1
+
+    def exit_thread(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            count = self._threads.get(thread_id, 0) - 1
+            if count > 0:
+                self._threads[thread_id] = count
+            else:
+                self._threads.pop(thread_id, None)
+
+    def record(self, frames, thread_names):
+        with self._lock:
+            thread_ids = list(self._threads)
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame, thread_names.get(thread_id, str(thread_id)))] += 1
+        self.samples += 1
+
+def _collapse(frame, thread_name):
+    """フレームを「スレッド名;外側の関数;...;内側の関数」の1行にする"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != __file__:
+            filename = "/".join(code.co_filename.replace("\\", "/").split("/")[-2:])
+            names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    # スレッドプールの番号は除いて、同じ種類のスレッドをまとめる
+    names.append(re.sub(r"[_-]?\d+$", "", thread_name))
+    return ";".join(reversed(names))
+
+_active_sessions = set()
+_sampler_lock = threading.Lock()
+_sampler_thread = None
+
+def _sampler_loop():
+    global _sampler_thread
+    while True:
+        with _sampler_lock:
+            sessions = list(_active_sessions)
+            if not sessions:
+                _sampler_thread = None
+                return
+        frames = sys._current_frames()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for session in sessions:
+            session.record(frames, thread_names)
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def _start_sampling(session):
+    global _sampler_thread
+    with _sampler_lock:
+        _active_sessions.add(session)
+        if _sampler_thread is None:
+            _sampler_thread = threading.Thread(target=_sampler_loop, name="raiden-profiler", daemon=True)
+            _sampler_thread.start()
+
+def _stop_sampling(session):
+    with _sampler_lock:
+        _active_sessions.discard(session)
+
+def write_profile(session, directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+    """
+    プロファイルを.foldedファイルに書き出し、古いファイルを上限まで削除する
+
+    Returns:
+    --------
+    str or None
+        書き出したファイルのパス。サンプルがなければNone
+    """
+    if not session.stacks:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    elapsed_ms = int((time.time() - session.started) * 1000)
+    timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started))
+    path = os.path.join(directory, f"{timestamp}-{elapsed_ms}ms-{session.name}-{id(session):x}.folded")
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in session.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    profiles = sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".folded")),
+        key=os.path.getmtime,
+    )
+    for old in profiles[:max(0, len(profiles) - max_files)]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    print(f"プロファイルを保存しました: {path} ({session.samples}サンプル, {elapsed_ms}ms)")
+    return path
+
+@contextmanager
+def profile_session(name):
+    """ブロックの処理をプロファイルし、終了時にファイルへ書き出す"""
+    session = ProfileSession(name)
+    token = _current_session.set(session)
+    session.enter_thread()
+    _start_sampling(session)
+    try:
+        yield session
+    finally:
+        session.exit_thread()
+        _stop_sampling(session)
+        _current_session.reset(token)
+        try:
+            write_profile(session)
+        except Exception as e:
+            print(f"プロファイルの書き出しエラー: {e}")
+
+def _should_profile():
+    if _requested.get() or _settings["enabled"]:
+        return True
+    rate = _settings["sample_rate"]
+    return rate > 0 and random.random() < rate
+
+def profiled(name=None, root=False):
+    """
+    関数をプロファイルの対象にするデコレーター
+
+    Parameters:
+    -----------
+    name : str, optional
+        プロファイルの名前（デフォルトは関数名）
+    root : bool
+        Trueなら、プロファイル中でないときにこの関数からプロファイルを開始できる。
+        Falseの関数は、プロファイル中のリクエストから呼ばれたときに実行中のスレッドを採取対象に加える
+        （スレッドプールで実行される処理もコンテキスト経由で同じリクエストのプロファイルに入る）
+    """
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = _current_session.get()
+            if session is None:
+                if root and _should_profile():
+                    with profile_session(label):
+                        return fn(*args, **kwargs)
+                return fn(*args, **kwargs)
+            session.enter_thread()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                session.exit_thread()
+
+        return wrapper
+    return decorator
+
+@contextmanager
+def requested_profile(request):
+    """
+    リクエストにX-Raiden-Profileヘッダーと正しい管理用トークンがあれば、ブロック内のroot関数でプロファイルを取る
+    （誰でもサンプリングとファイルの書き出しを起こせないよう、トークンがなければヘッダーを無視する）
+
+    Parameters:
+    -----------
+    request : gr.Request or starlette.requests.Request or None
+        ヘッダーを持つリクエスト
+    """
+    headers = getattr(request, "headers", None) or {}
+    if str(headers.get(PROFILE_HEADER, "")).lower() not in ("1", "true", "yes"):
+        yield
+        return
+    if not _valid_admin_token(headers.get(ADMIN_TOKEN_HEADER)):
+        print("管理用トークンがないため、プロファイルの要求を無視します")
+        yield
+        return
+    token = _requested.set(True)
+    try:
+        yield
+    finally:
+        _requested.reset(token)
+
+def _valid_admin_token(token):
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(str(token), ADMIN_TOKEN))
+
+def set_profiling(enabled=None, sample_rate=None):
+    """全リクエストのプロファイルの有効・無効とサンプリング率を切り替える"""
+    if enabled is not None:
+        _settings["enabled"] = bool(enabled)
+    if sample_rate is not None:
+        _settings["sample_rate"] = min(1.0, max(0.0, float(sample_rate)))
+    return get_profiling_status()
+
+def get_profiling_status():
+    with _sampler_lock:
+        active = len(_active_sessions)
+    return {**_settings, "active_sessions": active, "directory": PROFILE_DIR}
+
+class ProfilingSettings(BaseModel):
+    enabled: Optional[bool] = None
+    sample_rate: Optional[float] = None
+
+router = APIRouter()
+
+def _check_admin_token(token):
+    if not _valid_admin_token(token):
+        raise HTTPException(status_code=403, detail="管理用トークンが正しくありません")
+
+@router.get("/admin/profiling")
+def profiling_status(x_raiden_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_raiden_admin_token)
+    return get_profiling_status()
+
+@router.post("/admin/profiling")
+def update_profiling(settings: ProfilingSettings, x_raiden_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_raiden_admin_token)
+    return set_profiling(settings.enabled, settings.sample_rate)
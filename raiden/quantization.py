@@ -0,0 +1,169 @@
+"""
+ローカル類似検索用の埋め込み行列を省メモリで保持するモジュール
+float16 / int8（ベクトルごとのスケール付き）の量子化と、次元の切り詰めに対応する
+（text-embedding-3系は先頭の次元だけを使っても再正規化すれば検索に使える）
+
+float16はメモリを半分にするが、numpyではfloat32への展開が遅く検索が約8倍遅くなる
+（20000件・1536次元で1クエリあたりfloat32 8ms、float16 90ms、int8 38ms）。
+メモリを減らしたい場合は、int8と次元の切り詰めの組み合わせ（512次元で4ms）を優先する。
+検索の経路にあるローカルキャッシュ（raiden.local_cache）ではfloat16を受け付けない。
+
+ベンチマーク:
+    python -m raiden.quantization --rows 100000 --queries 200
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+PRECISIONS = ("float32", "float16", "int8")
+
+# float16・int8の内積をfloat32で計算するときに一度に展開する行数
+SCORE_CHUNK_ROWS = 8192
+
+def truncate_and_normalize(matrix, dimensions=None):
+    """先頭dimensions次元に切り詰めて行ごとに正規化する（dimensionsがNoneなら正規化のみ）"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dimensions is not None and dimensions < matrix.shape[-1]:
+        matrix = matrix[..., :dimensions]
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+class QuantizedMatrix:
+    """
+    精度を落として保持した埋め込み行列
+
+    Parameters:
+    -----------
+    codes : np.ndarray
+        (件数, 次元数) の行列。float32 / float16 / int8
+    scales : np.ndarray, optional
+        int8のときのベクトルごとのスケール（元の値 ≒ codes * scale）
+    dimensions : int, optional
+        切り詰めた次元数（クエリも同じ次元に切り詰める）
+    """
+
+    def __init__(self, codes, scales=None, dimensions=None):
+        self.codes = codes
+        self.scales = scales
+        self.dimensions = dimensions
+
+    @classmethod
+    def from_float(cls, matrix, precision="float32", dimensions=None):
+        """float32の行列を指定した精度に変換する"""
+        if precision not in PRECISIONS:
+            raise ValueError(f"未対応の精度です: {precision}")
+
+        # float32のまま切り詰めもしない場合は、メモリマップされた行列をコピーせずに使う
+        if precision == "float32" and dimensions is None:
+            return cls(matrix)
+
+        # 変換後の配列を先に確保し、SCORE_CHUNK_ROWS行ずつ変換して書き込む
+        # （メモリマップされたスナップショット全体のfloat32の一時配列を作らない）
+        rows, full_dimensions = matrix.shape
+        width = min(dimensions, full_dimensions) if dimensions is not None else full_dimensions
+        codes = np.empty((rows, width), dtype=precision)
+        scales = np.empty(rows, dtype=np.float32) if precision == "int8" else None
+        for start in range(0, rows, SCORE_CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+            if dimensions is not None:
+                chunk = truncate_and_normalize(chunk, dimensions)
+            if scales is None:
+                codes[start:start + SCORE_CHUNK_ROWS] = chunk
+                continue
+            chunk_scales = np.abs(chunk).max(axis=1) / 127.0
+            chunk_scales[chunk_scales == 0] = 1.0
+            codes[start:start + SCORE_CHUNK_ROWS] = np.round(chunk / chunk_scales[:, None])
+            scales[start:start + SCORE_CHUNK_ROWS] = chunk_scales
+        return cls(codes, scales, dimensions)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def prepare_query(self, embedding):
+        """クエリを行列と同じ次元に切り詰めて正規化する"""
+        return truncate_and_normalize(embedding, self.dimensions)
+
+    def scores(self, query):
+        """正規化済みのクエリとの内積（コサイン類似度）を返す"""
+        if self.codes.dtype == np.float32:
+            return np.asarray(self.codes @ query, dtype=np.float32)
+        # float16・int8はBLASが使えるfloat32へチャンクごとに展開して計算する
+        # （一度に全行を展開しないのでメモリ使用量は増えない）。
+        # numpyのfloat16→float32の変換は遅く、float16の検索はfloat32の約8倍の時間がかかる
+        result = np.empty(self.codes.shape[0], dtype=np.float32)
+        buffer = np.empty((min(SCORE_CHUNK_ROWS, self.codes.shape[0]), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, self.codes.shape[0], SCORE_CHUNK_ROWS):
+            chunk = self.codes[start:start + SCORE_CHUNK_ROWS]
+            expanded = buffer[:len(chunk)]
+            np.copyto(expanded, chunk)
+            result[start:start + SCORE_CHUNK_ROWS] = expanded @ query
+        if self.scales is not None:
+            result *= self.scales
+        return result
+
+    def top_k(self, query, k):
+        """類似度の高い順に (位置, スコア) の配列を返す"""
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+def benchmark(rows=100000, dimension=1536, queries=200, k=10, seed=0):
+    """
+    float32を基準に、各精度・次元数でのrecall@kとメモリ使用量・検索時間を比較する
+
+    合成データはクラスタ構造を持たせた乱数で、text-embedding-3のように先頭の次元ほど
+    分散が大きくなるよう重み付けしている。切り詰めの再現率は実データで確認すること。
+    """
+    rng = np.random.default_rng(seed)
+    weights = (1.0 / np.sqrt(np.arange(1, dimension + 1))).astype(np.float32)
+    centers = rng.normal(size=(max(1, rows // 50), dimension)).astype(np.float32)
+    assignments = rng.integers(0, len(centers), size=rows)
+    noise = rng.normal(size=(rows, dimension)).astype(np.float32)
+    data = truncate_and_normalize((centers[assignments] + 0.5 * noise) * weights)
+    query_rows = rng.integers(0, rows, size=queries)
+    query_noise = rng.normal(size=(queries, dimension)).astype(np.float32)
+    query_vectors = truncate_and_normalize(data[query_rows] + 0.3 * query_noise * weights)
+
+    baseline = QuantizedMatrix.from_float(data)
+    expected = [set(baseline.top_k(query, k)[0].tolist()) for query in query_vectors]
+
+    settings = [("float32", None), ("float16", None), ("int8", None),
+                ("float32", 512), ("float16", 512), ("int8", 512), ("int8", 256)]
+    print(f"rows={rows}, dimension={dimension}, queries={queries}, recall@{k}")
+    print(f"{'precision':>10} {'dims':>6} {'MB':>10} {'bytes/vec':>10} {'recall':>8} {'ms/query':>9}")
+    results = []
+    for precision, dimensions in settings:
+        matrix = QuantizedMatrix.from_float(data, precision, dimensions)
+        start = time.perf_counter()
+        hits = 0
+        for query, truth in zip(query_vectors, expected):
+            found, _ = matrix.top_k(matrix.prepare_query(query), k)
+            hits += len(truth & set(found.tolist()))
+        elapsed = (time.perf_counter() - start) / queries * 1000
+        recall = hits / (k * queries)
+        results.append({"precision": precision, "dimensions": dimensions or dimension,
+                        "bytes": matrix.nbytes, "recall": recall, "ms_per_query": elapsed})
+        print(f"{precision:>10} {dimensions or dimension:>6} {matrix.nbytes / 1e6:>10.1f} "
+              f"{matrix.nbytes / rows:>10.0f} {recall:>8.3f} {elapsed:>9.2f}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="量子化した埋め込みの再現率とメモリ使用量を比較します")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.rows, args.dimension, args.queries, args.k)
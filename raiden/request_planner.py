@@ -0,0 +1,183 @@
+"""
+キャッシュ検索とナレッジ検索を並列に実行するリクエストプランナー
+質問の埋め込みを1回だけ計算し、raiden-cacheへの類似質問検索とraidenインデックスからの検索を同時に投げる。
+設定によってはLLMによる回答生成も投機的に開始し、キャッシュヒットが確定したら負けた処理を打ち切る。
+"""
+
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from raiden.chatbot_engine import chat, build_answer_prompt, CHAT_ERROR_MESSAGE
+from raiden.chatbot_utils import embedding_model, check_previous_responses, fetch_response_metadata, CACHE_INDEX_NAME
+from raiden.custom import RETRIEVAL_FETCH_K
+from raiden.openai_client import MIN_ATTEMPT_SECONDS
+from raiden.deadline import current_deadline, remaining_time, time_allows, record_timeout, record_degradation
+from raiden.profiling import profiled
+
+# ナレッジ検索で取得するチャンク数（ツールの検索の代わりに使えるよう、ツールが取得する件数と同じにする）
+KNOWLEDGE_SEARCH_K = RETRIEVAL_FETCH_K
+
+# キャッシュ確認の結果を待たずにLLMでの回答生成を始めるかどうか
+# （キャッシュヒット時はトークンが無駄になるので、ヒット率が低い環境向け）
+SPECULATIVE_LLM = os.getenv("RAIDEN_SPECULATIVE_LLM", "false").lower() == "true"
+
+# LLMでの回答生成を始めるのに必要な残り時間（秒）。足りなければ過去の回答で代替する
+MIN_LLM_SECONDS = 10
+
+# 時間切れ時に代替として返す過去の回答の最低類似度
+DEGRADED_MIN_SIMILARITY = 0.6
+
+# 代替回答に付ける注意書き
+DEGRADED_NOTICE = "※ 回答の生成に時間がかかっているため、類似した過去の質問「{question}」への回答を表示しています。内容が質問と異なる場合があります。"
+TIMEOUT_MESSAGE = "申し訳ありません。ただいま混み合っており、時間内に回答を生成できませんでした。もう一度質問してください。"
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="raiden-planner")
+
+class RequestCancelled(Exception):
+    """投機的に開始した処理がキャンセルされたことを表す例外"""
+
+class CancellationCallback(BaseCallbackHandler):
+    """
+    キャンセルが要求されたら、次のLLM呼び出しやツール実行の直前で例外を投げてエージェントを止める
+    """
+
+    raise_error = True
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def _check(self):
+        if self.cancel_event.is_set():
+            raise RequestCancelled("キャッシュヒットのため回答生成を中止しました")
+
+    def on_llm_start(self, *args, **kwargs):
+        self._check()
+
+    def on_chat_model_start(self, *args, **kwargs):
+        self._check()
+
+    def on_tool_start(self, *args, **kwargs):
+        self._check()
+
+def submit(fn, *args, **kwargs):
+    """呼び出し元のコンテキスト（優先度レーンなど）を引き継いでスレッドプールで実行する"""
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, fn, *args, **kwargs)
+
+@profiled()
+def retrieve_knowledge(index, embedding, k=KNOWLEDGE_SEARCH_K):
+    """計算済みの埋め込みでナレッジインデックスを検索する（再度の埋め込みは行わない）"""
+    return index.vectorstore.similarity_search_by_vector_with_score(embedding, k=k)
+
+def wait_result(future, stage, default):
+    """デッドラインまでfutureの結果を待つ。時間切れや失敗ならdefaultを返す"""
+    try:
+        return future.result(timeout=remaining_time())
+    except FuturesTimeoutError:
+        record_timeout(stage)
+    except Exception as e:
+        print(f"{stage} エラー: {e}")
+    return default
+
+def degraded_answer(cached_result, reason):
+    """
+    時間切れ時の代替回答。閾値未満でも十分近い過去の回答があれば注意書きを付けて返す
+    """
+    record_degradation(reason)
+    candidate = (cached_result or {}).get("best_candidate")
+    if candidate and candidate["similarity"] >= DEGRADED_MIN_SIMILARITY:
+        try:
+            metadata = fetch_response_metadata(candidate["id"], index_name=candidate["index_name"])
+        except Exception as e:
+            print(f"代替回答の取得エラー: {e}")
+            metadata = None
+        if metadata and metadata.get("question") and metadata.get("text"):
+            record_degradation("below_threshold_cache")
+            return DEGRADED_NOTICE.format(question=metadata["question"]) + "\n\n" + metadata["text"]
+    return TIMEOUT_MESSAGE
+
+def answer(message, history, index, speculative_llm=SPECULATIVE_LLM):
+    """
+    キャッシュ検索とナレッジ検索を並列に行い、質問に回答する
+
+    Parameters:
+    -----------
+    message : str
+        ユーザーの質問
+    history : ChatMessageHistory
+        会話履歴
+    index : VectorStoreIndexWrapper
+        ナレッジインデックス
+    speculative_llm : bool
+        キャッシュ確認を待たずにLLMでの回答生成を開始するかどうか
+
+    Returns:
+    --------
+    dict
+        {"answer": 回答, "from_cache": キャッシュヒットかどうか, "cached_result": キャッシュ検索結果,
+         "embedding": 質問の埋め込み（保存時に再利用する）, "degraded": 時間切れで代替回答を返したかどうか}
+    """
+    start_time = time.time()
+    embedding = embedding_model.embed_query(message)
+    print(f"埋め込み生成: {time.time() - start_time:.3f}秒")
+
+    cache_future = submit(check_previous_responses, message, CACHE_INDEX_NAME, embedding)
+    retrieval_future = submit(retrieve_knowledge, index, embedding)
+
+    cancel_event = threading.Event()
+    llm_future = None
+    if speculative_llm:
+        # 検索結果を待たずに開始するので、chat()側のログ用検索はそのまま行われる
+        llm_future = submit(
+            chat, build_answer_prompt(message), history, index,
+            callbacks=[CancellationCallback(cancel_event)],
+        )
+
+    cached_result = wait_result(cache_future, "cache_lookup", {"found": False})
+    print(f"キャッシュ検索完了: {time.time() - start_time:.3f}秒")
+
+    if cached_result.get("found"):
+        # 負けた処理を打ち切る（開始前ならキャンセル、実行中なら次の区切りで中止）
+        cancel_event.set()
+        retrieval_future.cancel()
+        if llm_future is not None:
+            llm_future.cancel()
+        return {"answer": cached_result["answer"], "from_cache": True, "cached_result": cached_result,
+                "embedding": embedding, "degraded": False}
+
+    result = {"answer": None, "from_cache": False, "cached_result": cached_result,
+              "embedding": embedding, "degraded": False}
+
+    # 回答生成に必要な時間が残っていなければ、LLMを呼ばずに代替回答を返す
+    if not time_allows(MIN_LLM_SECONDS):
+        cancel_event.set()
+        retrieval_future.cancel()
+        result.update(answer=degraded_answer(cached_result, "skip_llm"), degraded=True)
+        return result
+
+    if llm_future is not None:
+        bot_message = wait_result(llm_future, "llm", None)
+        if bot_message is None:
+            cancel_event.set()
+    else:
+        # 時間切れ・失敗時は空の結果を渡し、chat()側で検索をやり直さない
+        # ツール入力が質問と十分似ていれば、ツールの検索もこの結果で済ませる
+        search_results = wait_result(retrieval_future, "retrieval", [])
+        bot_message = chat(build_answer_prompt(message), history, index,
+                           search_results=search_results, search_embedding=embedding)
+
+    deadline = current_deadline()
+    # 残り時間が1回の試行に足りずにLLM呼び出しを打ち切った場合も、締め切り前なので代替回答にする
+    if bot_message is None or (bot_message == CHAT_ERROR_MESSAGE and deadline is not None
+                               and not deadline.allows(MIN_ATTEMPT_SECONDS)):
+        result.update(answer=degraded_answer(cached_result, "llm_timeout"), degraded=True)
+        return result
+
+    print(f"回答生成完了: {time.time() - start_time:.3f}秒")
+    result["answer"] = bot_message
+    return result
@@ -0,0 +1,135 @@
+"""
+複数のGradioアプリを1つのプロセス・1つのサーバーで配信するモジュール
+アプリごとにlaunch()するとサーバー・イベントループ・キューがアプリの数だけでき、
+ワーカースレッドも分かれてしまうので、1つのASGIアプリにまとめて配信する
+
+起動モード（環境変数 RAIDEN_SERVE_MODE）:
+    mount     1つのFastAPIアプリに各アプリをパスごとにマウントする（既定）。
+              共有するのはプロセス・サーバー・ワーカースレッドだけで、キューはBlocksごとに別のまま
+              （同時実行数と待ち行列の上限はアプリごとに効く）
+    tabs      1つのBlocksにタブとしてまとめる。キューも1つになり、上限は全アプリの合計に効く
+    separate  従来通りアプリごとにポートを分けてlaunch()する
+"""
+
+import contextlib
+import os
+import threading
+
+import anyio
+import gradio as gr
+import uvicorn
+from fastapi import FastAPI
+
+SERVE_MODES = ("mount", "tabs", "separate")
+SERVE_MODE = os.getenv("RAIDEN_SERVE_MODE", "mount")
+
+SERVER_NAME = os.getenv("RAIDEN_SERVER_NAME", "127.0.0.1")  # EC2では0.0.0.0を指定する
+SERVER_PORT = int(os.getenv("RAIDEN_SERVER_PORT", "7860"))
+
+# 全アプリ共通のキュー設定（イベントごとの同時実行数と待ち行列の上限）
+# mountモードでは各アプリのキューに同じ値を設定するので、上限はアプリごとに効く
+QUEUE_CONCURRENCY_LIMIT = int(os.getenv("RAIDEN_QUEUE_CONCURRENCY", "4"))
+QUEUE_MAX_SIZE = int(os.getenv("RAIDEN_QUEUE_MAX_SIZE", "64"))
+
+# 同期関数を実行するワーカースレッドの上限（プロセス全体で共有する）
+WORKER_THREADS = int(os.getenv("RAIDEN_WORKER_THREADS", "40"))
+
+def configure_queue(blocks):
+    """共通のキュー設定をBlocksに適用する"""
+    return blocks.queue(default_concurrency_limit=QUEUE_CONCURRENCY_LIMIT, max_size=QUEUE_MAX_SIZE)
+
+@contextlib.asynccontextmanager
+async def _shared_worker_pool(app):
+    # Gradioはmax_threadsが既定値のときanyioのデフォルトのリミッターを使うので、
+    # その上限を変えれば全アプリが同じワーカースレッドの枠を共有する
+    anyio.to_thread.current_default_thread_limiter().total_tokens = WORKER_THREADS
+    yield
+
+def build_tabbed_app(apps, title=None):
+    """
+    複数のBlocksを1つのBlocksのタブにまとめる
+
+    Parameters:
+    -----------
+    apps : list
+        (タブ名, パス, Blocks) のリスト。先頭のアプリのタイトルとCSSを引き継ぐ
+    title : str, optional
+        ページのタイトル
+    """
+    first = apps[0][2]
+    with gr.Blocks(title=title or first.title, css=first.css) as tabbed:
+        with gr.Tabs():
+            for label, _, blocks in apps:
+                with gr.Tab(label):
+                    blocks.render()
+    return configure_queue(tabbed)
+
+def create_app(apps, mode=SERVE_MODE, routers=None):
+    """
+    アプリをまとめたFastAPIアプリを作る
+
+    Parameters:
+    -----------
+    apps : list
+        (タブ名, パス, Blocks) のリスト。先頭がメインのアプリ
+    mode : str
+        "mount" ならパスごとにマウント、"tabs" ならタブにまとめて "/" にマウントする
+    routers : list, optional
+        Gradioより先に登録するFastAPIのルーター（"/" のマウントに隠れないようにする）
+    """
+    if mode not in ("mount", "tabs"):
+        raise ValueError(f"未対応の起動モードです: {mode}")
+
+    server = FastAPI(lifespan=_shared_worker_pool)
+    for router in routers or []:
+        server.include_router(router)
+
+    if mode == "tabs":
+        gr.mount_gradio_app(server, build_tabbed_app(apps), path="/", show_error=True)
+        return server
+
+    # "/" のマウントは全てのパスに一致するので、長いパスから順に登録する
+    for _, path, blocks in sorted(apps, key=lambda app: len(app[1]), reverse=True):
+        gr.mount_gradio_app(server, configure_queue(blocks), path=path, show_error=True)
+    return server
+
+def serve(apps, mode=SERVE_MODE, server_name=SERVER_NAME, server_port=SERVER_PORT, routers=None):
+    """
+    アプリを起動する（戻らない）
+
+    Parameters:
+    -----------
+    apps : list
+        (タブ名, パス, Blocks) のリスト。先頭がメインのアプリ
+    mode : str
+        "mount" / "tabs" / "separate"
+    routers : list, optional
+        一緒に配信するFastAPIのルーター（"separate" では配信しない）
+    """
+    if mode not in SERVE_MODES:
+        raise ValueError(f"未対応の起動モードです: {mode}")
+
+    if mode == "separate":
+        # 従来の起動方法。メイン以外は別スレッドで、ポートを1つずつずらして起動する
+        for offset, (label, _, blocks) in enumerate(apps[1:], start=1):
+            print(f"{label}を起動中... (http://{server_name}:{server_port + offset})")
+            thread = threading.Thread(
+                target=configure_queue(blocks).launch,
+                kwargs={"server_name": server_name, "server_port": server_port + offset,
+                        "share": False, "show_error": True, "max_threads": WORKER_THREADS},
+                daemon=True,
+            )
+            thread.start()
+        label, _, blocks = apps[0]
+        print(f"{label}を起動中... (http://{server_name}:{server_port})")
+        configure_queue(blocks).launch(server_name=server_name, server_port=server_port,
+                                       share=False, show_error=True, max_threads=WORKER_THREADS)
+        return
+
+    server = create_app(apps, mode, routers)
+    if mode == "tabs":
+        print(f"タブ表示で起動中... (http://{server_name}:{server_port})")
+    else:
+        for label, path, _ in apps:
+            print(f"{label}: http://{server_name}:{server_port}{path.rstrip('/')}/")
+    uvicorn.run(server, host=server_name, port=server_port)
@@ -0,0 +1,166 @@
+"""
+起動モード（separate / mount / tabs）ごとのメモリ使用量とスループットを比較するベンチマーク
+モードごとに子プロセスでサーバーを起動し、起動直後と負荷後のRSSと、
+Gradioのキュー経由のAPI呼び出しのスループット・レイテンシを計測する
+
+使い方:
+    python -m raiden.serving_benchmark --apps twin:demo1@/ twin:demo2@/greet2 \\
+        --api-name greet2 --payload '["太郎", 3]'
+    python -m raiden.serving_benchmark --apps app:demo@/ app:dental_app@/dental \\
+        --api-name calculate_combinations_28 --payload '[14]'
+
+RSSの計測にpsutilを使う。ベンチマーク専用の依存なのでrequirements.txtには含めていない
+（実行前に pip install psutil が必要）。
+"""
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import psutil
+
+MODES = ("separate", "mount", "tabs")
+
+def parse_app_spec(spec):
+    """ "モジュール:属性@パス" を (モジュール, 属性, パス) に分解する"""
+    target, _, path = spec.partition("@")
+    module_name, _, attribute = target.partition(":")
+    return module_name, attribute, path or "/"
+
+def run_server(specs):
+    """子プロセス側: 指定されたアプリを環境変数のモードで起動する"""
+    from raiden.serving import serve
+
+    apps = []
+    for spec in specs:
+        module_name, attribute, path = parse_app_spec(spec)
+        apps.append((attribute, path, getattr(importlib.import_module(module_name), attribute)))
+    serve(apps)
+
+def _rss(process):
+    """子プロセスとその子孫のRSSの合計（MB）"""
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total / 1e6
+
+def _call(client, base_url, api_name, payload):
+    """キュー経由でAPIを1回呼び出し、完了までの秒数を返す"""
+    start = time.perf_counter()
+    response = client.post(f"{base_url}/gradio_api/call/{api_name}", json={"data": payload})
+    response.raise_for_status()
+    event_id = response.json()["event_id"]
+    with client.stream("GET", f"{base_url}/gradio_api/call/{api_name}/{event_id}") as stream:
+        for line in stream.iter_lines():
+            if line.startswith("event: error"):
+                raise RuntimeError(f"APIの呼び出しに失敗しました: {api_name}")
+            if line.startswith("event: complete"):
+                break
+    return time.perf_counter() - start
+
+def _wait_until_ready(base_url, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("サーバーの起動に失敗しました")
+        try:
+            if httpx.get(f"{base_url}/config", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"サーバーが起動しませんでした: {base_url}")
+
+def measure_mode(mode, specs, target_index, api_name, payload, requests, concurrency, port):
+    """
+    1つの起動モードについて計測する
+
+    Returns:
+    --------
+    dict
+        起動直後・負荷後のRSS(MB)、スレッド数、スループット(req/s)、p50/p95レイテンシ(ms)
+    """
+    env = {**os.environ, "RAIDEN_SERVE_MODE": mode, "RAIDEN_SERVER_PORT": str(port)}
+    command = [sys.executable, "-m", "raiden.serving_benchmark", "--child", "--apps", *specs]
+    child = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if mode == "separate":
+            base_url = f"http://127.0.0.1:{port + target_index}"
+        elif mode == "mount":
+            base_url = f"http://127.0.0.1:{port}{parse_app_spec(specs[target_index])[2].rstrip('/')}"
+        else:
+            base_url = f"http://127.0.0.1:{port}"
+        _wait_until_ready(base_url, child)
+        if mode == "separate":
+            # 別ポートで起動する他のアプリも立ち上がるのを待つ
+            for offset in range(len(specs)):
+                _wait_until_ready(f"http://127.0.0.1:{port + offset}", child)
+        time.sleep(1)
+
+        process = psutil.Process(child.pid)
+        idle_rss = _rss(process)
+        threads = process.num_threads()
+
+        with httpx.Client(timeout=60) as client:
+            _call(client, base_url, api_name, payload)  # ウォームアップ
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = list(executor.map(lambda _: _call(client, base_url, api_name, payload), range(requests)))
+            elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            "mode": mode,
+            "idle_rss_mb": idle_rss,
+            "loaded_rss_mb": _rss(process),
+            "threads": threads,
+            "throughput": requests / elapsed,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        }
+    finally:
+        child.terminate()
+        try:
+            child.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            child.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="起動モードごとのメモリ使用量とスループットを比較します")
+    parser.add_argument("--apps", nargs="+", required=True, help="モジュール:属性@パス（先頭がメインのアプリ）")
+    parser.add_argument("--api-name", help="負荷をかけるAPI名")
+    parser.add_argument("--payload", default="[]", help="APIに渡すdata（JSON）")
+    parser.add_argument("--target-index", type=int, default=1, help="負荷をかけるアプリの位置")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_server(args.apps)
+        return
+
+    target_index = min(args.target_index, len(args.apps) - 1)
+    payload = json.loads(args.payload)
+    print(f"requests={args.requests}, concurrency={args.concurrency}, api={args.api_name}")
+    print(f"{'mode':>9} {'idle MB':>8} {'load MB':>8} {'threads':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for mode in args.modes:
+        result = measure_mode(mode, args.apps, target_index, args.api_name, payload,
+                              args.requests, args.concurrency, args.port)
+        print(f"{mode:>9} {result['idle_rss_mb']:>8.1f} {result['loaded_rss_mb']:>8.1f} {result['threads']:>8} "
+              f"{result['throughput']:>8.1f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
 import gradio as gr
-import threading
+from raiden.serving import serve
 
 # 1つ目のGradioアプリ（シンプルな挨拶）
 def greet1(name):
     return "こんにちは " + name + "さん!"
 
-demo1 = gr.Interface(fn=greet1, inputs="text", outputs="text")
+demo1 = gr.Interface(fn=greet1, inputs="text", outputs="text", api_name="greet1")
 
 # 2つ目のGradioアプリ（スライダー付き挨拶）
 def greet2(name, intensity):
@@ -15,16 +15,12 @@ demo2 = gr.Interface(
     fn=greet2,
     inputs=["text", "slider"],
     outputs=["text"],
+    api_name="greet2",
 )
 
-# スレッドで1つ目のアプリを起動
-def run_app1():
-    demo1.launch(server_name="127.0.0.1", server_port=7860, share=False, inbrowser=True)
-
-# スレッドを開始
-thread = threading.Thread(target=run_app1)
-thread.daemon = True
-thread.start()
-
-# メインスレッドで2つ目のアプリを起動
-demo2.launch(server_name="127.0.0.1", server_port=7861, share=False, inbrowser=True)
\ No newline at end of file
+# 2つのアプリを1つのサーバーで起動（RAIDEN_SERVE_MODE=tabsならタブ表示、separateなら従来通り別ポート）
+if __name__ == "__main__":
+    serve([
+        ("挨拶", "/", demo1),
+        ("スライダー付き挨拶", "/greet2", demo2),
+    ])